@@ -1,20 +1,38 @@
 import os
+import re
 import sys
 import markdown
 import logging
 import json
+import time
+import secrets
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, Response, stream_with_context, g
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from markupsafe import Markup
 import pymongo
-from bson.objectid import ObjectId
 from werkzeug.security import generate_password_hash, check_password_hash
-from src.rag_chain import build_rag_chain, ask_question
+from src.rag_chain import build_rag_chain, ask_question, stream_question, DB_PATH
+from src.models import warm_up_embedding_model
+from src.embedding_cache import get_embedding_cache, EMBED_CACHE_ENABLED
+from src.answer_cache import get_answer_cache, ANSWER_CACHE_ENABLED
+from src.chat_history import build_history, update_summary, get_summary_llm
+from bson.objectid import ObjectId
+from src.conversation_store import ConversationStore, merge_unflushed, insert_many_ignore_duplicates, make_title
+from src.write_behind import create_write_behind_queue, append_jsonl
+from src.session_store import init_session_store, is_stored_session, rotate_session_id, ServerSessionInterface
+from src import metrics
 from dotenv import load_dotenv
 
 load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = "lexibot-ajax-fix-key"
+# Lịch sử chat của khách lưu phía server, cookie chỉ chứa session id
+init_session_store(app)
 
 MONGO_URI = os.getenv("MONGO_URI")
 
@@ -25,7 +43,7 @@ try:
         db = client.lexibot_db
         feedback_col = db.feedbacks
         users_col = db.users
-        conversations_col = db.conversations
+        conversation_store = ConversationStore(db)
         print("Đã kết nối thành công tới MongoDB Atlas")
     else:
         print("Chưa có MONGO_URI trong file .env")
@@ -35,12 +53,99 @@ except Exception as e:
     db = None
 
 LEXIBOT_CHAIN = {}
+_chain_lock = threading.Lock()
+
+# Provider được build sẵn khi worker khởi động
+WARMUP_PROVIDERS = [p.strip() for p in os.getenv("WARMUP_PROVIDERS", "gemini,groq").split(",") if p.strip()]
+WARMUP_STATE = {"status": "starting", "embedding": False, "providers": {}, "duration": None}
 
 def get_chain(model_provider: str):
-    global LEXIBOT_CHAIN
-    if model_provider not in LEXIBOT_CHAIN:
-        LEXIBOT_CHAIN[model_provider] = build_rag_chain(model_provider)
-    return LEXIBOT_CHAIN[model_provider]
+    # Double-checked locking: nhiều request đầu tiên đồng thời chỉ build chain 1 lần
+    chain = LEXIBOT_CHAIN.get(model_provider)
+    if chain is not None:
+        return chain
+    with _chain_lock:
+        if model_provider not in LEXIBOT_CHAIN:
+            LEXIBOT_CHAIN[model_provider] = build_rag_chain(model_provider)
+        return LEXIBOT_CHAIN[model_provider]
+
+def warm_up(providers=None):
+    """Nạp embedding model + build chain cho các provider trước khi worker nhận request"""
+    start = time.perf_counter()
+    WARMUP_STATE["status"] = "starting"
+    if db is not None:
+        try:
+            conversation_store.ensure_indexes()
+        except Exception as e:
+            print(f"[WARMUP] Không tạo được index MongoDB: {e}", flush=True)
+    try:
+        warm_up_embedding_model()
+        WARMUP_STATE["embedding"] = True
+    except Exception as e:
+        print(f"[WARMUP] Lỗi nạp embedding model: {e}", flush=True)
+
+    for provider in providers or WARMUP_PROVIDERS:
+        try:
+            get_chain(provider)
+            WARMUP_STATE["providers"][provider] = "ready"
+        except Exception as e:
+            # Thiếu API key của 1 provider không làm hỏng cả worker
+            WARMUP_STATE["providers"][provider] = f"error: {e}"
+            print(f"[WARMUP] Không build được chain '{provider}': {e}", flush=True)
+
+    ok = [p for p, st in WARMUP_STATE["providers"].items() if st == "ready"]
+    if WARMUP_STATE["embedding"] and ok:
+        WARMUP_STATE["status"] = "ready" if len(ok) == len(WARMUP_STATE["providers"]) else "degraded"
+    else:
+        WARMUP_STATE["status"] = "failed"
+    WARMUP_STATE["duration"] = round(time.perf_counter() - start, 2)
+    print(f"[WARMUP] {WARMUP_STATE['status']} sau {WARMUP_STATE['duration']}s: {WARMUP_STATE['providers']}", flush=True)
+
+def _reset_after_fork():
+    """
+    Với gunicorn --preload, app được import ở master rồi fork ra worker.
+    Chain (client Chroma) và lock không an toàn khi fork -> tạo lại trong worker.
+    Client LLM/httpx (src/models.py) và router (src/llm_router.py) tự reset bằng os.register_at_fork của module đó.
+    """
+    global _chain_lock
+    _chain_lock = threading.Lock()
+    LEXIBOT_CHAIN.clear()
+    WARMUP_STATE.update({"status": "starting", "embedding": False, "providers": {}, "duration": None})
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+# =========================
+# METRICS
+# =========================
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    metrics.start_request()
+
+@app.after_request
+def finish_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    elapsed = time.perf_counter() - g.get("request_start", time.perf_counter())
+    metrics.inc("lexibot_http_requests_total", {"route": route, "status": response.status_code})
+    metrics.observe("lexibot_http_request_duration_seconds", elapsed, {"route": route})
+
+    timing = metrics.server_timing_header()
+    if timing:
+        response.headers["Server-Timing"] = f"{timing}, total;dur={elapsed * 1000:.1f}"
+    return response
+
+def cache_gauges():
+    values = []
+    if EMBED_CACHE_ENABLED:
+        stats = get_embedding_cache().stats()
+        values.append(({"cache": "embedding"}, stats["hit_rate"]))
+    if ANSWER_CACHE_ENABLED:
+        stats = get_answer_cache(DB_PATH).stats()
+        values.append(({"cache": "answer"}, stats["hit_rate"]))
+    return values
+
+metrics.describe("lexibot_request_errors_total", "Số request lỗi theo route")
+metrics.register_gauge("lexibot_cache_hit_rate", "Tỉ lệ trúng cache (từ lúc worker khởi động)", cache_gauges)
 
 def simplify_sources(docs):
     simple = []
@@ -93,6 +198,7 @@ def login():
 
     user = users_col.find_one({"username": username})
     if user and check_password_hash(user["password"], password):
+        rotate_session_id(app, session)
         session["user_id"] = str(user["_id"])
         session["username"] = username
         session["current_chat_id"] = None # Reset chat context
@@ -116,14 +222,22 @@ def index():
     requested_chat_id = request.args.get("chat_id")
 
     if user_id and db is not None:
+        # Các lượt vừa hỏi có thể còn trong hàng đợi ghi nền -> ghép vào, không chờ ghi xong
+        pending_chats = unflushed_conversations(user_id)
         # Lấy danh sách hội thoại của user
-        conversations = list(conversations_col.find({"user_id": user_id}).sort("updated_at", -1))
+        conversations = conversation_store.list_conversations(user_id)
+        listed = {str(chat["_id"]) for chat in conversations}
+        conversations = [chat for chat in pending_chats if str(chat["_id"]) not in listed] + conversations
         
         if requested_chat_id:
             # Load nội dung hội thoại cụ thể
-            chat = conversations_col.find_one({"_id": ObjectId(requested_chat_id), "user_id": user_id})
+            pending = unflushed_items(requested_chat_id)
+            chat = conversation_store.get(requested_chat_id, user_id)
             if chat:
-                chat_history = chat.get("messages", [])
+                chat_history = merge_unflushed(conversation_store.load_messages(chat), pending)
+                session["current_chat_id"] = requested_chat_id
+            elif any(str(c["_id"]) == requested_chat_id for c in pending_chats):
+                chat_history = merge_unflushed([], pending)
                 session["current_chat_id"] = requested_chat_id
         else:
             # Trang chủ mặc định hoặc sau khi bấm New Chat
@@ -132,7 +246,7 @@ def index():
             else:
                  chat_history = []
     else:
-        # Khách: Dùng session cookie
+        # Khách: lịch sử nằm trong session
         chat_history = session.get("chat_history", [])
 
     return render_template("index.html", 
@@ -142,6 +256,270 @@ def index():
                            username=session.get("username"),
                            current_chat_id=session.get("current_chat_id"))
 
+MESSAGE_FORMAT_MARKDOWN = "markdown"
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "2048"))  # số câu trả lời đã render được nhớ
+
+# Tóm tắt lịch sử chạy nền sau khi đã trả lời (không làm chậm request)
+HISTORY_SUMMARY_MAX_STEPS = int(os.getenv("HISTORY_SUMMARY_MAX_STEPS", "5"))  # tồn đọng dài thì tóm tắt dần qua nhiều lượt
+summary_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
+
+# =========================
+# GHI NỀN (write-behind)
+# =========================
+FEEDBACK_LOG_PATH = "feedback_logs.jsonl"
+
+# chat_id -> các batch tin nhắn đã xếp hàng nhưng có thể chưa ghi xuống Mongo
+_unflushed = {}
+# chat_id -> hội thoại mới đã xếp hàng nhưng có thể chưa được tạo (hiện trên sidebar)
+_unflushed_conversations = {}
+_unflushed_lock = threading.Lock()
+
+def write_conversations(items):
+    conversation_store.create_many(items)
+
+def write_messages(items):
+    missing = conversation_store.append_many(items)
+    if missing:
+        # Hội thoại không có trong Mongo (đã xóa, hoặc lệnh tạo đã vào file dự phòng) -> giữ tin nhắn trong file dự phòng
+        print(f"[PERSIST] {len(missing)} batch tin nhắn không có hội thoại -> {persist_queue.fallback_path}", flush=True)
+        persist_queue.fallback("messages", missing, reason="conversation_missing")
+        items = [item for item in items if item["first_seq"] is not None]
+    # Tóm tắt sau khi tin nhắn đã nằm trong Mongo
+    models = {str(item["chat_id"]): item["model"] for item in items}
+    for chat_id, model in models.items():
+        try:
+            summary_pool.submit(refresh_conversation_summary, chat_id, model)
+        except RuntimeError:
+            # Process đang tắt (pool đã đóng): tin nhắn đã ghi xong, bản tóm tắt sẽ được cập nhật ở lượt hỏi sau
+            break
+
+def write_feedback(items):
+    if db is not None:
+        insert_many_ignore_duplicates(feedback_col, items)
+    else:
+        append_jsonl(FEEDBACK_LOG_PATH, items)
+
+def settle_unflushed(kind, items):
+    if kind == "conversation":
+        with _unflushed_lock:
+            for item in items:
+                _unflushed_conversations.pop(str(item["chat_id"]), None)
+        return
+    if kind != "messages":
+        return
+    with _unflushed_lock:
+        for item in items:
+            key = str(item["chat_id"])
+            pending = [p for p in _unflushed.get(key, []) if p is not item]
+            if pending:
+                _unflushed[key] = pending
+            else:
+                _unflushed.pop(key, None)
+
+persist_queue = create_write_behind_queue(
+    {"conversation": write_conversations, "messages": write_messages, "feedback": write_feedback},
+    on_settled=settle_unflushed,
+)
+
+def queue_new_conversation(user_id, question):
+    """Tạo id hội thoại ngay (để ghi vào session), document được ghi nền"""
+    chat_id = ObjectId()
+    with _unflushed_lock:
+        _unflushed_conversations[str(chat_id)] = {
+            "_id": chat_id, "user_id": user_id, "title": make_title(question), "updated_at": datetime.now()}
+    persist_queue.put("conversation", {"chat_id": chat_id, "user_id": user_id, "question": question})
+    return str(chat_id)
+
+def queue_messages(chat_id, messages, model):
+    item = {"chat_id": chat_id, "messages": messages, "model": model}
+    with _unflushed_lock:
+        _unflushed.setdefault(str(chat_id), []).append(item)
+    persist_queue.put("messages", item)
+
+def unflushed_items(chat_id):
+    with _unflushed_lock:
+        return list(_unflushed.get(str(chat_id), []))
+
+def unflushed_conversations(user_id):
+    """Hội thoại mới của user chưa được ghi xuống Mongo, mới nhất trước"""
+    with _unflushed_lock:
+        chats = [c for c in _unflushed_conversations.values() if c["user_id"] == user_id]
+    return sorted(chats, key=lambda c: c["updated_at"], reverse=True)
+
+def load_conversation_history(chat_id):
+    """N tin nhắn cuối trong Mongo + các tin nhắn đang chờ ghi (câu hỏi tiếp theo vẫn thấy lượt vừa hỏi)"""
+    pending = unflushed_items(chat_id)
+    messages, summary, summary_upto, offset = conversation_store.load_history(chat_id)
+    return merge_unflushed(messages, pending), summary, summary_upto, offset
+
+def load_context_history():
+    """Lấy lịch sử để làm context cho AI: (các lượt gần nhất trong cửa sổ token, tóm tắt các lượt cũ hơn)"""
+    if session.get("user_id") and session.get("current_chat_id") and db is not None:
+        # Chỉ đọc N tin nhắn cuối, không tải cả hội thoại
+        return build_history(*load_conversation_history(session["current_chat_id"]))
+    return build_history(session.get("chat_history", []), session.get("chat_summary"), session.get("chat_summary_upto"))
+
+def refresh_conversation_summary(chat_id, model, max_steps=HISTORY_SUMMARY_MAX_STEPS):
+    """Gộp các tin nhắn đã rơi khỏi cửa sổ vào bản tóm tắt của hội thoại (chạy trong summary_pool), tối đa max_steps lần gọi LLM"""
+    try:
+        for _ in range(max_steps):
+            messages, summary, summary_upto, offset = conversation_store.load_summary_backlog(chat_id)
+            result = update_summary(get_summary_llm(model), messages, summary, summary_upto, offset)
+            if result is None:
+                break
+            conversation_store.save_summary(chat_id, summary_upto, *result)
+    except Exception as e:
+        print(f"[HISTORY] Lỗi tóm tắt hội thoại {chat_id}: {e}", flush=True)
+
+def refresh_stored_guest_summary(sid, model, max_steps=HISTORY_SUMMARY_MAX_STEPS):
+    """Khách, session phía server: tóm tắt trong summary_pool rồi ghi lại session theo id"""
+    interface = app.session_interface
+    try:
+        for _ in range(max_steps):
+            sess = interface.get(sid)
+            result = update_summary(get_summary_llm(model), sess.get("chat_history", []),
+                                    sess.get("chat_summary"), sess.get("chat_summary_upto"))
+            if result is None:
+                break
+            # Đọc lại: trong lúc gọi LLM session có thể đã được ghi (lượt mới, xóa lịch sử, task khác đã tóm tắt)
+            latest = interface.get(sid)
+            if (latest.get("chat_summary_upto") != sess.get("chat_summary_upto")
+                    or len(latest.get("chat_history", [])) < result[1]):
+                break
+            latest["chat_summary"], latest["chat_summary_upto"] = result
+            interface.store(app, latest)
+    except Exception as e:
+        print(f"[HISTORY] Lỗi tóm tắt lịch sử khách: {e}", flush=True)
+
+def queue_guest_summary(sid, model):
+    try:
+        summary_pool.submit(refresh_stored_guest_summary, sid, model)
+    except RuntimeError:
+        # Process đang tắt: lịch sử đã lưu, bản tóm tắt sẽ được cập nhật ở lượt hỏi sau
+        pass
+
+def refresh_guest_summary(model):
+    """
+    Khách, session phía server: ghi session ngay rồi tóm tắt nền (như write_messages của user).
+    Cookie session chỉ ghi được khi kết thúc request nên phải tóm tắt ngay trong request.
+    """
+    if isinstance(app.session_interface, ServerSessionInterface):
+        new_session = session.sid is None
+        app.session_interface.store(app, session)
+        session.modified = new_session   # session mới: save_session vẫn phải gửi cookie chứa id
+        queue_guest_summary(session.sid, model)
+        return
+    try:
+        result = update_summary(get_summary_llm(model), session.get("chat_history", []),
+                                session.get("chat_summary"), session.get("chat_summary_upto"))
+    except Exception as e:
+        print(f"[HISTORY] Lỗi tóm tắt lịch sử khách: {e}", flush=True)
+        return
+    if result is not None:
+        session["chat_summary"], session["chat_summary_upto"] = result
+        session.modified = True
+
+def build_turn_messages(question, answer_markdown, sources, model):
+    """Tạo object tin nhắn (câu trả lời lưu Markdown gốc, HTML được render khi hiển thị)"""
+    user_msg = {"role": "user", "content": question, "timestamp": datetime.now()}
+    bot_msg = {
+        "role": "assistant",
+        "content": answer_markdown,
+        "format": MESSAGE_FORMAT_MARKDOWN,
+        "sources": sources,
+        "model": model,
+        "timestamp": datetime.now()
+    }
+    return user_msg, bot_msg
+
+def clear_guest_history():
+    for key in ("chat_history", "chat_summary", "chat_summary_upto"):
+        session.pop(key, None)
+
+def append_guest_history(messages):
+    """Lưu Session cho khách"""
+    hist = session.get("chat_history", [])
+    hist.extend(messages)
+    session["chat_history"] = hist
+    session.modified = True
+
+def save_turn(question, user_msg, bot_msg):
+    """LƯU TRỮ 1 lượt hỏi-đáp vào Mongo qua hàng đợi ghi nền (user) hoặc session (khách), rồi cập nhật tóm tắt lịch sử"""
+    if session.get("user_id") and db is not None:
+        chat_id = session.get("current_chat_id")
+        if not chat_id:
+            # Tạo hội thoại mới
+            chat_id = queue_new_conversation(session["user_id"], question)
+            session["current_chat_id"] = chat_id
+        queue_messages(chat_id, [user_msg, bot_msg], bot_msg["model"])
+    else:
+        append_guest_history([user_msg, bot_msg])
+        refresh_guest_summary(bot_msg["model"])
+
+def render_answer(answer_raw):
+    return markdown.markdown(answer_raw, extensions=['tables', 'fenced_code'])
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render_message(answer_raw):
+    """Render câu trả lời hoàn chỉnh (memoize: mỗi tin nhắn chỉ render 1 lần mỗi worker, kể cả khi index() hiển thị lại)"""
+    return render_answer(answer_raw)
+
+@app.template_filter("message_html")
+def message_html(msg):
+    """Tin nhắn cũ (trước khi lưu Markdown) đã là HTML -> hiển thị nguyên như trước"""
+    if msg.get("format") == MESSAGE_FORMAT_MARKDOWN:
+        return Markup(render_message(msg.get("content", "")))
+    return Markup(msg.get("content", ""))
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+_FENCE_RE = re.compile(r"^ {0,3}(```|~~~)", re.M)
+
+class AnswerStreamRenderer:
+    """
+    Gom token khi stream và tạo các sự kiện SSE. Chỉ render các khối Markdown vừa hoàn chỉnh (kết thúc bằng dòng trống,
+    không nằm giữa khối code) rồi gửi để client nối thêm -> mỗi đoạn chỉ render một lần, không render lại cả câu trả lời.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.sources = []
+        self.pending = ""       # phần chưa render (khối đang viết dở)
+        self.rendered_upto = 0  # số ký tự đầu câu trả lời đã render
+
+    def feed(self, kind, payload):
+        if kind == "sources":
+            self.sources = simplify_sources(payload)
+            return [sse_event("sources", {"sources": self.sources})]
+
+        self.parts.append(payload)
+        self.pending += payload
+        events = [sse_event("token", {"text": payload})]
+        if "\n" in payload:
+            end = self._complete_blocks_end()
+            if end:
+                html = render_answer(self.pending[:end])
+                self.rendered_upto += end
+                self.pending = self.pending[end:]
+                events.append(sse_event("html", {"html": html, "upto": self.rendered_upto}))
+        return events
+
+    def _complete_blocks_end(self):
+        """Vị trí sau dòng trống cuối cùng không nằm trong khối code (0 nếu chưa có khối nào xong)"""
+        end = self.pending.rfind("\n\n")
+        while end != -1:
+            if len(_FENCE_RE.findall(self.pending, 0, end)) % 2 == 0:
+                return end + 2
+            end = self.pending.rfind("\n\n", 0, end)
+        return 0
+
+    def answer_markdown(self):
+        return "".join(self.parts)
+
+    def answer_html(self):
+        return render_message(self.answer_markdown())
+
 @app.route("/ask", methods=["POST"])
 def ask():
     try:
@@ -152,61 +530,18 @@ def ask():
         model = data.get("model", "gemini")
         chain = get_chain(model)
         
-        # Lấy lịch sử để context cho AI
-        context_history = [] 
-        if session.get("user_id") and session.get("current_chat_id") and db is not None:
-             chat_doc = conversations_col.find_one({"_id": ObjectId(session["current_chat_id"])})
-             if chat_doc: context_history = chat_doc.get("messages", [])
-        else:
-             context_history = session.get("chat_history", [])
+        with metrics.timed("history_load"):
+            context_history, history_summary = load_context_history()
 
         # Xử lý RAG
-        answer_raw, raw_docs = ask_question(chain, question, context_history)
-        answer_html = markdown.markdown(answer_raw, extensions=['tables', 'fenced_code'])
+        answer_raw, raw_docs = ask_question(chain, question, context_history, history_summary)
+        with metrics.timed("render"):
+            answer_html = render_message(answer_raw)
         safe_sources = simplify_sources(raw_docs)
         
-        # Tạo object tin nhắn
-        user_msg = {"role": "user", "content": question, "timestamp": datetime.now()}
-        bot_msg = {
-            "role": "assistant", 
-            "content": answer_html, 
-            "sources": safe_sources, 
-            "model": model, 
-            "timestamp": datetime.now()
-        }
-
-        # LƯU TRỮ
-        if session.get("user_id") and db is not None:
-            user_id = session["user_id"]
-            chat_id = session.get("current_chat_id")
-
-            if chat_id:
-                # Cập nhật chat hiện tại
-                conversations_col.update_one(
-                    {"_id": ObjectId(chat_id)},
-                    {
-                        "$push": {"messages": {"$each": [user_msg, bot_msg]}},
-                        "$set": {"updated_at": datetime.now()}
-                    }
-                )
-            else:
-                # Tạo hội thoại mới
-                new_chat = {
-                    "user_id": user_id,
-                    "title": question[:50] + "..." if len(question) > 50 else question,
-                    "created_at": datetime.now(),
-                    "updated_at": datetime.now(),
-                    "messages": [user_msg, bot_msg]
-                }
-                res = conversations_col.insert_one(new_chat)
-                session["current_chat_id"] = str(res.inserted_id)
-        else:
-            # Lưu Session cho khách
-            hist = session.get("chat_history", [])
-            hist.append(user_msg)
-            hist.append(bot_msg)
-            session["chat_history"] = hist
-            session.modified = True
+        user_msg, bot_msg = build_turn_messages(question, answer_raw, safe_sources, model)
+        with metrics.timed("persist"):
+            save_turn(question, user_msg, bot_msg)
 
         return jsonify({
             "answer": answer_html,
@@ -214,27 +549,139 @@ def ask():
             "model": model
         })
 
+    except Exception as e:
+        print(f"[ERROR]: {str(e)}", flush=True)
+        metrics.inc("lexibot_request_errors_total", {"route": "/ask"})
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/ask_stream", methods=["POST"])
+def ask_stream():
+    """
+    Bản streaming của /ask (Server-Sent Events):
+    - event "sources": nguồn tài liệu ngay khi retrieve xong
+    - event "token": từng đoạn text LLM sinh ra
+    - event "html": HTML của các khối Markdown vừa hoàn chỉnh (client nối thêm), upto = số ký tự đã render
+    - event "done": câu trả lời HTML cuối cùng (+ commit_token cho khách)
+    """
+    data = request.get_json()
+    if not data: return jsonify({"error": "Dữ liệu lỗi"}), 400
+
+    question = data.get("question")
+    model = data.get("model", "gemini")
+    try:
+        chain = get_chain(model)
+        with metrics.timed("history_load"):
+            context_history, history_summary = load_context_history()
     except Exception as e:
         print(f"[ERROR]: {str(e)}", flush=True)
         return jsonify({"error": str(e)}), 500
 
+    # Header/cookie được gửi trước khi stream -> phải tạo hội thoại (và ghi session) từ bây giờ
+    user_id = session.get("user_id") if db is not None else None
+    chat_id = None
+    if user_id:
+        chat_id = session.get("current_chat_id")
+        if not chat_id:
+            chat_id = queue_new_conversation(user_id, question)
+            session["current_chat_id"] = chat_id
+    else:
+        ensure_guest_id(session)
+
+    def generate():
+        renderer = AnswerStreamRenderer()
+        try:
+            for kind, payload in stream_question(chain, question, context_history, history_summary):
+                yield from renderer.feed(kind, payload)
+
+            answer_html = renderer.answer_html()
+            user_msg, bot_msg = build_turn_messages(question, renderer.answer_markdown(), renderer.sources, model)
+            done = {"answer": answer_html, "sources": renderer.sources, "model": model}
+            if user_id:
+                with metrics.timed("persist"):
+                    queue_messages(chat_id, [user_msg, bot_msg], model)
+            elif is_stored_session(session):
+                # Session phía server: ghi thẳng (refresh_guest_summary ghi session), không cần gửi lại cookie
+                append_guest_history([user_msg, bot_msg])
+                refresh_guest_summary(model)
+            else:
+                # Cookie session không ghi được sau khi đã stream -> client gửi lại token đã ký qua /ask_stream/commit
+                done["commit_token"] = make_commit_token(
+                    session, question, renderer.answer_markdown(), renderer.sources, model)
+            yield sse_event("done", done)
+        except Exception as e:
+            print(f"[ERROR]: {str(e)}", flush=True)
+            metrics.inc("lexibot_request_errors_total", {"route": "/ask_stream"})
+            yield sse_event("error", {"error": str(e)})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+COMMIT_TOKEN_MAX_AGE = int(os.getenv("COMMIT_TOKEN_MAX_AGE", "300"))  # giây
+
+def guest_turn_serializer():
+    return URLSafeTimedSerializer(app.secret_key, salt="guest-turn")
+
+def ensure_guest_id(sess):
+    """Id ngẫu nhiên của phiên khách, gắn commit token với đúng session (phải có trước khi gửi cookie)"""
+    if "guest_id" not in sess:
+        sess["guest_id"] = secrets.token_urlsafe(16)
+    return sess["guest_id"]
+
+def make_commit_token(sess, question, answer, sources, model):
+    return guest_turn_serializer().dumps({
+        "sid": sess.get("guest_id"), "nonce": secrets.token_urlsafe(16),
+        "question": question, "answer": answer, "sources": sources, "model": model
+    })
+
+def accept_commit_token(sess, token):
+    """Lượt hỏi-đáp trong token, None nếu sai chữ ký, hết hạn, của session khác hoặc đã dùng"""
+    try:
+        turn = guest_turn_serializer().loads(token, max_age=COMMIT_TOKEN_MAX_AGE)
+    except BadSignature:
+        return None
+    if not turn.get("sid") or turn["sid"] != sess.get("guest_id"):
+        return None
+    # Nonce đã dùng được nhớ tới khi token hết hạn
+    now = time.time()
+    used = {n: t for n, t in sess.get("used_commit_nonces", {}).items() if t > now}
+    if turn["nonce"] in used:
+        return None
+    used[turn["nonce"]] = now + COMMIT_TOKEN_MAX_AGE
+    sess["used_commit_nonces"] = used
+    return turn
+
+@app.route("/ask_stream/commit", methods=["POST"])
+def ask_stream_commit():
+    """Lưu lượt hỏi-đáp đã stream vào session của khách"""
+    data = request.get_json() or {}
+    turn = accept_commit_token(session, data.get("commit_token", ""))
+    if turn is None:
+        return jsonify({"error": "Token không hợp lệ"}), 400
+
+    user_msg, bot_msg = build_turn_messages(turn["question"], turn["answer"], turn["sources"], turn["model"])
+    append_guest_history([user_msg, bot_msg])
+    refresh_guest_summary(turn["model"])
+    return jsonify({"status": "success"})
+
 @app.route("/new_chat", methods=["POST"])
 def new_chat():
     """Tạo phiên chat mới"""
     if session.get("user_id"):
         session["current_chat_id"] = None
     else:
-        session.pop("chat_history", None)
+        clear_guest_history()
     return jsonify({"status": "success"})
 
 @app.route("/delete_chat", methods=["POST"])
 def delete_chat():
     """Xóa hội thoại hiện tại"""
     if session.get("user_id") and session.get("current_chat_id") and db is not None:
-        conversations_col.delete_one({"_id": ObjectId(session["current_chat_id"])})
+        # Ghi xong các thao tác đang chờ trước, tránh hội thoại bị tạo lại sau khi xóa
+        persist_queue.drain()
+        conversation_store.delete(session["current_chat_id"], session["user_id"])
         session["current_chat_id"] = None
     else:
-        session.pop("chat_history", None)
+        clear_guest_history()
     return jsonify({"status": "success"})
 
 @app.route("/feedback", methods=["POST"])
@@ -251,20 +698,32 @@ def feedback():
             "timestamp": datetime.now(timezone.utc)
         }
         if db is not None:
-            result = feedback_col.insert_one(feedback_doc)
-            return jsonify({"status": "success", "id": str(result.inserted_id)})
+            feedback_doc["_id"] = ObjectId()
+            persist_queue.put("feedback", feedback_doc)
+            return jsonify({"status": "success", "id": str(feedback_doc["_id"])})
         else:
-            with open("feedback_logs.jsonl", "a", encoding="utf-8") as f:
-                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+            persist_queue.put("feedback", data)
             return jsonify({"status": "success", "storage": "local"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Số liệu Prometheus của worker hiện tại"""
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/health", methods=["GET"])
+def health():
+    """Trạng thái sẵn sàng của worker (dùng cho load balancer / readiness probe)"""
+    code = 200 if WARMUP_STATE["status"] in ("ready", "degraded") else 503
+    return jsonify(WARMUP_STATE), code
+
 @app.route("/clear", methods=["POST"])
 def clear():
-    session.pop("chat_history", None)
+    clear_guest_history()
     return jsonify({"status": "success"})
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
+    warm_up()
     app.run(host="0.0.0.0", port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,292 @@
+"""
+Entry point ASGI cho LexiBot.
+- /ask và /ask_stream chạy bất đồng bộ: thời gian chờ LLM không giữ thread/worker,
+  một process (một bản embedding model) phục vụ được hàng trăm câu hỏi cùng lúc.
+- Các route còn lại vẫn do Flask xử lý (qua WsgiToAsgi), dùng chung session (src/session_store.py).
+
+Chạy: uvicorn asgi:application --host 0.0.0.0 --port 5000
+"""
+import json
+import time
+import asyncio
+from http.cookies import SimpleCookie
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+from pymongo import AsyncMongoClient
+from werkzeug.http import dump_cookie
+from app import (
+    app as flask_app, MONGO_URI, get_chain, simplify_sources, render_message, build_turn_messages,
+    sse_event, AnswerStreamRenderer, make_commit_token, ensure_guest_id, warm_up,
+    persist_queue, queue_new_conversation, queue_messages, unflushed_items, queue_guest_summary
+)
+from src.rag_chain import ask_question_async, astream_question
+from src.chat_history import build_history, aupdate_summary, get_summary_llm
+from src.conversation_store import AsyncConversationStore, merge_unflushed
+from src.session_store import ServerSessionInterface, is_stored_session
+from src import metrics
+
+flask_asgi = WsgiToAsgi(flask_app)
+
+_async_db = None
+_async_store = None
+
+def get_async_db():
+    """Kết nối MongoDB bất đồng bộ (tạo khi đã có event loop)"""
+    global _async_db
+    if _async_db is None and MONGO_URI:
+        _async_db = AsyncMongoClient(MONGO_URI).lexibot_db
+    return _async_db
+
+def get_store():
+    global _async_store
+    if _async_store is None and get_async_db() is not None:
+        _async_store = AsyncConversationStore(get_async_db())
+    return _async_store
+
+# =========================
+# SESSION (dùng chung cookie và session store với Flask)
+# =========================
+def server_session_interface():
+    interface = flask_app.session_interface
+    return interface if isinstance(interface, ServerSessionInterface) else None
+
+def load_session(scope):
+    cookie_name = flask_app.config["SESSION_COOKIE_NAME"]
+    raw = b""
+    for name, value in scope.get("headers", []):
+        if name == b"cookie":
+            raw = value
+            break
+    morsel = SimpleCookie(raw.decode("latin-1")).get(cookie_name)
+    interface = server_session_interface()
+    if interface is not None:
+        return interface.load(flask_app, morsel.value if morsel else None)
+    if morsel is None:
+        return {}
+
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+    try:
+        return dict(serializer.loads(morsel.value, max_age=max_age))
+    except BadSignature:
+        return {}
+
+async def save_session(sess):
+    """Ghi session phía server (SQLite nằm ngoài event loop) -> giá trị cookie (None = xóa cookie)"""
+    interface = server_session_interface()
+    if interface is None:
+        serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+        return serializer.dumps(sess)
+    return await asyncio.to_thread(interface.store, flask_app, sess)
+
+async def session_cookie_header(sess):
+    value = await save_session(sess)
+    cookie = dump_cookie(
+        flask_app.config["SESSION_COOKIE_NAME"],
+        value or "",
+        max_age=None if value else 0,
+        path=flask_app.config["SESSION_COOKIE_PATH"] or "/",
+        httponly=flask_app.config["SESSION_COOKIE_HTTPONLY"],
+        secure=flask_app.config["SESSION_COOKIE_SECURE"],
+        samesite=flask_app.config["SESSION_COOKIE_SAMESITE"],
+    )
+    return (b"set-cookie", cookie.encode("latin-1"))
+
+# =========================
+# HTTP HELPERS
+# =========================
+async def read_json(receive):
+    body = b""
+    more = True
+    while more:
+        message = await receive()
+        body += message.get("body", b"")
+        more = message.get("more_body", False)
+    try:
+        return json.loads(body) if body else None
+    except ValueError:
+        return None
+
+async def send_json(send, status, data, headers=()):
+    body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), *headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+# =========================
+# LƯU TRỮ
+# =========================
+# Ghi Mongo đi qua hàng đợi ghi nền của app.py (thread riêng); tóm tắt hội thoại chạy sau khi batch được ghi
+async def load_context_history(sess):
+    store = get_store()
+    if sess.get("user_id") and sess.get("current_chat_id") and store is not None:
+        chat_id = sess["current_chat_id"]
+        pending = unflushed_items(chat_id)
+        messages, summary, summary_upto, offset = await store.load_history(chat_id)
+        return build_history(merge_unflushed(messages, pending), summary, summary_upto, offset)
+    return build_history(sess.get("chat_history", []), sess.get("chat_summary"), sess.get("chat_summary_upto"))
+
+async def refresh_guest_summary(sess, model):
+    """Chỉ dùng cho cookie session (ghi được khi gửi response); session phía server tóm tắt nền qua queue_guest_summary"""
+    try:
+        llm = await asyncio.to_thread(get_summary_llm, model)
+        result = await aupdate_summary(llm, sess.get("chat_history", []),
+                                       sess.get("chat_summary"), sess.get("chat_summary_upto"))
+    except Exception as e:
+        print(f"[HISTORY] Lỗi tóm tắt lịch sử khách: {e}", flush=True)
+        return
+    if result is not None:
+        sess["chat_summary"], sess["chat_summary_upto"] = result
+
+# =========================
+# ROUTES
+# =========================
+async def ask(scope, receive, send):
+    start = time.perf_counter()
+    metrics.start_request()
+    sess = load_session(scope)
+    data = await read_json(receive)
+    if not data:
+        return await send_json(send, 400, {"error": "Dữ liệu lỗi"})
+
+    try:
+        question = data.get("question")
+        model = data.get("model", "gemini")
+        chain = await asyncio.to_thread(get_chain, model)
+        with metrics.timed("history_load"):
+            context_history, history_summary = await load_context_history(sess)
+
+        # Xử lý RAG
+        answer_raw, raw_docs = await ask_question_async(chain, question, context_history, history_summary)
+        with metrics.timed("render"):
+            answer_html = render_message(answer_raw)
+        safe_sources = simplify_sources(raw_docs)
+        user_msg, bot_msg = build_turn_messages(question, answer_raw, safe_sources, model)
+
+        # LƯU TRỮ
+        guest = not (sess.get("user_id") and get_store() is not None)
+        with metrics.timed("persist"):
+            if not guest:
+                chat_id = sess.get("current_chat_id")
+                if not chat_id:
+                    chat_id = await asyncio.to_thread(queue_new_conversation, sess["user_id"], question)
+                    sess["current_chat_id"] = chat_id
+                await asyncio.to_thread(queue_messages, chat_id, [user_msg, bot_msg], model)
+            else:
+                sess["chat_history"] = sess.get("chat_history", []) + [user_msg, bot_msg]
+                if server_session_interface() is None:
+                    await refresh_guest_summary(sess, model)
+        cookie = await session_cookie_header(sess)
+        if guest and is_stored_session(sess):
+            queue_guest_summary(sess.sid, model)
+
+        elapsed = time.perf_counter() - start
+        metrics.inc("lexibot_http_requests_total", {"route": "/ask", "status": 200})
+        metrics.observe("lexibot_http_request_duration_seconds", elapsed, {"route": "/ask"})
+        timing = f"{metrics.server_timing_header()}, total;dur={elapsed * 1000:.1f}"
+        return await send_json(send, 200, {
+            "answer": answer_html,
+            "sources": safe_sources,
+            "model": model
+        }, headers=[cookie, (b"server-timing", timing.encode("latin-1"))])
+
+    except Exception as e:
+        print(f"[ERROR]: {str(e)}", flush=True)
+        metrics.inc("lexibot_request_errors_total", {"route": "/ask"})
+        return await send_json(send, 500, {"error": str(e)})
+
+async def ask_stream(scope, receive, send):
+    start = time.perf_counter()
+    metrics.start_request()
+    sess = load_session(scope)
+    data = await read_json(receive)
+    if not data:
+        return await send_json(send, 400, {"error": "Dữ liệu lỗi"})
+
+    question = data.get("question")
+    model = data.get("model", "gemini")
+    try:
+        chain = await asyncio.to_thread(get_chain, model)
+        with metrics.timed("history_load"):
+            context_history, history_summary = await load_context_history(sess)
+    except Exception as e:
+        print(f"[ERROR]: {str(e)}", flush=True)
+        metrics.inc("lexibot_request_errors_total", {"route": "/ask_stream"})
+        return await send_json(send, 500, {"error": str(e)})
+
+    # Header/cookie được gửi trước khi stream -> tạo hội thoại từ bây giờ
+    user_id = sess.get("user_id") if get_store() is not None else None
+    chat_id = None
+    headers = [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")]
+    if user_id:
+        chat_id = sess.get("current_chat_id")
+        if not chat_id:
+            chat_id = await asyncio.to_thread(queue_new_conversation, user_id, question)
+            sess["current_chat_id"] = chat_id
+            headers.append(await session_cookie_header(sess))
+    elif "guest_id" not in sess:
+        # Khách mới: commit token gắn với guest_id nên cookie phải có id trước khi stream
+        ensure_guest_id(sess)
+        headers.append(await session_cookie_header(sess))
+
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+
+    async def emit(text):
+        await send({"type": "http.response.body", "body": text.encode("utf-8"), "more_body": True})
+
+    renderer = AnswerStreamRenderer()
+    try:
+        async for kind, payload in astream_question(chain, question, context_history, history_summary):
+            for event in renderer.feed(kind, payload):
+                await emit(event)
+
+        answer_html = renderer.answer_html()
+        user_msg, bot_msg = build_turn_messages(question, renderer.answer_markdown(), renderer.sources, model)
+        done = {"answer": answer_html, "sources": renderer.sources, "model": model}
+        if user_id:
+            await asyncio.to_thread(queue_messages, chat_id, [user_msg, bot_msg], model)
+        elif is_stored_session(sess):
+            # Session phía server: ghi thẳng, không cần gửi lại cookie
+            sess["chat_history"] = sess.get("chat_history", []) + [user_msg, bot_msg]
+            await save_session(sess)
+            queue_guest_summary(sess.sid, model)
+        else:
+            done["commit_token"] = make_commit_token(
+                sess, question, renderer.answer_markdown(), renderer.sources, model)
+        await emit(sse_event("done", done))
+    except Exception as e:
+        print(f"[ERROR]: {str(e)}", flush=True)
+        metrics.inc("lexibot_request_errors_total", {"route": "/ask_stream"})
+        await emit(sse_event("error", {"error": str(e)}))
+    await send({"type": "http.response.body", "body": b""})
+
+    # Thời gian tới khi stream xong (status đã gửi là 200 kể cả khi lỗi giữa chừng)
+    metrics.inc("lexibot_http_requests_total", {"route": "/ask_stream", "status": 200})
+    metrics.observe("lexibot_http_request_duration_seconds", time.perf_counter() - start, {"route": "/ask_stream"})
+
+ASYNC_ROUTES = {
+    ("POST", "/ask"): ask,
+    ("POST", "/ask_stream"): ask_stream,
+}
+
+async def application(scope, receive, send):
+    if scope["type"] == "http":
+        handler = ASYNC_ROUTES.get((scope["method"], scope["path"]))
+        if handler is not None:
+            return await handler(scope, receive, send)
+    if scope["type"] == "lifespan":
+        # Flask không xử lý lifespan
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # Chỉ báo startup.complete (bắt đầu nhận request) sau khi đã warm-up
+                await asyncio.to_thread(warm_up)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await asyncio.to_thread(persist_queue.close)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    return await flask_asgi(scope, receive, send)
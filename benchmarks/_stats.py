@@ -0,0 +1,7 @@
+"""Hàm thống kê dùng chung cho các benchmark (không phụ thuộc src.* để benchmark nào cũng import được)"""
+
+
+def percentile(values, p):
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[idx]
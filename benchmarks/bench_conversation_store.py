@@ -0,0 +1,116 @@
+"""
+So sánh schema lưu hội thoại cũ (mảng messages nhúng trong document) và mới (collection messages riêng):
+- Sidebar: liệt kê hội thoại của một user (cũ: đọc cả document kèm messages, không có index).
+- Lịch sử: đọc N tin nhắn cuối làm context (cũ: tải cả hội thoại rồi cắt trong Python).
+Cần MongoDB thật (--mongo-uri, nên dùng DB riêng vì benchmark xóa dữ liệu của nó). Không có thì dùng mongomock
+nếu đã cài: chỉ để kiểm tra chạy đúng, mongomock không dùng index nên số đo không phản ánh MongoDB thật.
+Chạy từ thư mục gốc:
+    python -m benchmarks.bench_conversation_store --mongo-uri mongodb://localhost:27017 --conversations 2000
+"""
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+from pymongo import DESCENDING
+from benchmarks._stats import percentile
+from src.conversation_store import (ConversationStore, new_conversation, message_docs,
+                                     CONVERSATION_LIST_LIMIT, HISTORY_FETCH_MESSAGES)
+
+
+def get_database(mongo_uri, db_name):
+    if mongo_uri:
+        from pymongo import MongoClient
+        return MongoClient(mongo_uri)[db_name], "mongodb"
+    try:
+        import mongomock
+    except ImportError:
+        raise SystemExit("Cần --mongo-uri hoặc cài mongomock (pip install mongomock) để chạy benchmark")
+    return mongomock.MongoClient()[db_name], "mongomock"
+
+
+def fake_messages(n, answer_chars):
+    messages = []
+    for i in range(n // 2):
+        messages.append({"role": "user", "content": f"Câu hỏi số {i} về học phí và học bổng?"})
+        messages.append({"role": "assistant", "content": "Trả lời " * (answer_chars // 8), "format": "markdown",
+                         "sources": [{"file": "QD_hocphi.pdf", "page": 1}]})
+    return messages
+
+
+def seed(db, users, conversations, messages_per_chat, answer_chars):
+    """Cùng một dữ liệu ghi theo cả 2 schema: legacy_conversations (cũ) và conversations/messages (mới)"""
+    for name in ("legacy_conversations", "conversations", "messages"):
+        db[name].drop()
+    store = ConversationStore(db)
+    store.ensure_indexes()
+    base = datetime.now() - timedelta(days=365)
+    chat_ids = {}
+    for u in range(users):
+        user_id = f"user{u}"
+        legacy_docs, new_docs, message_batch = [], [], []
+        for c in range(conversations):
+            n = random.randint(2, messages_per_chat) // 2 * 2
+            messages = fake_messages(n, answer_chars)
+            doc = new_conversation(user_id, f"Hội thoại {c}", n)
+            doc["updated_at"] = base + timedelta(minutes=c)
+            legacy_docs.append({k: doc[k] for k in ("user_id", "title", "created_at", "updated_at")}
+                               | {"messages": messages})
+            new_docs.append(doc)
+        db.legacy_conversations.insert_many(legacy_docs)
+        ids = db.conversations.insert_many(new_docs).inserted_ids
+        for chat_id, doc, legacy in zip(ids, new_docs, legacy_docs):
+            message_batch.extend(message_docs(chat_id, legacy["messages"], 0))
+        db.messages.insert_many(message_batch)
+        chat_ids[user_id] = list(zip(ids, (d["_id"] for d in legacy_docs)))
+    return store, chat_ids
+
+
+def measure(fn, repeat):
+    latencies = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - t0) * 1000)
+    return latencies
+
+
+def report(name, latencies):
+    print(f"  {name:<10} p50={percentile(latencies, 50):8.2f}ms  p95={percentile(latencies, 95):8.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark schema lưu hội thoại: nhúng messages vs collection riêng")
+    parser.add_argument("--mongo-uri", help="MongoDB để benchmark (mặc định dùng mongomock trong bộ nhớ)")
+    parser.add_argument("--db-name", default="lexibot_bench")
+    parser.add_argument("--users", type=int, default=3)
+    parser.add_argument("--conversations", type=int, default=2000, help="Số hội thoại mỗi user")
+    parser.add_argument("--messages", type=int, default=60, help="Số tin nhắn tối đa mỗi hội thoại")
+    parser.add_argument("--answer-chars", type=int, default=1500)
+    parser.add_argument("--repeat", type=int, default=30)
+    args = parser.parse_args()
+
+    db, backend = get_database(args.mongo_uri, args.db_name)
+    t0 = time.perf_counter()
+    store, chat_ids = seed(db, args.users, args.conversations, args.messages, args.answer_chars)
+    print(f"[{backend}] {args.users} user x {args.conversations} hội thoại, "
+          f"{db.messages.count_documents({})} tin nhắn (seed {time.perf_counter() - t0:.1f}s)")
+
+    user_id = "user0"
+    print(f"Sidebar ({CONVERSATION_LIST_LIMIT} hội thoại mới nhất của {user_id}):")
+    report("cũ", measure(lambda: list(db.legacy_conversations.find({"user_id": user_id})
+                                      .sort("updated_at", DESCENDING).limit(CONVERSATION_LIST_LIMIT)), args.repeat))
+    report("mới", measure(lambda: store.list_conversations(user_id), args.repeat))
+
+    pairs = chat_ids[user_id]
+    print(f"Lịch sử ({HISTORY_FETCH_MESSAGES} tin nhắn cuối của một hội thoại ngẫu nhiên):")
+    report("cũ", measure(lambda: db.legacy_conversations.find_one(
+        {"_id": random.choice(pairs)[1]})["messages"][-HISTORY_FETCH_MESSAGES:], args.repeat))
+    report("mới", measure(lambda: store.load_history(str(random.choice(pairs)[0])), args.repeat))
+
+    if args.mongo_uri:
+        for name in ("legacy_conversations", "conversations", "messages"):
+            db[name].drop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+So sánh các backend embedding (torch float32, torch-int8, onnx, onnx-int8) trên corpus data/:
+thời gian nạp, RAM, độ trễ encode câu hỏi, tốc độ encode chunk và độ khớp retrieval so với torch float32.
+Mỗi backend chạy trong một tiến trình riêng để đo RAM chính xác.
+
+Chạy từ thư mục gốc:  python -m benchmarks.bench_embedding_backends --backends torch torch-int8 onnx-int8
+"""
+import time
+import argparse
+import statistics
+import multiprocessing as mp
+import numpy as np
+from benchmarks.bench_retriever_backends import QUESTIONS
+from benchmarks._stats import percentile
+
+
+def current_rss_mb():
+    """RSS hiện tại của tiến trình (Linux), fallback về peak RSS"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_backend(backend, texts, questions, batch_size):
+    """Chạy trong tiến trình con: nạp model, encode corpus + câu hỏi"""
+    from src.models import create_embedding_model
+
+    rss_before = current_rss_mb()
+    t0 = time.perf_counter()
+    model = create_embedding_model(backend)
+    load_time = time.perf_counter() - t0
+    client = model._client
+
+    # Làm nóng
+    client.encode(questions[:2], normalize_embeddings=True)
+
+    query_lat = []
+    query_vectors = []
+    for q in questions:
+        t0 = time.perf_counter()
+        query_vectors.append(client.encode([q], normalize_embeddings=True)[0])
+        query_lat.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    corpus = client.encode(texts, batch_size=batch_size, normalize_embeddings=True, convert_to_numpy=True)
+    corpus_time = time.perf_counter() - t0
+
+    return {
+        "backend": backend,
+        "load_time": load_time,
+        "rss_mb": current_rss_mb() - rss_before,
+        "query_lat": query_lat,
+        "corpus_rate": len(texts) / corpus_time if corpus_time > 0 else 0.0,
+        "query_vectors": np.asarray(query_vectors, dtype=np.float32),
+        "corpus": np.asarray(corpus, dtype=np.float32),
+    }
+
+
+def top_k(query_vectors, corpus, k):
+    scores = query_vectors @ corpus.T
+    return [set(np.argpartition(-row, k - 1)[:k].tolist()) for row in scores]
+
+
+def load_corpus_texts():
+    from create_db import load_documents, chunk_document
+    texts = []
+    for doc in load_documents():
+        texts.extend(c.page_content for c in chunk_document(doc))
+    return texts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="So sánh backend embedding trên corpus data/")
+    parser.add_argument("--backends", nargs="+", default=["torch", "torch-int8"],
+                        help="torch | torch-int8 | onnx | onnx-int8 (backend đầu tiên là mốc so sánh)")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    texts = load_corpus_texts()
+    print(f"Corpus: {len(texts)} chunk | {len(QUESTIONS)} câu hỏi | k={args.k}\n")
+
+    ctx = mp.get_context("spawn")
+    results = []
+    for backend in args.backends:
+        with ctx.Pool(1) as pool:
+            try:
+                results.append(pool.apply(run_backend, (backend, texts, QUESTIONS, args.batch_size)))
+            except Exception as e:
+                print(f"[{backend}] lỗi: {e}")
+
+    if not results:
+        return
+    base = results[0]
+    base_top = top_k(base["query_vectors"], base["corpus"], args.k)
+
+    print(f"{'backend':<12}{'load(s)':>9}{'RAM(MB)':>10}{'q p50(ms)':>11}{'q p95(ms)':>11}"
+          f"{'chunk/s':>10}{'cos vs ' + base['backend']:>16}{'top-' + str(args.k) + ' khớp':>12}")
+    for r in results:
+        ms = [x * 1000 for x in r["query_lat"]]
+        # Độ giống vector cùng một chunk giữa 2 backend và độ trùng top-k
+        cos = float(np.mean(np.sum(r["corpus"] * base["corpus"], axis=1)))
+        overlap = statistics.mean(
+            len(a & b) / args.k for a, b in zip(top_k(r["query_vectors"], r["corpus"], args.k), base_top)
+        )
+        print(f"{r['backend']:<12}{r['load_time']:>9.1f}{r['rss_mb']:>10.0f}{percentile(ms, 50):>11.1f}"
+              f"{percentile(ms, 95):>11.1f}{r['corpus_rate']:>10.1f}{cos:>16.4f}{overlap * 100:>11.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Kiểm tra router LLM (src/llm_router.py) với 2 stub LLM cục bộ: groq = provider chính, gemini = dự phòng.
+- healthy: cả 2 bình thường.
+- slow:    provider chính có token đầu tiên rất chậm -> so sánh không hedge và có hedge.
+- failing: provider chính trả lỗi 503 -> failover, circuit breaker mở và bỏ qua provider chính.
+Chạy từ thư mục gốc:
+    python -m benchmarks.bench_llm_router --requests 40 --concurrency 4
+"""
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.messages import HumanMessage
+from benchmarks.stub_llm_server import start_stub_server
+from benchmarks._stats import percentile
+
+PRIMARY, BACKUP = "groq", "gemini"
+
+
+def run(router, n_requests, concurrency):
+    """Gọi router.stream song song -> (list thời gian tới token đầu tiên, số lỗi)"""
+    messages = [HumanMessage("Điều kiện xét học bổng khuyến khích học tập là gì?")]
+
+    def one(_):
+        t0 = time.perf_counter()
+        ttft = None
+        try:
+            for chunk in router.stream(PRIMARY, messages):
+                if ttft is None and chunk.content:
+                    ttft = time.perf_counter() - t0
+        except Exception:
+            return None
+        return ttft
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(n_requests)))
+    return [r for r in results if r is not None], results.count(None)
+
+
+def scenario(name, router, stubs, n_requests, concurrency):
+    before = [s.requests for s in stubs]
+    t0 = time.perf_counter()
+    ttfts, errors = run(router, n_requests, concurrency)
+    elapsed = time.perf_counter() - t0
+    sent = [s.requests - b for s, b in zip(stubs, before)]
+    p50 = percentile(ttfts, 50) * 1000 if ttfts else float("nan")
+    p95 = percentile(ttfts, 95) * 1000 if ttfts else float("nan")
+    print(f"  {name:<18} TTFT p50={p50:7.0f}ms p95={p95:7.0f}ms  lỗi={errors:<3} "
+          f"request {PRIMARY}={sent[0]:<4} {BACKUP}={sent[1]:<4} breaker={router.stats(PRIMARY).state:<9} "
+          f"({elapsed:.1f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark router LLM: failover, circuit breaker, hedge")
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.3, help="Giây tới token đầu tiên khi bình thường")
+    parser.add_argument("--slow-latency", type=float, default=4.0, help="Giây tới token đầu tiên khi provider chậm")
+    parser.add_argument("--hedge-delay", type=float, default=1.0, help="Chờ bao lâu trước khi hedge khi chưa đủ số liệu")
+    args = parser.parse_args()
+
+    primary = start_stub_server(latency=args.latency, token_rate=200, answer_tokens=40)
+    backup = start_stub_server(latency=args.latency, token_rate=200, answer_tokens=40)
+    # Cấu hình provider phải có trước khi import src.models
+    os.environ.update({"GROQ_BASE_URL": primary.base_url, "GROQ_API_KEY": "stub",
+                       "GEMINI_BASE_URL": backup.base_url, "GEMINI_API_KEY_2": "stub",
+                       "LLM_HEDGE_DEFAULT_DELAY": str(args.hedge_delay), "LLM_MAX_RETRIES": "0"})
+    from src.llm_router import LLMRouter
+
+    stubs = (primary, backup)
+    fallbacks = {PRIMARY: [BACKUP]}
+    print(f"{args.requests} request, {args.concurrency} đồng thời; {PRIMARY} -> {primary.base_url}, "
+          f"{BACKUP} -> {backup.base_url}")
+
+    scenario("healthy", LLMRouter(fallbacks, hedge=False), stubs, args.requests, args.concurrency)
+
+    primary.latency = args.slow_latency
+    scenario("slow, không hedge", LLMRouter(fallbacks, hedge=False), stubs, args.requests, args.concurrency)
+    scenario("slow, hedge", LLMRouter(fallbacks, hedge=True), stubs, args.requests, args.concurrency)
+
+    primary.latency = args.latency
+    primary.error_rate = 1.0
+    scenario("failing", LLMRouter(fallbacks, hedge=False), stubs, args.requests, args.concurrency)
+
+    primary.shutdown()
+    backup.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Benchmark chất lượng + tốc độ retrieval offline (không gọi LLM), chạy trên chroma_db hiện có:
+- Bộ câu hỏi chuẩn (gold_retrieval.jsonl): mỗi câu hỏi gắn với file + Điều/mục cần tìm thấy.
+- Đo recall@k, MRR, độ trễ truy vấn p50/p95/p99 của từng cấu hình retriever, in cạnh nhau.
+- Tùy chọn --build: đo thời gian build index từ đầu (chunking, embedding, ghi DB, xuất index phẳng)
+  vào thư mục tạm, không đụng tới chroma_db đang dùng.
+
+Độ trễ gồm cả bước embed câu hỏi; đặt EMBED_CACHE=0 để không bị cache embedding làm sai lệch.
+Chạy từ thư mục gốc (sau create_db.py):
+    python -m benchmarks.bench_retrieval --configs chroma flat bm25 hybrid --k 1 3 5 10
+"""
+import os
+import re
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from benchmarks._stats import percentile
+
+GOLD_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gold_retrieval.jsonl")
+
+
+# =========================
+# CẤU HÌNH RETRIEVER
+# =========================
+def _backend_retriever(backend, routing=False):
+    def factory(k):
+        from src.rag_chain import load_retriever
+        return load_retriever(backend, k=k, routing=routing)
+    return factory
+
+
+def _reranked_retriever(backend, kind):
+    """Retriever lấy rộng RERANK_CANDIDATES chunk + reranker giữ lại k chunk (giống build_rag_chain)"""
+    def factory(k):
+        from langchain_core.runnables import RunnableLambda
+        from src.rag_chain import load_retriever
+        from src.reranker import create_reranker, RERANK_CANDIDATES
+        retriever = load_retriever(backend, k=max(k, RERANK_CANDIDATES), routing=False)
+        reranker = create_reranker(kind, top_n=k)
+        reranker.warm_up()
+        return RunnableLambda(lambda q: reranker.rerank(q, retriever.invoke(q)))
+    return factory
+
+
+# Tên cấu hình -> hàm tạo retriever (nhận k, trả về đối tượng có .invoke(question))
+RETRIEVER_CONFIGS = {
+    "chroma": _backend_retriever("chroma"),
+    "flat": _backend_retriever("flat"),
+    "bm25": _backend_retriever("bm25"),
+    "hybrid": _backend_retriever("hybrid"),
+    "chroma-routed": _backend_retriever("chroma", routing=True),
+    "flat-routed": _backend_retriever("flat", routing=True),
+    "bm25-routed": _backend_retriever("bm25", routing=True),
+    "hybrid-routed": _backend_retriever("hybrid", routing=True),
+    "flat+mmr": _reranked_retriever("flat", "mmr"),
+    "hybrid+mmr": _reranked_retriever("hybrid", "mmr"),
+    "hybrid+ce": _reranked_retriever("hybrid", "cross-encoder"),
+}
+
+
+# =========================
+# BỘ CÂU HỎI CHUẨN
+# =========================
+def load_gold(path=GOLD_PATH):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _pattern_matches(pattern, section):
+    # "Điều 1" không được khớp "Điều 10"
+    if re.match(r"Điều \d+$", pattern):
+        return re.search(re.escape(pattern) + r"(?!\d)", section) is not None
+    return pattern.lower() in section.lower()
+
+
+def is_relevant(doc, relevant):
+    """Chunk khớp một mục gold nếu đúng file và section chứa mọi chuỗi trong mục đó"""
+    file_name = os.path.basename(doc.metadata.get("source", ""))
+    section = doc.metadata.get("section", "") or ""
+    return any(
+        file_name == r["file"] and all(_pattern_matches(p, section) for p in r["section"])
+        for r in relevant
+    )
+
+
+def first_relevant_rank(docs, relevant):
+    for rank, doc in enumerate(docs, start=1):
+        if is_relevant(doc, relevant):
+            return rank
+    return None
+
+
+# =========================
+# ĐÁNH GIÁ
+# =========================
+def evaluate(name, gold, ks, repeat):
+    max_k = max(ks)
+    t0 = time.perf_counter()
+    retriever = RETRIEVER_CONFIGS[name](max_k)
+    retriever.invoke(gold[0]["question"])  # làm nóng (nạp model, mở DB)
+    startup = time.perf_counter() - t0
+
+    latencies = []
+    ranks = []
+    for item in gold:
+        docs = None
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            docs = retriever.invoke(item["question"])
+            latencies.append(time.perf_counter() - t0)
+        ranks.append(first_relevant_rank(docs[:max_k], item["relevant"]))
+
+    n = len(gold)
+    ms = [x * 1000 for x in latencies]
+    return {
+        "name": name,
+        "startup": startup,
+        "recall": {k: sum(1 for r in ranks if r is not None and r <= k) / n for k in ks},
+        "mrr": sum(1 / r for r in ranks if r is not None) / n,
+        "p50": percentile(ms, 50),
+        "p95": percentile(ms, 95),
+        "p99": percentile(ms, 99),
+        "misses": [item["question"] for item, r in zip(gold, ranks) if r is None],
+    }
+
+
+def time_index_build(batch_size, num_workers):
+    """Build lại toàn bộ index vào thư mục tạm, trả về thời gian từng bước (giây)"""
+    from langchain_community.vectorstores import Chroma
+    from create_db import load_documents, chunk_document, assign_chunk_ids
+    from src.embedding_engine import EmbeddingEngine, upsert_in_batches
+    from src.flat_index import export_flat_index
+    from src.lexical_index import export_lexical_index
+    from src.models import get_embedding_model, get_sentence_transformer
+
+    get_sentence_transformer()  # thời gian nạp model không tính vào build
+    timings = {}
+    tmp_dir = tempfile.mkdtemp(prefix="lexibot_bench_")
+    try:
+        t0 = time.perf_counter()
+        chunks, ids = [], []
+        for doc in load_documents():
+            doc_chunks = chunk_document(doc)
+            chunks.extend(doc_chunks)
+            ids.extend(assign_chunk_ids(doc_chunks, doc.metadata.get("source", "")))
+        timings["chunking"] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        engine = EmbeddingEngine(batch_size=batch_size, num_workers=num_workers)
+        vectors = engine.embed_texts([c.page_content for c in chunks])
+        timings["embedding"] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        vector_db = Chroma(persist_directory=tmp_dir, embedding_function=get_embedding_model())
+        upsert_in_batches(vector_db, ids, chunks, vectors)
+        timings["chroma_insert"] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        export_flat_index(vector_db, tmp_dir)
+        timings["flat_export"] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        export_lexical_index(vector_db, tmp_dir)
+        timings["bm25_export"] = time.perf_counter() - t0
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    timings["total"] = sum(timings.values())
+    return len(chunks), timings
+
+
+def print_results(results, ks):
+    header = f"{'config':<12}{'startup(s)':>11}"
+    header += "".join(f"{'R@' + str(k):>8}" for k in ks)
+    header += f"{'MRR':>8}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}"
+    print(header)
+    for r in results:
+        line = f"{r['name']:<12}{r['startup']:>11.2f}"
+        line += "".join(f"{r['recall'][k]:>8.3f}" for k in ks)
+        line += f"{r['mrr']:>8.3f}{r['p50']:>10.2f}{r['p95']:>10.2f}{r['p99']:>10.2f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark retrieval offline: recall@k, MRR, độ trễ")
+    parser.add_argument("--configs", nargs="+", default=["chroma", "flat", "bm25", "hybrid"],
+                        help="Các cấu hình cần so sánh: " + ", ".join(RETRIEVER_CONFIGS))
+    parser.add_argument("--k", nargs="+", type=int, default=[1, 3, 5, 10])
+    parser.add_argument("--repeat", type=int, default=5, help="Số lần lặp mỗi câu hỏi khi đo độ trễ")
+    parser.add_argument("--gold", default=GOLD_PATH)
+    parser.add_argument("--build", action="store_true", help="Đo thêm thời gian build index từ đầu")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--show-misses", action="store_true", help="In các câu hỏi không tìm thấy trong top-k")
+    args = parser.parse_args()
+
+    unknown = [c for c in args.configs if c not in RETRIEVER_CONFIGS]
+    if unknown:
+        parser.error(f"Cấu hình không tồn tại: {', '.join(unknown)}")
+
+    ks = sorted(set(args.k))
+    gold = load_gold(args.gold)
+    print(f"{len(gold)} câu hỏi chuẩn | k={ks} | lặp {args.repeat} lần\n")
+
+    if args.build:
+        n_chunks, timings = time_index_build(args.batch_size, args.workers)
+        print(f"Build index ({n_chunks} chunk): " +
+              " | ".join(f"{stage}={seconds:.2f}s" for stage, seconds in timings.items()) + "\n")
+
+    results = [evaluate(name, gold, ks, args.repeat) for name in args.configs]
+    print_results(results, ks)
+
+    if args.show_misses:
+        for r in results:
+            for q in r["misses"]:
+                print(f"[{r['name']}] không tìm thấy: {q}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+So sánh backend retriever Chroma và index phẳng NumPy.
+Chạy từ thư mục gốc (sau create_db.py):  python -m benchmarks.bench_retriever_backends
+"""
+import time
+import argparse
+import statistics
+from src.models import get_embedding_model
+from src.rag_chain import DB_PATH, load_vector_db
+from src.flat_index import FlatVectorIndex
+from benchmarks._stats import percentile
+
+QUESTIONS = [
+    "Học phí một tín chỉ năm học 2025-2026 là bao nhiêu?",
+    "Điều kiện để được xét học bổng khuyến khích học tập?",
+    "Sinh viên bị cảnh báo học tập khi nào?",
+    "Thời hạn nộp học phí học kỳ là khi nào?",
+    "Điểm rèn luyện được đánh giá như thế nào?",
+    "Quy định về đăng ký học phần",
+    "Điều kiện tốt nghiệp đại học",
+    "Sinh viên được nghỉ học tạm thời trong trường hợp nào?",
+    "Cách tính điểm trung bình tích lũy CPA",
+    "Chế độ miễn giảm học phí cho sinh viên",
+]
+
+
+def report(name, startup, latencies):
+    ms = [x * 1000 for x in latencies]
+    print(f"{name:<8} startup={startup * 1000:8.1f}ms  "
+          f"mean={statistics.mean(ms):7.3f}ms  p50={percentile(ms, 50):7.3f}ms  p95={percentile(ms, 95):7.3f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Chroma vs flat NumPy index")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=20, help="Số lần lặp mỗi câu hỏi")
+    args = parser.parse_args()
+
+    # Tải model trước để không tính vào thời gian khởi động backend
+    embedding = get_embedding_model()
+    query_vectors = [embedding.embed_query(q) for q in QUESTIONS]
+
+    t0 = time.perf_counter()
+    chroma = load_vector_db()
+    chroma._collection.count()
+    chroma_startup = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    flat = FlatVectorIndex(DB_PATH)
+    flat_startup = time.perf_counter() - t0
+
+    # Đo riêng phần tìm kiếm (vector câu hỏi đã có sẵn)
+    chroma_lat, flat_lat = [], []
+    overlap = []
+    for _ in range(args.repeat):
+        for vec in query_vectors:
+            t0 = time.perf_counter()
+            chroma_docs = chroma.similarity_search_by_vector(vec, k=args.k)
+            chroma_lat.append(time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            flat_hits = flat.search(vec, k=args.k)
+            flat_lat.append(time.perf_counter() - t0)
+
+            chroma_set = {d.page_content for d in chroma_docs}
+            flat_set = {flat.documents[row] for row, _ in flat_hits}
+            overlap.append(len(chroma_set & flat_set) / max(1, len(chroma_set)))
+
+    print(f"Số vector: {len(flat)} | k={args.k} | {len(chroma_lat)} truy vấn mỗi backend")
+    report("chroma", chroma_startup, chroma_lat)
+    report("flat", flat_startup, flat_lat)
+    print(f"Độ trùng top-{args.k} giữa 2 backend: {statistics.mean(overlap) * 100:.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+Load test end-to-end cho /ask với LLM giả lập (stub_llm_server), không gọi Gemini/Groq thật.
+- Tự chạy stub LLM, rồi chạy server (gunicorn hoặc uvicorn) với GROQ_BASE_URL trỏ vào stub.
+- Mỗi "người dùng ảo" giữ cookie session riêng: trộn câu hỏi mới và câu hỏi nối tiếp (có lịch sử).
+- Quét số worker x mức đồng thời, báo cáo throughput, độ trễ p50/p95/p99 và thời gian từng bước
+  (đọc từ header Server-Timing).
+
+Chạy từ thư mục gốc (sau create_db.py):
+    python -m benchmarks.load_test --server gunicorn --workers 1 2 --concurrency 1 8 32 --requests 100
+Hoặc đo một server đang chạy sẵn (đã trỏ GROQ_BASE_URL vào stub):  --target http://127.0.0.1:5000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+import subprocess
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from benchmarks.bench_retriever_backends import QUESTIONS
+from benchmarks._stats import percentile
+from benchmarks.stub_llm_server import start_stub_server
+
+# Câu hỏi nối tiếp: phụ thuộc lịch sử, buộc chain phải viết lại câu hỏi
+FOLLOWUPS = [
+    "Thế còn hệ thạc sĩ thì sao?",
+    "Mức đó áp dụng cho cả sinh viên năm nhất không?",
+    "Nếu không đạt thì bị xử lý thế nào?",
+    "Hạn chót là khi nào?",
+    "Cần chuẩn bị hồ sơ gì?",
+    "Giải thích rõ hơn ý thứ hai được không?",
+]
+
+
+# =========================
+# SERVER
+# =========================
+def start_app_server(kind, workers, port, threads, env):
+    if kind == "gunicorn":
+        cmd = [sys.executable, "-m", "gunicorn", "app:app", "-c", "gunicorn.conf.py",
+               "--workers", str(workers), "--threads", str(threads), "--bind", f"127.0.0.1:{port}"]
+    elif kind == "uvicorn":
+        cmd = [sys.executable, "-m", "uvicorn", "asgi:application", "--workers", str(workers),
+               "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    else:
+        raise ValueError(f"Server không hợp lệ: {kind}")
+    return subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+
+def wait_until_ready(target, proc=None, timeout=300):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"Server đã dừng (exit code {proc.returncode})")
+        try:
+            if requests.get(f"{target}/health", timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Server không sẵn sàng sau {timeout}s")
+
+
+def stop_app_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+# =========================
+# NGƯỜI DÙNG ẢO
+# =========================
+def parse_server_timing(header):
+    """ "rewrite;dur=12.3, retrieve;dur=4.0" -> {"rewrite": 12.3, "retrieve": 4.0} (ms)"""
+    stages = {}
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if params.startswith("dur="):
+            try:
+                stages[name] = float(params[4:])
+            except ValueError:
+                pass
+    return stages
+
+
+class VirtualUser:
+    def __init__(self, target, model, followup_ratio, rng):
+        self.target = target
+        self.model = model
+        self.followup_ratio = followup_ratio
+        self.rng = rng
+        self.session = None
+        self.turns = 0
+
+    def next_question(self):
+        if self.session is not None and self.turns and self.rng.random() < self.followup_ratio:
+            return "followup", self.rng.choice(FOLLOWUPS)
+        # Câu hỏi mới = hội thoại mới (cookie mới, lịch sử rỗng)
+        if self.session is not None:
+            self.session.close()
+        self.session = requests.Session()
+        self.turns = 0
+        return "new", self.rng.choice(QUESTIONS)
+
+    def ask(self):
+        kind, question = self.next_question()
+        start = time.perf_counter()
+        try:
+            resp = self.session.post(f"{self.target}/ask", json={"question": question, "model": self.model},
+                                     timeout=300)
+            ok = resp.status_code == 200
+            stages = parse_server_timing(resp.headers.get("Server-Timing"))
+        except requests.RequestException:
+            ok, stages = False, {}
+        if ok:
+            self.turns += 1
+        return {"kind": kind, "ok": ok, "latency": time.perf_counter() - start, "stages": stages}
+
+
+def run_level(target, model, concurrency, n_requests, followup_ratio, seed):
+    """Chạy n_requests request với `concurrency` người dùng song song"""
+    results = []
+    lock = threading.Lock()
+    remaining = [n_requests]
+
+    def worker(idx):
+        user = VirtualUser(target, model, followup_ratio, random.Random(seed + idx))
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            r = user.ask()
+            with lock:
+                results.append(r)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return results, time.perf_counter() - start
+
+
+# =========================
+# BÁO CÁO
+# =========================
+def summarize(results, wall):
+    ok = [r for r in results if r["ok"]]
+    ms = [r["latency"] * 1000 for r in ok] or [0.0]
+    summary = {
+        "rps": len(ok) / wall if wall > 0 else 0.0,
+        "errors": len(results) - len(ok),
+        "p50": percentile(ms, 50), "p95": percentile(ms, 95), "p99": percentile(ms, 99),
+        "stages": {},
+    }
+    for kind in ("new", "followup"):
+        kind_ms = [r["latency"] * 1000 for r in ok if r["kind"] == kind]
+        summary[kind] = percentile(kind_ms, 50) if kind_ms else None
+
+    names = []
+    for r in ok:
+        names.extend(n for n in r["stages"] if n not in names)
+    for name in names:
+        values = [r["stages"][name] for r in ok if name in r["stages"]]
+        summary["stages"][name] = (statistics.mean(values), percentile(values, 95))
+    return summary
+
+
+def print_row(workers, concurrency, s):
+    fmt = lambda v: f"{v:>10.0f}" if v is not None else f"{'-':>10}"
+    print(f"{workers:>8}{concurrency:>8}{s['rps']:>9.2f}{s['p50']:>10.0f}{s['p95']:>10.0f}{s['p99']:>10.0f}"
+          f"{fmt(s['new'])}{fmt(s['followup'])}{s['errors']:>8}")
+
+
+def print_stages(rows):
+    print("\nThời gian từng bước (ms, mean / p95) theo Server-Timing:")
+    for workers, concurrency, s in rows:
+        parts = [f"{name}={mean:.0f}/{p95:.0f}" for name, (mean, p95) in s["stages"].items()]
+        print(f"  workers={workers} c={concurrency}: " + (" | ".join(parts) or "(không có header)"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /ask với stub LLM")
+    parser.add_argument("--server", choices=["gunicorn", "uvicorn"], default="gunicorn")
+    parser.add_argument("--target", help="URL server đang chạy sẵn (bỏ qua việc tự chạy server)")
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 2])
+    parser.add_argument("--threads", type=int, default=8, help="Số thread mỗi worker gunicorn")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=60, help="Số request mỗi mức đồng thời")
+    parser.add_argument("--followup-ratio", type=float, default=0.5, help="Tỉ lệ câu hỏi nối tiếp")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--llm-url", help="Dùng LLM tương thích OpenAI có sẵn thay vì stub tích hợp")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Giây tới token đầu tiên của stub")
+    parser.add_argument("--llm-token-rate", type=float, default=50.0, help="Token/giây của stub")
+    parser.add_argument("--answer-tokens", type=int, default=120)
+    parser.add_argument("--answer-cache", action="store_true",
+                        help="Giữ cache câu trả lời (mặc định tắt để mọi request đều đi hết pipeline)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    stub = None
+    llm_url = args.llm_url
+    if llm_url is None and args.target is None:
+        stub = start_stub_server(latency=args.llm_latency, token_rate=args.llm_token_rate,
+                                 answer_tokens=args.answer_tokens)
+        llm_url = stub.base_url
+        print(f"Stub LLM: {llm_url} (latency={args.llm_latency}s, {args.llm_token_rate} token/s)")
+
+    env = dict(os.environ, GROQ_BASE_URL=llm_url or "", GROQ_API_KEY=os.getenv("GROQ_API_KEY", "stub"),
+               WARMUP_PROVIDERS="groq", GUNICORN_THREADS=str(args.threads))
+    if not args.answer_cache:
+        env["ANSWER_CACHE"] = "0"
+
+    worker_counts = [None] if args.target else args.workers
+    rows = []
+    print(f"\n{'workers':>8}{'conc':>8}{'req/s':>9}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}"
+          f"{'new p50':>10}{'fup p50':>10}{'errors':>8}")
+    try:
+        for workers in worker_counts:
+            proc = None
+            target = args.target
+            if target is None:
+                target = f"http://127.0.0.1:{args.port}"
+                proc = start_app_server(args.server, workers, args.port, args.threads, env)
+            try:
+                wait_until_ready(target, proc)
+                run_level(target, "groq", 1, 2, 0.0, args.seed)  # làm nóng
+                for concurrency in args.concurrency:
+                    results, wall = run_level(target, "groq", concurrency, args.requests,
+                                              args.followup_ratio, args.seed)
+                    summary = summarize(results, wall)
+                    label = workers if workers is not None else "-"
+                    print_row(label, concurrency, summary)
+                    rows.append((label, concurrency, summary))
+            finally:
+                if proc is not None:
+                    stop_app_server(proc)
+    finally:
+        if stub is not None:
+            print(f"\nStub LLM đã nhận {stub.requests} request")
+            stub.shutdown()
+
+    print_stages(rows)
+
+
+if __name__ == "__main__":
+    main()
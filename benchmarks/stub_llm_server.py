@@ -0,0 +1,187 @@
+"""
+Server LLM giả lập API OpenAI (/v1/chat/completions), dùng cho load test không tốn quota Gemini/Groq.
+- latency: thời gian chờ trước token đầu tiên (giây), token_rate: số token/giây sinh ra sau đó.
+- Hỗ trợ cả stream (SSE) lẫn không stream.
+- error_rate: tỉ lệ request trả lỗi 503 (thử failover/circuit breaker của src/llm_router.py).
+- Prompt viết lại câu hỏi -> trả lại nguyên câu hỏi; prompt trả lời -> đoạn Markdown dài answer_tokens từ.
+
+Chạy riêng:  python -m benchmarks.stub_llm_server --port 8900 --latency 0.8 --token-rate 80
+Rồi đặt GROQ_BASE_URL=http://127.0.0.1:8900/v1 GROQ_API_KEY=stub và dùng model "groq"
+(stub thứ hai cho provider gemini: GEMINI_BASE_URL + GEMINI_API_KEY_2).
+"""
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER_TEXT = (
+    "Theo **quy chế đào tạo**, sinh viên cần lưu ý các điểm sau:\n\n"
+    "- Đăng ký học phần đúng thời hạn trên hệ thống.\n"
+    "- Hoàn thành học phí theo thông báo của Nhà trường.\n"
+    "- Theo dõi kết quả học tập và điểm rèn luyện mỗi học kỳ.\n\n"
+    "Nếu có vướng mắc, bạn liên hệ Phòng Đào tạo hoặc Ban CTSV để được hỗ trợ."
+)
+SOURCE_LINE = "\n\n[Nguồn: quychedaotao_2025.txt]"
+
+
+def build_answer(n_tokens):
+    words = ANSWER_TEXT.split(" ")
+    out = [words[i % len(words)] for i in range(max(1, n_tokens))]
+    return " ".join(out) + SOURCE_LINE
+
+
+def split_tokens(text):
+    """Chia câu trả lời thành các "token" (từ kèm khoảng trắng phía trước)"""
+    words = text.split(" ")
+    return [words[0]] + [" " + w for w in words[1:]]
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.5, token_rate=50.0, answer_tokens=120, jitter=0.2, error_rate=0.0):
+        super().__init__(address, StubLLMHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.token_rate = token_rate
+        self.answer_tokens = answer_tokens
+        self.jitter = jitter
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # Worker phía client bị tắt giữa chừng -> không in traceback
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def reply_for(self, messages):
+        system = " ".join(m.get("content", "") for m in messages if m.get("role") == "system")
+        if "Viết lại câu hỏi" in system:
+            users = [m.get("content", "") for m in messages if m.get("role") == "user"]
+            return users[-1] if users else ""
+        return build_answer(self.answer_tokens)
+
+    def first_token_delay(self):
+        return max(0.0, self.latency * (1 + random.uniform(-self.jitter, self.jitter)))
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            return self._send_json(200, {"object": "list", "data": [{"id": "stub", "object": "model"}]})
+        self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            return self._send_json(404, {"error": {"message": "not found"}})
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+
+        server = self.server
+        with server._lock:
+            server.requests += 1
+        if random.random() < server.error_rate:
+            return self._send_json(503, {"error": {"message": "stub overloaded", "type": "server_error"}})
+        text = server.reply_for(body.get("messages", []))
+        tokens = split_tokens(text)
+        model = body.get("model", "stub")
+        time.sleep(server.first_token_delay())
+
+        if body.get("stream"):
+            self._stream(tokens, model)
+        else:
+            time.sleep(len(tokens) / server.token_rate)
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": text}}],
+                "usage": {"prompt_tokens": length // 4, "completion_tokens": len(tokens),
+                          "total_tokens": length // 4 + len(tokens)},
+            })
+
+    def _send_json(self, status, data):
+        payload = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream(self, tokens, model):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+        delay = 1 / self.server.token_rate
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(delay)
+            delta = {"role": "assistant", "content": token} if i == 0 else {"content": token}
+            self._write_event(chunk_id, model, delta, None)
+        self._write_event(chunk_id, model, {}, "stop")
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_event(self, chunk_id, model, delta, finish_reason):
+        event = {
+            "id": chunk_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+
+def start_stub_server(host="127.0.0.1", port=0, **kwargs):
+    """Chạy server trong thread nền, trả về đối tượng server (server.base_url, server.shutdown())"""
+    server = StubLLMServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub LLM tương thích OpenAI cho load test")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.5, help="Giây chờ trước token đầu tiên")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="Token/giây")
+    parser.add_argument("--answer-tokens", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Tỉ lệ request trả lỗi 503")
+    args = parser.parse_args()
+
+    server = StubLLMServer((args.host, args.port), latency=args.latency, token_rate=args.token_rate,
+                           answer_tokens=args.answer_tokens, error_rate=args.error_rate)
+    print(f"Stub LLM đang chạy tại {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
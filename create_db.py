@@ -1,68 +1,239 @@
 import os
 import shutil
 import re
+import json
+import hashlib
+import argparse
+import time
 from langchain_community.document_loaders import DirectoryLoader, TextLoader
 from langchain_community.vectorstores import Chroma
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from src.models import get_embedding_model
+from src.models import get_embedding_model, embedding_model_id
+from src.flat_index import export_flat_index, get_flat_index_dir
+from src.xref_index import export_xref_index
+from src.lexical_index import export_lexical_index, get_lexical_index_dir
+from src.doc_router import get_doc_category
+from src.embedding_cache import get_embedding_cache, EMBED_CACHE_ENABLED
+from src.embedding_engine import EmbeddingEngine, upsert_in_batches, EMBED_BATCH_SIZE, EMBED_WORKERS
 
 
 DATA_PATH = "./data"
 DB_PATH = "./chroma_db"
 MAX_CHUNK_SIZE = 1500  # Kích thước tối đa của 1 chunk (ký tự)
+MANIFEST_PATH = os.path.join(DB_PATH, "manifest.json")
+MANIFEST_VERSION = 3  # 2: metadata có chunk_index, 3: metadata có category
 
-def create_vector_db():
+def create_vector_db(full_rebuild=False, batch_size=EMBED_BATCH_SIZE, num_workers=EMBED_WORKERS):
     print("BẮT ĐẦU TẠO VECTOR DATABASE")
 
-    # Dọn dẹp DB cũ
-    if os.path.exists(DB_PATH):
-        shutil.rmtree(DB_PATH)
-        print(f"Đã xóa database cũ tại {DB_PATH}")
-
     # Load tài liệu
     if not os.path.exists(DATA_PATH):
         print(f"Thư mục {DATA_PATH} không tồn tại!")
         return
 
-    loader = DirectoryLoader(DATA_PATH, glob="**/*.txt", loader_cls=TextLoader, loader_kwargs={"encoding": "utf-8"})
-    raw_documents = loader.load()
+    manifest = None if full_rebuild else load_manifest()
+    if manifest is not None and not manifest_compatible(manifest):
+        print("Manifest cũ không khớp cấu hình chunking/embedding -> build lại toàn bộ")
+        manifest = None
+
+    # Không có manifest hợp lệ -> không biết id chunk cũ, phải dọn DB cũ
+    if manifest is None:
+        if os.path.exists(DB_PATH):
+            shutil.rmtree(DB_PATH)
+            print(f"Đã xóa database cũ tại {DB_PATH}")
+        manifest = new_manifest()
+    else:
+        print(f"Chế độ incremental: đã có manifest với {len(manifest['files'])} file")
+
+    raw_documents = load_documents()
     print(f"Đã tải {len(raw_documents)} file tài liệu")
 
-    # Xử lý & Chunking
-    all_chunks = []
-    
+    # Xử lý & Chunking (chỉ với file mới/thay đổi)
+    old_files = manifest["files"]
+    new_files = {}
+    chunks_to_add = []
+    ids_to_add = []
+    ids_to_delete = []
+    ids_to_update = []
+    metadatas_to_update = []
+    stats = {"files_unchanged": 0, "files_changed": 0, "files_removed": 0,
+             "chunks_skipped": 0, "chunks_embedded": 0, "chunks_deleted": 0}
+
     for doc in raw_documents:
-        file_name = os.path.basename(doc.metadata.get("source", ""))
-        content = doc.page_content
-        
-        # Phân loại tài liệu để áp dụng chiến thuật cắt
-        if is_legal_document(file_name):
-            print(f"Xử lý Quy chế: {file_name}")
-            chunks = split_legal_document(content, doc.metadata)
-        else:
-            print(f"Xử lý Sổ tay/Markdown: {file_name}")
-            chunks = split_markdown_document(content, doc.metadata)
-            
-        all_chunks.extend(chunks)
+        source = doc.metadata.get("source", "")
+        file_hash = hash_text(doc.page_content)
+
+        old_entry = old_files.get(source)
+        if old_entry and old_entry["hash"] == file_hash:
+            # File không đổi -> giữ nguyên toàn bộ chunk
+            new_files[source] = old_entry
+            stats["files_unchanged"] += 1
+            stats["chunks_skipped"] += len(old_entry["chunks"])
+            continue
+
+        chunks = chunk_document(doc)
+        chunk_ids = assign_chunk_ids(chunks, source)
+        old_ids = set(old_entry["chunks"]) if old_entry else set()
+
+        # Chỉ embed chunk có nội dung mới, chunk trùng hash giữ nguyên trong DB (chỉ cập nhật metadata vị trí)
+        for chunk, cid in zip(chunks, chunk_ids):
+            if cid in old_ids:
+                stats["chunks_skipped"] += 1
+                ids_to_update.append(cid)
+                metadatas_to_update.append(chunk.metadata)
+            else:
+                chunks_to_add.append(chunk)
+                ids_to_add.append(cid)
+
+        orphans = old_ids - set(chunk_ids)
+        ids_to_delete.extend(orphans)
+
+        new_files[source] = {"hash": file_hash, "chunks": chunk_ids}
+        stats["files_changed"] += 1
+
+    # File đã bị xóa khỏi thư mục data -> xóa hết chunk của nó
+    for source, entry in old_files.items():
+        if source not in new_files:
+            print(f"File đã bị xóa: {os.path.basename(source)}")
+            ids_to_delete.extend(entry["chunks"])
+            stats["files_removed"] += 1
+
+    stats["chunks_embedded"] = len(chunks_to_add)
+    stats["chunks_deleted"] = len(ids_to_delete)
+    print(f"Tổng số chunk cần embed: {len(chunks_to_add)}")
 
-    print(f"Tổng số chunk tạo ra: {len(all_chunks)}")
-    
     # In 3 chunk đầu
-    print_debug_chunks(all_chunks)
+    print_debug_chunks(chunks_to_add)
+
+    # Index dẫn chiếu Điều/khoản: build lại từ toàn bộ văn bản quy chế (chỉ cắt chunk, rất nhanh)
+    legal_chunks = []
+    for doc in raw_documents:
+        if is_legal_document(os.path.basename(doc.metadata.get("source", ""))):
+            legal_chunks.extend(chunk_document(doc, verbose=False))
+    export_xref_index(legal_chunks, DB_PATH)
+
+    flat_index_ready = os.path.exists(get_flat_index_dir(DB_PATH)) and os.path.exists(get_lexical_index_dir(DB_PATH))
+    if not chunks_to_add and not ids_to_delete and os.path.exists(DB_PATH) and flat_index_ready:
+        print("Không có thay đổi nào, bỏ qua bước embedding.")
+        print_incremental_report(stats)
+        return
 
     # Lưu vào ChromaDB
-    print("\nĐang mã hóa (Embedding) và lưu vào DB...")
+    print("\nĐang mã hóa (Embedding) và cập nhật DB...")
+    start = time.perf_counter()
     embedding_model = get_embedding_model()
-    vector_db = Chroma.from_documents(
-        documents=all_chunks,
-        embedding=embedding_model,
-        persist_directory=DB_PATH
+    embedding_cache = get_embedding_cache() if EMBED_CACHE_ENABLED else None
+    vector_db = Chroma(
+        persist_directory=DB_PATH,
+        embedding_function=embedding_model
     )
+    if ids_to_delete:
+        vector_db.delete(ids=ids_to_delete)
+    if ids_to_update:
+        vector_db._collection.update(ids=ids_to_update, metadatas=metadatas_to_update)
+    if chunks_to_add:
+        engine = EmbeddingEngine(batch_size=batch_size, num_workers=num_workers, cache=embedding_cache)
+        vectors = engine.embed_texts([c.page_content for c in chunks_to_add])
+        upsert_in_batches(vector_db, ids_to_add, chunks_to_add, vectors)
+        elapsed = time.perf_counter() - start
+        print(f"Embedding: {engine.last_rate:.1f} chunk/s | Tổng ingestion: {len(chunks_to_add) / elapsed:.1f} chunk/s ({elapsed:.1f}s)")
     vector_db.persist()
+
+    # Xuất thêm index phẳng (NumPy) cho backend RETRIEVER_BACKEND=flat và index BM25 cho bm25/hybrid
+    export_flat_index(vector_db, DB_PATH)
+    export_lexical_index(vector_db, DB_PATH)
+
+    manifest["files"] = new_files
+    manifest["index_version"] = compute_index_version(new_files)
+    save_manifest(manifest)
+    print_incremental_report(stats)
     print(f"HOÀN TẤT! Database sẵn sàng tại: {DB_PATH}")
 
+# =========================
+# MANIFEST (INCREMENTAL)
+# =========================
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def chunking_signature():
+    """Chữ ký cấu hình chunking + embedding, đổi cấu hình thì phải build lại"""
+    return {
+        "embedding_model": embedding_model_id(),
+        "max_chunk_size": MAX_CHUNK_SIZE,
+        "manifest_version": MANIFEST_VERSION,
+    }
+
+def new_manifest():
+    return {**chunking_signature(), "files": {}}
+
+def manifest_compatible(manifest):
+    return all(manifest.get(k) == v for k, v in chunking_signature().items())
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return None
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Không đọc được manifest ({e}) -> build lại toàn bộ")
+        return None
+
+def save_manifest(manifest):
+    os.makedirs(DB_PATH, exist_ok=True)
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, MANIFEST_PATH)
 
+def compute_index_version(files):
+    """Phiên bản index = hash của toàn bộ id chunk, đổi nội dung là đổi version (cache câu trả lời tự hết hiệu lực)"""
+    all_ids = sorted(cid for entry in files.values() for cid in entry["chunks"])
+    return hash_text("\n".join(all_ids))[:16]
+
+def assign_chunk_ids(chunks, source):
+    """
+    ID chunk = hash(file + nội dung). Chunk trùng nội dung trong cùng file
+    được đánh thêm số thứ tự để không đè lên nhau.
+    """
+    ids = []
+    seen = {}
+    for c in chunks:
+        base = hash_text(f"{source}\0{c.page_content}")[:32]
+        n = seen.get(base, 0)
+        seen[base] = n + 1
+        ids.append(base if n == 0 else f"{base}-{n}")
+    return ids
+
+def print_incremental_report(stats):
+    total = stats["chunks_skipped"] + stats["chunks_embedded"]
+    print("\n📊 --- Thống kê incremental ---")
+    print(f"   File không đổi: {stats['files_unchanged']} | thay đổi/mới: {stats['files_changed']} | đã xóa: {stats['files_removed']}")
+    print(f"   Chunk bỏ qua (không embed lại): {stats['chunks_skipped']}/{total}")
+    print(f"   Chunk embed mới: {stats['chunks_embedded']} | chunk mồ côi đã xóa: {stats['chunks_deleted']}")
+
+def load_documents(data_path=DATA_PATH):
+    loader = DirectoryLoader(data_path, glob="**/*.txt", loader_cls=TextLoader, loader_kwargs={"encoding": "utf-8"})
+    return loader.load()
+
+def chunk_document(doc, verbose=True):
+    """Phân loại tài liệu để áp dụng chiến thuật cắt"""
+    file_name = os.path.basename(doc.metadata.get("source", ""))
+    if is_legal_document(file_name):
+        if verbose: print(f"Xử lý Quy chế: {file_name}")
+        chunks = split_legal_document(doc.page_content, doc.metadata)
+    else:
+        if verbose: print(f"Xử lý Sổ tay/Markdown: {file_name}")
+        chunks = split_markdown_document(doc.page_content, doc.metadata)
+
+    # Vị trí chunk trong file: dùng để ghép lại các chunk liền kề khi tạo context
+    # Nhóm tài liệu: dùng để lọc khi định tuyến câu hỏi (src/doc_router.py)
+    category = get_doc_category(file_name)
+    for i, c in enumerate(chunks):
+        c.metadata["chunk_index"] = i
+        c.metadata["category"] = category
+    return chunks
 
 def is_legal_document(filename):
     """Nhận diện file quy chế dựa trên tên file"""
@@ -209,4 +380,9 @@ def print_debug_chunks(chunks):
         print("-" * 50)
 
 if __name__ == "__main__":
-    create_vector_db()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Tạo/cập nhật vector database cho LexiBot")
+    parser.add_argument("--full", action="store_true", help="Xóa DB cũ và build lại toàn bộ")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="Số chunk mỗi batch encode")
+    parser.add_argument("--workers", type=int, default=EMBED_WORKERS, help="Số tiến trình encode (0 = tất cả CPU)")
+    args = parser.parse_args()
+    create_vector_db(full_rebuild=args.full, batch_size=args.batch_size, num_workers=args.workers)
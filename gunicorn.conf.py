@@ -0,0 +1,19 @@
+# Cấu hình gunicorn (tự động được nạp khi chạy `gunicorn app:app` tại thư mục gốc)
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+timeout = 120
+
+
+def post_fork(server, worker):
+    # Warm-up trong từng worker, trước khi worker bắt đầu nhận request
+    from app import warm_up
+    warm_up()
+
+
+def worker_exit(server, worker):
+    # Ghi nốt hàng đợi ghi nền (lịch sử chat, feedback) trước khi worker tắt
+    from app import persist_queue
+    persist_queue.close()
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE", "1") != "0"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))  # giây
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+
+_VERSION_CHECK_INTERVAL = 5  # giây giữa 2 lần stat manifest
+
+
+def read_index_version(db_path: str):
+    """Đọc index_version do create_db.py ghi vào manifest (None nếu chưa có)"""
+    manifest_path = os.path.join(db_path, "manifest.json")
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("index_version")
+    except (OSError, ValueError):
+        return None
+
+
+class AnswerCache:
+    """
+    Cache câu trả lời theo ngữ nghĩa:
+    key = embedding của câu hỏi độc lập (sau khi viết lại) + provider + phiên bản index.
+    Câu hỏi mới có cosine >= threshold với câu đã trả lời thì dùng lại answer/sources, không gọi LLM.
+    Có TTL, giới hạn số entry (LRU) và tự xóa khi create_db.py build lại index.
+    """
+
+    def __init__(self, db_path: str, threshold: float = ANSWER_CACHE_THRESHOLD,
+                 ttl: int = ANSWER_CACHE_TTL, max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        self.db_path = db_path
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # id -> entry
+        self._matrix = {}              # provider -> (ids, ma trận vector), dựng lại khi thay đổi
+        self._next_id = 0
+        self._version = read_index_version(db_path)
+        self._manifest_mtime = self._get_manifest_mtime()
+        self._last_version_check = time.time()
+
+    # ---------- phiên bản index ----------
+    def _get_manifest_mtime(self):
+        try:
+            return os.path.getmtime(os.path.join(self.db_path, "manifest.json"))
+        except OSError:
+            return None
+
+    def _check_version(self):
+        now = time.time()
+        if now - self._last_version_check < _VERSION_CHECK_INTERVAL:
+            return
+        self._last_version_check = now
+        mtime = self._get_manifest_mtime()
+        if mtime == self._manifest_mtime:
+            return
+        self._manifest_mtime = mtime
+        version = read_index_version(self.db_path)
+        if version != self._version:
+            print(f"Index đã thay đổi ({self._version} -> {version}), xóa cache câu trả lời")
+            self._version = version
+            self._entries.clear()
+            self._matrix.clear()
+
+    # ---------- tra cứu ----------
+    def _provider_matrix(self, provider):
+        if provider not in self._matrix:
+            ids = [i for i, e in self._entries.items() if e["provider"] == provider]
+            mat = np.stack([self._entries[i]["vector"] for i in ids]) if ids else None
+            self._matrix[provider] = (ids, mat)
+        return self._matrix[provider]
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry is not None:
+            self._matrix.pop(entry["provider"], None)
+
+    def lookup(self, vector, provider: str):
+        """Trả về {"answer", "sources", "question", "score"} nếu trúng cache, ngược lại None"""
+        with self._lock:
+            self._check_version()
+            ids, mat = self._provider_matrix(provider)
+            if mat is None:
+                self.misses += 1
+                return None
+
+            scores = mat @ np.asarray(vector, dtype=np.float32)
+            # Entry hết hạn không được chọn (và bị dọn), để không che mất entry còn hạn khớp kém hơn một chút
+            now = time.time()
+            expired = [k for k, i in enumerate(ids) if now - self._entries[i]["created"] > self.ttl]
+            if expired:
+                scores[expired] = -np.inf
+                for k in expired:
+                    self._remove(ids[k])
+            best = int(np.argmax(scores))
+            score = float(scores[best])
+            entry_id = ids[best]
+            entry = self._entries.get(entry_id)
+
+            if entry is None or score < self.threshold:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            return {"answer": entry["answer"], "sources": entry["sources"],
+                    "question": entry["question"], "score": score}
+
+    def store(self, vector, provider: str, question: str, answer: str, sources):
+        with self._lock:
+            self._check_version()
+            now = time.time()
+            # Dọn entry hết hạn trước khi thêm
+            for entry_id in [i for i, e in self._entries.items() if now - e["created"] > self.ttl]:
+                self._remove(entry_id)
+            while len(self._entries) >= self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+            self._entries[self._next_id] = {
+                "provider": provider,
+                "vector": np.asarray(vector, dtype=np.float32),
+                "question": question,
+                "answer": answer,
+                "sources": sources,
+                "created": now,
+            }
+            self._next_id += 1
+            self._matrix.pop(provider, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries),
+                "hit_rate": self.hits / total if total else 0.0}
+
+
+_answer_cache_instance = None
+
+def get_answer_cache(db_path: str):
+    global _answer_cache_instance
+    if _answer_cache_instance is None:
+        _answer_cache_instance = AnswerCache(db_path)
+    return _answer_cache_instance
@@ -0,0 +1,157 @@
+"""
+Cửa sổ lịch sử hội thoại có giới hạn token + tóm tắt cuốn chiếu các lượt cũ.
+- Chỉ các lượt gần nhất (tổng tối đa HISTORY_WINDOW_TOKENS) được gửi nguyên văn.
+- Các lượt rơi ra khỏi cửa sổ được gộp dần vào một bản tóm tắt lưu cùng hội thoại
+  (summary + summary_upto = số tin nhắn đã được tóm tắt), không bao giờ tóm tắt lại từ đầu.
+"""
+import os
+import re
+import html
+from langchain_core.prompts import ChatPromptTemplate
+from src.context_packer import estimate_tokens, truncate_to_tokens
+from src.models import get_llm
+from src import metrics
+
+HISTORY_WINDOW_TOKENS = int(os.getenv("HISTORY_WINDOW_TOKENS", "1500"))
+HISTORY_MESSAGE_TOKENS = int(os.getenv("HISTORY_MESSAGE_TOKENS", "600"))   # câu trả lời dài bị cắt bớt
+HISTORY_SUMMARY_ENABLED = os.getenv("HISTORY_SUMMARY", "1") != "0"
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "300"))
+HISTORY_SUMMARY_PROVIDER = os.getenv("HISTORY_SUMMARY_PROVIDER", "")       # rỗng = dùng provider của lượt hỏi
+HISTORY_SUMMARY_BATCH = int(os.getenv("HISTORY_SUMMARY_BATCH", "20"))      # số tin nhắn tối đa gộp mỗi lần gọi LLM
+
+summary_system_prompt = """
+Nhiệm vụ: Cập nhật bản tóm tắt cuộc hội thoại giữa sinh viên và LexiBot.
+
+Quy tắc:
+- Gộp các lượt mới vào bản tóm tắt hiện có, KHÔNG bỏ các ý quan trọng đã có.
+- Giữ lại: chủ đề sinh viên hỏi, thông tin cá nhân sinh viên đã nêu (ngành, khóa, hệ đào tạo...),
+  các con số/điều kiện chính trong câu trả lời.
+- Viết ngắn gọn bằng tiếng Việt, tối đa {max_words} từ.
+- Chỉ xuất ra bản tóm tắt.
+"""
+
+summary_prompt = ChatPromptTemplate.from_messages([
+    ("system", summary_system_prompt),
+    ("human", "Tóm tắt hiện có:\n{summary}\n\nCác lượt mới cần gộp vào:\n{turns}")
+])
+
+_summary_llms = {}
+
+
+def plain_text(content: str) -> str:
+    """HTML -> text thường"""
+    return html.unescape(re.sub(r"<[^>]+>", "", content or "")).strip()
+
+
+def message_text(msg) -> str:
+    """Nội dung gửi cho LLM: Markdown gốc; câu trả lời cũ lưu dạng HTML thì bỏ thẻ"""
+    content = msg.get("content", "") or ""
+    if msg.get("role") == "assistant" and msg.get("format") != "markdown":
+        return plain_text(content)
+    return content
+
+
+def clip_message(content: str) -> str:
+    return truncate_to_tokens(content or "", HISTORY_MESSAGE_TOKENS)
+
+
+# =========================
+# CỬA SỔ LỊCH SỬ
+# =========================
+def window_start(messages, summarized_upto: int = 0, budget: int = HISTORY_WINDOW_TOKENS) -> int:
+    """Vị trí tin nhắn đầu tiên được gửi nguyên văn (luôn giữ ít nhất lượt hỏi-đáp cuối)"""
+    start = len(messages)
+    used = 0
+    while start > summarized_upto:
+        tokens = estimate_tokens(clip_message(message_text(messages[start - 1])))
+        if used + tokens > budget and len(messages) - start >= 2:
+            break
+        used += tokens
+        start -= 1
+    # Không cắt đôi một lượt: cửa sổ bắt đầu từ câu hỏi của người dùng
+    while start < len(messages) - 1 and messages[start].get("role") != "user":
+        start += 1
+    return start
+
+
+def _relative_upto(messages, summarized_upto, offset):
+    """summary_upto tính trên toàn hội thoại, messages có thể chỉ là phần đuôi bắt đầu từ tin nhắn thứ offset"""
+    return min(max((summarized_upto or 0) - offset, 0), len(messages))
+
+
+def build_history(messages, summary: str = "", summarized_upto: int = 0, offset: int = 0):
+    """(các tin nhắn trong cửa sổ, đã cắt bớt nội dung quá dài; bản tóm tắt các lượt cũ hơn)"""
+    messages = messages or []
+    start = window_start(messages, _relative_upto(messages, summarized_upto, offset))
+    window = [{"role": m.get("role"), "content": clip_message(message_text(m))} for m in messages[start:]]
+    metrics.observe("lexibot_history_window_messages", len(window), buckets=(2, 4, 6, 8, 10, 15, 20, 30, 50))
+    return window, summary or ""
+
+
+# =========================
+# TÓM TẮT CUỐN CHIẾU
+# =========================
+def get_summary_llm(model_provider: str):
+    provider = HISTORY_SUMMARY_PROVIDER or model_provider
+    if provider not in _summary_llms:
+        _summary_llms[provider] = get_llm(provider)
+    return _summary_llms[provider]
+
+
+def pending_messages(messages, summarized_upto: int = 0, offset: int = 0, batch: int = HISTORY_SUMMARY_BATCH):
+    """
+    Các tin nhắn đã ra khỏi cửa sổ nhưng chưa được tóm tắt -> (messages, vị trí summary_upto mới).
+    Tối đa batch tin nhắn mỗi lần; messages bắt đầu sau summary_upto (thiếu đoạn giữa) thì không tóm tắt gì,
+    để summary_upto không nhảy qua các tin nhắn chưa từng được tóm tắt.
+    """
+    if (summarized_upto or 0) < offset:
+        return [], summarized_upto or 0
+    upto = _relative_upto(messages, summarized_upto, offset)
+    start = window_start(messages, upto)
+    end = min(start, upto + batch)
+    # Không cắt đôi một lượt: dừng trước câu hỏi kế tiếp của người dùng
+    while upto < end < start and messages[end].get("role") != "user":
+        end += 1
+    return messages[upto:end], offset + end
+
+
+def format_turns(messages):
+    lines = []
+    for m in messages:
+        speaker = "Sinh viên" if m.get("role") == "user" else "LexiBot"
+        lines.append(f"{speaker}: {clip_message(message_text(m))}")
+    return "\n".join(lines)
+
+
+def _summary_inputs(summary, pending):
+    return {
+        "summary": summary or "(chưa có)",
+        "turns": format_turns(pending),
+        "max_words": HISTORY_SUMMARY_TOKENS // 2,
+    }
+
+
+def update_summary(llm, messages, summary: str = "", summarized_upto: int = 0, offset: int = 0):
+    """Gộp các tin nhắn mới rơi khỏi cửa sổ vào bản tóm tắt -> (summary, summary_upto) hoặc None nếu không có gì mới"""
+    if not HISTORY_SUMMARY_ENABLED:
+        return None
+    pending, new_upto = pending_messages(messages or [], summarized_upto, offset)
+    if not pending:
+        return None
+    with metrics.timed("history_summary"):
+        result = (summary_prompt | llm).invoke(_summary_inputs(summary, pending))
+    metrics.inc("lexibot_history_summarized_messages_total", value=len(pending))
+    return truncate_to_tokens(result.content.strip(), HISTORY_SUMMARY_TOKENS), new_upto
+
+
+async def aupdate_summary(llm, messages, summary: str = "", summarized_upto: int = 0, offset: int = 0):
+    """Bản async của update_summary"""
+    if not HISTORY_SUMMARY_ENABLED:
+        return None
+    pending, new_upto = pending_messages(messages or [], summarized_upto, offset)
+    if not pending:
+        return None
+    with metrics.timed("history_summary"):
+        result = await (summary_prompt | llm).ainvoke(_summary_inputs(summary, pending))
+    metrics.inc("lexibot_history_summarized_messages_total", value=len(pending))
+    return truncate_to_tokens(result.content.strip(), HISTORY_SUMMARY_TOKENS), new_upto
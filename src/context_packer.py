@@ -0,0 +1,159 @@
+import os
+import math
+
+CONTEXT_PACKING_ENABLED = os.getenv("CONTEXT_PACKING", "1") != "0"
+# Ước lượng token theo số ký tự (tiếng Việt ~3 ký tự/token với tokenizer của Gemini/Llama)
+CHARS_PER_TOKEN = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", "3.0"))
+DEFAULT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+CONTEXT_TOKEN_BUDGETS = {
+    "gemini": int(os.getenv("CONTEXT_TOKEN_BUDGET_GEMINI", "6000")),
+    "groq": int(os.getenv("CONTEXT_TOKEN_BUDGET_GROQ", "2500")),
+}
+
+MIN_OVERLAP_CHARS = 20    # đoạn trùng ngắn hơn coi như không phải overlap của splitter
+MAX_OVERLAP_CHARS = 400   # lớn hơn chunk_overlap (150/200) của create_db.py
+MIN_PARTIAL_TOKENS = 80   # phần còn lại của budget nhỏ hơn thì không cắt thêm đoạn dở dang
+GAP_MARKER = "\n[...]\n"  # nối 2 phần không liền nhau của cùng một Điều/mục
+
+
+def get_context_budget(provider: str) -> int:
+    return CONTEXT_TOKEN_BUDGETS.get(provider, DEFAULT_CONTEXT_TOKEN_BUDGET)
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def source_header(doc):
+    file_name = os.path.basename(doc.metadata.get('source', 'Tai_lieu'))
+    section = doc.metadata.get('section', 'Thông tin chung')
+    return f"[Nguồn: {file_name} | {section}]"
+
+
+def format_block(header, text):
+    return f"{header}\nNội dung: {text}"
+
+
+def strip_section_header(doc):
+    """Bỏ dòng "[Chương > Điều]" mà create_doc gắn vào đầu chunk (đã có trong dòng [Nguồn: ...])"""
+    text = doc.page_content
+    section = doc.metadata.get("section")
+    if section is not None and text.startswith(f"[{section}]\n"):
+        return text[len(section) + 3:]
+    return text
+
+
+def overlap_length(a: str, b: str) -> int:
+    """Độ dài phần cuối của a trùng với phần đầu của b (overlap do text splitter tạo ra)"""
+    probe = b[:MIN_OVERLAP_CHARS]
+    if len(probe) < MIN_OVERLAP_CHARS:
+        return 0
+    pos = a.find(probe, max(0, len(a) - MAX_OVERLAP_CHARS))
+    while pos != -1:
+        if b.startswith(a[pos:]):
+            return len(a) - pos
+        pos = a.find(probe, pos + 1)
+    return 0
+
+
+def merge_pieces(pieces):
+    """
+    Gộp các chunk con của cùng một Điều/mục, pieces = list (chunk_index, text).
+    Có chunk_index: xếp theo thứ tự trong tài liệu, chunk liền kề nối thẳng (bỏ phần overlap),
+    chunk cách quãng nối bằng GAP_MARKER. Index cũ chưa có chunk_index: chỉ nối được chunk có overlap.
+    """
+    if all(idx is not None for idx, _ in pieces):
+        return _merge_ordered(sorted(pieces))
+    return _merge_by_overlap([text for _, text in pieces])
+
+
+def _merge_ordered(pieces):
+    prev_idx, merged = pieces[0]
+    for idx, text in pieces[1:]:
+        if idx == prev_idx + 1:
+            n = overlap_length(merged, text)
+            merged += text[n:] if n else "\n" + text
+        else:
+            merged += GAP_MARKER + text
+        prev_idx = idx
+    return merged
+
+
+def _merge_by_overlap(pieces):
+    changed = True
+    while changed and len(pieces) > 1:
+        changed = False
+        for i in range(len(pieces)):
+            for j in range(len(pieces)):
+                if i == j:
+                    continue
+                a, b = pieces[i], pieces[j]
+                if b in a:
+                    merged = a
+                else:
+                    n = overlap_length(a, b)
+                    if not n:
+                        continue
+                    merged = a + b[n:]
+                pieces[i] = merged
+                del pieces[j]
+                changed = True
+                break
+            if changed:
+                break
+    return GAP_MARKER.join(pieces)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cắt text vừa max_tokens, ưu tiên cắt ở cuối dòng/câu"""
+    limit = int(max_tokens * CHARS_PER_TOKEN)
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    boundary = max(cut.rfind("\n"), cut.rfind(". "))
+    if boundary > limit // 2:
+        cut = cut[:boundary + 1]
+    return cut.rstrip() + " ..."
+
+
+def pack_context(docs, budget: int):
+    """
+    Ghép context cho prompt từ các chunk đã retrieve (theo thứ tự liên quan):
+    gom chunk cùng file + section, bỏ phần trùng lặp, rồi xếp vào vừa budget token.
+    Trả về (context_text, docs được dùng, thống kê token).
+    """
+    groups = {}
+    for doc in docs:
+        key = (doc.metadata.get("source"), doc.metadata.get("section"))
+        groups.setdefault(key, []).append(doc)
+
+    blocks = []
+    used_docs = []
+    used_tokens = 0
+    for group in groups.values():
+        header = source_header(group[0])
+        pieces = [(d.metadata.get("chunk_index"), strip_section_header(d)) for d in group]
+        block = format_block(header, merge_pieces(pieces))
+        tokens = estimate_tokens(block)
+        remaining = budget - used_tokens
+        if tokens > remaining:
+            # Đoạn liên quan nhất luôn được giữ (cắt bớt), các đoạn sau chỉ cắt nếu còn đủ chỗ
+            if blocks and remaining < MIN_PARTIAL_TOKENS:
+                continue
+            block = truncate_to_tokens(block, remaining)
+            tokens = estimate_tokens(block)
+        blocks.append(block)
+        used_docs.extend(group)
+        used_tokens += tokens
+
+    raw_tokens = sum(estimate_tokens(format_block(source_header(d), d.page_content)) for d in docs)
+    context_text = "\n\n".join(blocks)
+    packed_tokens = estimate_tokens(context_text)
+    stats = {
+        "chunks": len(docs),
+        "blocks": len(blocks),
+        "raw_tokens": raw_tokens,
+        "packed_tokens": packed_tokens,
+        "saved_tokens": max(0, raw_tokens - packed_tokens),
+    }
+    return context_text, used_docs, stats
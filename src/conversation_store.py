@@ -0,0 +1,276 @@
+"""
+Lưu trữ hội thoại trên MongoDB, tách tin nhắn ra khỏi document hội thoại.
+- conversations: user_id, title, created_at, updated_at, message_count, summary, summary_upto
+  (index (user_id, updated_at) cho sidebar).
+- messages: mỗi tin nhắn một document (conversation_id, seq 0,1,2..., role, content, ...),
+  index duy nhất (conversation_id, seq) -> đọc N tin nhắn cuối không phải tải cả hội thoại.
+- Hội thoại kiểu cũ (mảng "messages" nhúng trong document) được chuyển sang khi đọc lần đầu.
+ConversationStore dùng pymongo (Flask), AsyncConversationStore dùng AsyncMongoClient (asgi.py).
+create_many/append_many: ghi theo batch cho hàng đợi ghi nền (src/write_behind.py), thử lại không bị ghi trùng.
+"""
+import os
+from datetime import datetime
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError
+
+CONVERSATION_LIST_LIMIT = int(os.getenv("CONVERSATION_LIST_LIMIT", "100"))   # số hội thoại trên sidebar
+HISTORY_FETCH_MESSAGES = int(os.getenv("HISTORY_FETCH_MESSAGES", "40"))      # số tin nhắn cuối đọc làm context
+SUMMARY_BACKLOG_MESSAGES = int(os.getenv("SUMMARY_BACKLOG_MESSAGES", "200"))  # số tin nhắn tối đa đọc mỗi lần tóm tắt
+
+LIST_FIELDS = {"title": 1, "updated_at": 1}
+META_FIELDS = {"user_id": 1, "title": 1, "updated_at": 1, "message_count": 1, "summary": 1, "summary_upto": 1}
+MESSAGE_FIELDS = {"_id": 0, "conversation_id": 0}
+
+
+def make_title(question: str) -> str:
+    return question[:50] + "..." if len(question) > 50 else question
+
+
+def new_conversation(user_id, question, n_messages=0):
+    now = datetime.now()
+    return {
+        "user_id": user_id,
+        "title": make_title(question),
+        "created_at": now,
+        "updated_at": now,
+        "message_count": n_messages,
+        "summary": "",
+        "summary_upto": 0
+    }
+
+
+def message_docs(conversation_id, messages, first_seq):
+    return [{**m, "conversation_id": conversation_id, "seq": first_seq + i} for i, m in enumerate(messages)]
+
+
+def _owner_filter(chat_id, user_id=None):
+    query = {"_id": ObjectId(chat_id)}
+    if user_id is not None:
+        query["user_id"] = user_id
+    return query
+
+
+def insert_many_ignore_duplicates(collection, docs):
+    """insert_many bỏ qua document đã có (lần thử lại sau khi batch trước ghi được một phần)"""
+    if not docs:
+        return
+    try:
+        collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])) or e.details.get("writeConcernErrors"):
+            raise
+
+
+def merge_unflushed(messages, items):
+    """Nối các tin nhắn đang chờ ghi vào phần đuôi hội thoại đọc từ Mongo (bỏ phần batch đã kịp ghi)"""
+    stored = {m.get("seq") for m in messages}
+    extra = [m for item in items if item.get("first_seq") not in stored for m in item["messages"]]
+    return messages + extra if extra else messages
+
+
+def history_window_start(chat_doc, limit=HISTORY_FETCH_MESSAGES):
+    """seq đầu tiên cần đọc làm context: N tin nhắn cuối, không lùi về trước phần đã tóm tắt"""
+    count = chat_doc.get("message_count", 0)
+    return max(chat_doc.get("summary_upto") or 0, count - limit, 0)
+
+
+class ConversationStore:
+    def __init__(self, db):
+        self.conversations = db.conversations
+        self.messages = db.messages
+
+    def ensure_indexes(self):
+        self.conversations.create_index([("user_id", ASCENDING), ("updated_at", DESCENDING)])
+        self.messages.create_index([("conversation_id", ASCENDING), ("seq", ASCENDING)], unique=True)
+
+    # ----- hội thoại -----
+    def list_conversations(self, user_id, limit=CONVERSATION_LIST_LIMIT):
+        """Sidebar: chỉ lấy tiêu đề + thời gian, mới nhất trước"""
+        cursor = self.conversations.find({"user_id": user_id}, LIST_FIELDS)
+        return list(cursor.sort("updated_at", DESCENDING).limit(limit))
+
+    def get(self, chat_id, user_id=None):
+        """Metadata hội thoại (không kèm tin nhắn), None nếu không tồn tại/không thuộc user"""
+        chat_doc = self.conversations.find_one(_owner_filter(chat_id, user_id), META_FIELDS)
+        if chat_doc is not None and "message_count" not in chat_doc:
+            chat_doc = self._migrate(chat_doc["_id"])
+        return chat_doc
+
+    def create(self, user_id, question, messages):
+        chat_doc = new_conversation(user_id, question, len(messages))
+        chat_id = self.conversations.insert_one(chat_doc).inserted_id
+        if messages:
+            self.messages.insert_many(message_docs(chat_id, messages, 0))
+        return str(chat_id)
+
+    def delete(self, chat_id, user_id=None):
+        result = self.conversations.delete_one(_owner_filter(chat_id, user_id))
+        if result.deleted_count:
+            self.messages.delete_many({"conversation_id": ObjectId(chat_id)})
+
+    # ----- tin nhắn -----
+    def append(self, chat_id, messages):
+        """Cấp số thứ tự bằng $inc nguyên tử rồi ghi các tin nhắn mới"""
+        chat_doc = self.conversations.find_one_and_update(
+            {"_id": ObjectId(chat_id)},
+            {"$inc": {"message_count": len(messages)}, "$set": {"updated_at": datetime.now()}},
+            projection={"message_count": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if chat_doc is None:
+            return
+        self.messages.insert_many(message_docs(chat_doc["_id"], messages, chat_doc["message_count"] - len(messages)))
+
+    # ----- ghi theo batch -----
+    def create_many(self, items):
+        """items: {"chat_id": ObjectId tạo sẵn, "user_id", "question"}; tin nhắn được thêm sau bằng append_many"""
+        docs = [{"_id": item["chat_id"], **new_conversation(item["user_id"], item["question"])} for item in items]
+        insert_many_ignore_duplicates(self.conversations, docs)
+
+    def append_many(self, items):
+        """
+        items: {"chat_id", "messages"} theo thứ tự. Mỗi hội thoại một lần $inc cho cả batch, mọi tin nhắn một lần insert_many.
+        Số thứ tự đã cấp được lưu vào item["first_seq"] nên thử lại không cấp lần nữa.
+        Trả về các item không ghi được vì hội thoại không tồn tại (đã xóa, hoặc lệnh tạo bị chuyển sang file dự phòng)
+        để người gọi lưu lại thay vì bỏ mất.
+        """
+        counts = {}
+        for item in items:
+            if "first_seq" not in item:
+                counts[item["chat_id"]] = counts.get(item["chat_id"], 0) + len(item["messages"])
+        next_seq = {}
+        for chat_id, n in counts.items():
+            chat_doc = self.conversations.find_one_and_update(
+                {"_id": ObjectId(chat_id)},
+                {"$inc": {"message_count": n}, "$set": {"updated_at": datetime.now()}},
+                projection={"message_count": 1},
+                return_document=ReturnDocument.AFTER
+            )
+            next_seq[chat_id] = None if chat_doc is None else chat_doc["message_count"] - n
+        missing = []
+        for item in items:
+            if "first_seq" not in item:
+                seq = next_seq[item["chat_id"]]
+                item["first_seq"] = seq
+                if seq is None:
+                    missing.append(item)
+                else:
+                    next_seq[item["chat_id"]] = seq + len(item["messages"])
+        docs = []
+        for item in items:
+            if item["first_seq"] is not None:
+                docs.extend(message_docs(ObjectId(item["chat_id"]), item["messages"], item["first_seq"]))
+        insert_many_ignore_duplicates(self.messages, docs)
+        return missing
+
+    def load_messages(self, chat_doc, start_seq=0, end_seq=None):
+        seq = {"$gte": start_seq} if end_seq is None else {"$gte": start_seq, "$lt": end_seq}
+        cursor = self.messages.find({"conversation_id": chat_doc["_id"], "seq": seq}, MESSAGE_FIELDS)
+        return list(cursor.sort("seq", ASCENDING))
+
+    def load_history(self, chat_id, limit=HISTORY_FETCH_MESSAGES):
+        """(N tin nhắn cuối, summary, summary_upto, seq của tin nhắn đầu tiên) để dựng context"""
+        chat_doc = self.get(chat_id)
+        if chat_doc is None:
+            return [], "", 0, 0
+        start = history_window_start(chat_doc, limit)
+        return self.load_messages(chat_doc, start), chat_doc.get("summary"), chat_doc.get("summary_upto"), start
+
+    def load_summary_backlog(self, chat_id, max_messages=SUMMARY_BACKLOG_MESSAGES):
+        """
+        Như load_history nhưng luôn đọc từ summary_upto, kể cả khi tóm tắt chậm hơn N tin nhắn cuối
+        (không bỏ qua đoạn ở giữa). Tồn đọng quá max_messages thì chỉ đọc phần đầu, tóm tắt dần qua nhiều lần.
+        """
+        chat_doc = self.get(chat_id)
+        if chat_doc is None:
+            return [], "", 0, 0
+        start = chat_doc.get("summary_upto") or 0
+        messages = self.load_messages(chat_doc, start, start + max_messages)
+        return messages, chat_doc.get("summary"), chat_doc.get("summary_upto"), start
+
+    def save_summary(self, chat_id, expected_upto, summary, summary_upto):
+        """Chỉ ghi nếu chưa có lượt tóm tắt khác chạy xong trước (summary_upto không đổi)"""
+        self.conversations.update_one(
+            {"_id": ObjectId(chat_id), "summary_upto": expected_upto},
+            {"$set": {"summary": summary, "summary_upto": summary_upto}}
+        )
+
+    def _migrate(self, chat_id):
+        legacy = self.conversations.find_one({"_id": chat_id})
+        messages = legacy.get("messages", [])
+        if messages:
+            self.messages.delete_many({"conversation_id": chat_id})
+            self.messages.insert_many(message_docs(chat_id, messages, 0))
+        self.conversations.update_one(
+            {"_id": chat_id},
+            {"$set": {"message_count": len(messages)}, "$unset": {"messages": ""}}
+        )
+        print(f"[STORE] Đã tách {len(messages)} tin nhắn của hội thoại {chat_id}")
+        return self.conversations.find_one({"_id": chat_id}, META_FIELDS)
+
+
+class AsyncConversationStore:
+    """Bản async của ConversationStore (cùng schema, cùng tên hàm)"""
+
+    def __init__(self, db):
+        self.conversations = db.conversations
+        self.messages = db.messages
+
+    async def ensure_indexes(self):
+        await self.conversations.create_index([("user_id", ASCENDING), ("updated_at", DESCENDING)])
+        await self.messages.create_index([("conversation_id", ASCENDING), ("seq", ASCENDING)], unique=True)
+
+    async def get(self, chat_id, user_id=None):
+        chat_doc = await self.conversations.find_one(_owner_filter(chat_id, user_id), META_FIELDS)
+        if chat_doc is not None and "message_count" not in chat_doc:
+            chat_doc = await self._migrate(chat_doc["_id"])
+        return chat_doc
+
+    async def create(self, user_id, question, messages):
+        chat_doc = new_conversation(user_id, question, len(messages))
+        chat_id = (await self.conversations.insert_one(chat_doc)).inserted_id
+        if messages:
+            await self.messages.insert_many(message_docs(chat_id, messages, 0))
+        return str(chat_id)
+
+    async def append(self, chat_id, messages):
+        chat_doc = await self.conversations.find_one_and_update(
+            {"_id": ObjectId(chat_id)},
+            {"$inc": {"message_count": len(messages)}, "$set": {"updated_at": datetime.now()}},
+            projection={"message_count": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if chat_doc is None:
+            return
+        await self.messages.insert_many(message_docs(chat_doc["_id"], messages, chat_doc["message_count"] - len(messages)))
+
+    async def load_messages(self, chat_doc, start_seq=0):
+        cursor = self.messages.find({"conversation_id": chat_doc["_id"], "seq": {"$gte": start_seq}}, MESSAGE_FIELDS)
+        return await cursor.sort("seq", ASCENDING).to_list(None)
+
+    async def load_history(self, chat_id, limit=HISTORY_FETCH_MESSAGES):
+        chat_doc = await self.get(chat_id)
+        if chat_doc is None:
+            return [], "", 0, 0
+        start = history_window_start(chat_doc, limit)
+        return await self.load_messages(chat_doc, start), chat_doc.get("summary"), chat_doc.get("summary_upto"), start
+
+    async def save_summary(self, chat_id, expected_upto, summary, summary_upto):
+        await self.conversations.update_one(
+            {"_id": ObjectId(chat_id), "summary_upto": expected_upto},
+            {"$set": {"summary": summary, "summary_upto": summary_upto}}
+        )
+
+    async def _migrate(self, chat_id):
+        legacy = await self.conversations.find_one({"_id": chat_id})
+        messages = legacy.get("messages", [])
+        if messages:
+            await self.messages.delete_many({"conversation_id": chat_id})
+            await self.messages.insert_many(message_docs(chat_id, messages, 0))
+        await self.conversations.update_one(
+            {"_id": chat_id},
+            {"$set": {"message_count": len(messages)}, "$unset": {"messages": ""}}
+        )
+        print(f"[STORE] Đã tách {len(messages)} tin nhắn của hội thoại {chat_id}")
+        return await self.conversations.find_one({"_id": chat_id}, META_FIELDS)
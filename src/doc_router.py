@@ -0,0 +1,180 @@
+"""
+Định tuyến câu hỏi tới nhóm tài liệu (học phí, học bổng, đào tạo, CTSV, sổ tay...).
+- create_db.py gắn metadata "category" cho mỗi chunk theo tên file (get_doc_category).
+- Lúc hỏi: khớp từ khóa (có dấu hoặc không dấu) trước, không có thì so với vector trung bình
+  (centroid) của từng nhóm. Không chắc chắn -> tìm trên toàn bộ collection như cũ.
+- Lọc bằng metadata filter kiểu Chroma {"category": ...}, FlatRetriever/LexicalRetriever hiểu cùng cú pháp.
+"""
+import os
+import re
+import asyncio
+import unicodedata
+from typing import Any, List
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from src import metrics
+
+DOC_ROUTING_ENABLED = os.getenv("DOC_ROUTING", "1") != "0"
+ROUTER_MAX_CATEGORIES = int(os.getenv("ROUTER_MAX_CATEGORIES", "2"))        # khớp nhiều nhóm hơn -> tìm toàn bộ
+ROUTER_CENTROID_MIN = float(os.getenv("ROUTER_CENTROID_MIN", "0.35"))       # cosine tối thiểu với centroid
+ROUTER_CENTROID_MARGIN = float(os.getenv("ROUTER_CENTROID_MARGIN", "0.05"))  # cách biệt với nhóm thứ 2
+DEFAULT_CATEGORY = "chung"
+ALWAYS_INCLUDED = [DEFAULT_CATEGORY]   # FAQ/tài liệu chung luôn được tìm cùng nhóm đã chọn
+
+# category -> (từ khóa trong tên file, từ khóa trong câu hỏi); một từ khóa có thể thuộc nhiều nhóm
+DOC_CATEGORIES = {
+    "hoc_phi": (["hocphi"], [
+        "học phí", "tchp", "đóng tiền", "nộp tiền", "mức thu", "hoàn phí", "đơn giá",
+    ]),
+    "hoc_bong": (["hocbong"], [
+        "học bổng", "kkht", "hbkk", "xét học bổng",
+    ]),
+    "dao_tao": (["daotao"], [
+        "đăng ký học", "học phần", "tốt nghiệp", "cảnh báo học tập", "thôi học", "cpa", "gpa",
+        "điểm trung bình", "đồ án", "chuyển ngành", "song ngành", "học lại", "học cải thiện",
+        "bảo lưu", "nghỉ học tạm thời", "thạc sĩ", "tiến sĩ", "khối lượng học tập", "chuẩn đầu ra",
+    ]),
+    "ctsv": (["congtacsinhvien"], [
+        "rèn luyện", "khen thưởng", "kỷ luật", "ký túc xá", "ktx", "nội trú", "ngoại trú",
+        "bảo hiểm", "tâm lý", "trợ cấp", "vay vốn", "tuần sinh hoạt công dân", "lớp trưởng", "cố vấn học tập",
+    ]),
+    "so_tay": (["sotay"], [
+        "sổ tay", "câu lạc bộ", "clb", "thư viện", "email", "tài khoản", "wifi", "ctt", "qldt",
+        "phòng ban", "số điện thoại", "địa chỉ", "bản đồ", "toà nhà", "tòa nhà",
+        # Sổ tay tóm tắt lại các chính sách này -> tìm cả sổ tay lẫn văn bản gốc
+        "miễn giảm", "vay vốn", "trợ cấp",
+    ]),
+}
+
+
+def get_doc_category(filename: str) -> str:
+    name = filename.lower()
+    for category, (file_keywords, _) in DOC_CATEGORIES.items():
+        if any(k in name for k in file_keywords):
+            return category
+    return DEFAULT_CATEGORY
+
+
+def _fold(text: str) -> str:
+    """Chữ thường, bỏ dấu, chỉ giữ từ: "Học phí?" -> "hoc phi" """
+    text = unicodedata.normalize("NFD", text.lower())
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn").replace("đ", "d")
+    return " ".join(re.findall(r"\w+", text))
+
+
+# Từ khóa so khớp ở dạng không dấu, theo ranh giới từ
+_KEYWORD_PATTERNS = {
+    category: re.compile(r"\b(?:" + "|".join(re.escape(_fold(k)) for k in keywords) + r")\b")
+    for category, (_, keywords) in DOC_CATEGORIES.items()
+}
+
+
+# =========================
+# FILTER KIỂU CHROMA
+# =========================
+def category_filter(categories):
+    categories = list(categories)
+    if len(categories) == 1:
+        return {"category": categories[0]}
+    return {"category": {"$in": categories}}
+
+
+def filter_categories(filter):
+    """Ngược lại với category_filter: filter -> list category (None nếu không lọc theo category)"""
+    if not filter or "category" not in filter:
+        return None
+    value = filter["category"]
+    if not isinstance(value, dict):
+        return [value]
+    if "$in" in value:
+        return list(value["$in"])
+    if "$eq" in value:
+        return [value["$eq"]]
+    return None
+
+
+def category_rows(metadatas, categories):
+    """Các hàng có metadata category thuộc categories (dùng cho index phẳng và BM25)"""
+    wanted = set(categories)
+    return np.fromiter(
+        (i for i, m in enumerate(metadatas) if (m or {}).get("category") in wanted), dtype=np.int64
+    )
+
+
+# =========================
+# ROUTER
+# =========================
+class DocRouter:
+    """Chọn nhóm tài liệu cho câu hỏi; route() trả về (list category hoặc None, lý do)"""
+
+    def __init__(self, flat_index, embedding=None):
+        self.embedding = embedding
+        categories = [(m or {}).get("category") for m in flat_index.metadatas]
+        self.available = {c for c in categories if c}
+        self.centroids = {}
+        if embedding is not None and len(flat_index):
+            labels = np.array([c or "" for c in categories])
+            for category in self.available:
+                centroid = np.asarray(flat_index.vectors[labels == category]).mean(axis=0)
+                self.centroids[category] = centroid / max(float(np.linalg.norm(centroid)), 1e-12)
+
+    def _with_defaults(self, categories):
+        extra = [c for c in ALWAYS_INCLUDED if c in self.available and c not in categories]
+        return list(categories) + extra
+
+    def route(self, question: str):
+        if not self.available:
+            return None, "no_categories"   # DB cũ chưa có metadata category
+        folded = _fold(question)
+        matched = [c for c, p in _KEYWORD_PATTERNS.items() if c in self.available and p.search(folded)]
+        if matched:
+            if len(matched) > ROUTER_MAX_CATEGORIES:
+                return None, "ambiguous"
+            return self._with_defaults(matched), "keyword"
+        if not self.centroids:
+            return None, "no_match"
+
+        query = np.asarray(self.embedding.embed_query(question), dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        ranked = sorted(((float(c @ query), name) for name, c in self.centroids.items()), reverse=True)
+        best_score, best = ranked[0]
+        runner_up = ranked[1][0] if len(ranked) > 1 else -1.0
+        if best_score >= ROUTER_CENTROID_MIN and best_score - runner_up >= ROUTER_CENTROID_MARGIN:
+            return self._with_defaults([best]), "centroid"
+        return None, "uncertain"
+
+
+class RoutedRetriever(BaseRetriever):
+    """Tìm trong nhóm tài liệu router chọn; router không chắc hoặc nhóm không có kết quả -> tìm toàn bộ"""
+
+    router: Any
+    retriever: Any
+
+    def _record(self, reason, categories):
+        metrics.inc("lexibot_route_decisions_total", {"reason": reason})
+        if categories:
+            print(f"[ROUTE] {reason}: {', '.join(categories)}")
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        categories, reason = self.router.route(query)
+        self._record(reason, categories)
+        if categories:
+            docs = self.retriever.invoke(query, filter=category_filter(categories))
+            if docs:
+                return docs
+            metrics.inc("lexibot_route_decisions_total", {"reason": "empty_fallback"})
+        return self.retriever.invoke(query)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        if self.router.embedding is not None:
+            categories, reason = await asyncio.to_thread(self.router.route, query)
+        else:
+            categories, reason = self.router.route(query)
+        self._record(reason, categories)
+        if categories:
+            docs = await self.retriever.ainvoke(query, filter=category_filter(categories))
+            if docs:
+                return docs
+            metrics.inc("lexibot_route_decisions_total", {"reason": "empty_fallback"})
+        return await self.retriever.ainvoke(query)
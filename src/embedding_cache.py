@@ -0,0 +1,305 @@
+import os
+import re
+import atexit
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE", "1") != "0"
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", "./embedding_cache")
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "50000"))
+
+_TOUCH_FLUSH_EVERY = 256
+_SQL_BATCH = 500
+
+
+def normalize_text(text: str) -> str:
+    """Chuẩn hóa trước khi băm: Unicode NFC + gộp khoảng trắng"""
+    text = unicodedata.normalize("NFC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def cache_key(model_name: str, text: str) -> str:
+    return hashlib.sha256(f"{model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()[:32]
+
+
+def key_tag(key: str):
+    """Dấu 64 bit của key lưu cạnh vector trong slot (khác 0; 0 = slot đang ghi dở)"""
+    return np.uint64(int(key[:16], 16) | 1)
+
+
+class EmbeddingCache:
+    """
+    Cache vector embedding trên đĩa, dùng chung cho create_db.py và lúc truy vấn.
+    - vectors-<gen>.f4: ma trận float32 (max_entries x dim) được memory-map, mỗi entry một slot.
+    - tags-<gen>.u8: mỗi slot ghi kèm dấu của key đang nằm trong slot (0 = đang ghi dở). Worker khác đọc slot
+      vừa bị thu hồi/ghi đè sẽ thấy dấu không khớp -> coi như miss, không bao giờ nhận vector của text khác.
+    - index.sqlite: key -> slot, last_used (an toàn khi nhiều worker cùng ghi).
+    Khi đầy thì slot ít được dùng nhất (LRU) bị ghi đè. Đổi số chiều/kích thước thì tăng generation và dùng file mới,
+    không xóa/cắt file mà worker khác có thể vẫn đang map (file thế hệ cũ xóa được sau khi mọi worker khởi động lại).
+    """
+
+    def __init__(self, cache_dir: str = EMBED_CACHE_DIR, max_entries: int = EMBED_CACHE_MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.index_path = os.path.join(cache_dir, "index.sqlite")
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._conn = None
+        self._vectors = None
+        self._tags = None
+        self._dim = None
+        self._generation = None
+        self._pending_touch = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # ---------- kết nối ----------
+    def _connect(self):
+        # Sau fork (gunicorn --preload) phải mở lại kết nối SQLite/memmap
+        if self._conn is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._vectors = self._tags = None
+        self._pending_touch = {}
+        self._conn = sqlite3.connect(self.index_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, slot INTEGER UNIQUE, last_used REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_last_used ON entries(last_used)")
+
+        stored_max = self._get_meta("max_entries")
+        if self._get_meta("generation") is None:
+            # Cache định dạng cũ (vectors.f32 không có dấu key) -> bắt đầu lại
+            self._reset()
+        elif stored_max is not None and int(stored_max) != self.max_entries:
+            print("Kích thước cache embedding thay đổi -> xóa cache cũ")
+            self._reset()
+        self._set_meta("max_entries", self.max_entries)
+
+    def _get_meta(self, name):
+        row = self._conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, name, value):
+        self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, str(value)))
+
+    def _reset(self):
+        """Bỏ toàn bộ entry và chuyển sang file thế hệ mới"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        generation = int(self._get_meta("generation") or 0) + 1
+        self._conn.execute("DELETE FROM entries")
+        self._conn.execute("DELETE FROM meta")
+        self._set_meta("generation", generation)
+        self._set_meta("max_entries", self.max_entries)
+        self._conn.execute("COMMIT")
+        self._vectors = self._tags = None
+        self._dim = None
+
+    def _check_generation(self):
+        """Worker khác đã reset cache -> bỏ memmap cũ để mở file thế hệ mới"""
+        generation = self._get_meta("generation")
+        if generation != self._generation:
+            self._vectors = self._tags = None
+            self._generation = generation
+
+    def _map(self, name, dtype, shape):
+        """memmap file, tạo/nới file bằng truncate khi cần (không dùng mode w+ vì sẽ cắt file worker khác đang map)"""
+        path = os.path.join(self.cache_dir, f"{name}-{self._generation}.{np.dtype(dtype).str[1:]}")
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+    def _open_vectors(self, dim=None):
+        """Mở (hoặc tạo) file vector khi đã biết số chiều"""
+        self._check_generation()
+        if self._vectors is not None:
+            return self._vectors
+        stored_dim = self._get_meta("dim")
+        if stored_dim is None:
+            if dim is None:
+                return None
+            self._set_meta("dim", dim)
+            stored_dim = dim
+        self._dim = int(stored_dim)
+        self._tags = self._map("tags", np.uint64, (self.max_entries,))
+        self._vectors = self._map("vectors", np.float32, (self.max_entries, self._dim))
+        return self._vectors
+
+    # ---------- đọc/ghi ----------
+    def get_many(self, model_name: str, texts):
+        """Trả về list vector (np.ndarray) hoặc None nếu chưa có trong cache"""
+        keys = [cache_key(model_name, t) for t in texts]
+        results = [None] * len(texts)
+        with self._lock:
+            self._connect()
+            vectors = self._open_vectors()
+            if vectors is None:
+                self.misses += len(texts)
+                return results
+            tags = self._tags
+
+            # Đọc key -> slot và vector trong cùng một transaction đọc
+            self._conn.execute("BEGIN")
+            try:
+                slots = {}
+                for i in range(0, len(keys), _SQL_BATCH):
+                    batch = keys[i:i + _SQL_BATCH]
+                    marks = ",".join("?" * len(batch))
+                    for key, slot in self._conn.execute(f"SELECT key, slot FROM entries WHERE key IN ({marks})", batch):
+                        slots[key] = slot
+
+                now = time.time()
+                for i, key in enumerate(keys):
+                    slot = slots.get(key)
+                    if slot is not None:
+                        # Dấu trước và sau khi copy phải cùng là key này (slot không bị ghi đè giữa chừng)
+                        expected = key_tag(key)
+                        before = tags[slot]
+                        vector = np.array(vectors[slot])
+                        if before == expected and tags[slot] == expected:
+                            results[i] = vector
+                            self._pending_touch[key] = now
+                            self.hits += 1
+                            continue
+                    self.misses += 1
+            finally:
+                self._conn.execute("COMMIT")
+
+            if len(self._pending_touch) >= _TOUCH_FLUSH_EVERY:
+                self._flush_touches()
+        return results
+
+    def put_many(self, model_name: str, texts, embeddings):
+        if not texts:
+            return
+        with self._lock:
+            self._connect()
+            vectors = self._open_vectors(dim=len(embeddings[0]))
+            if len(embeddings[0]) != self._dim:
+                print("Số chiều embedding thay đổi -> xóa cache cũ")
+                self._reset()
+                vectors = self._open_vectors(dim=len(embeddings[0]))
+            tags = self._tags
+
+            # Bỏ trùng trong cùng một lần ghi
+            items = {}
+            for text, emb in zip(texts, embeddings):
+                items[cache_key(model_name, text)] = emb
+
+            now = time.time()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self._get_meta("generation") != self._generation:
+                    # Worker khác vừa reset cache -> bỏ lần ghi này, lần sau sẽ mở file mới
+                    self._conn.execute("ROLLBACK")
+                    return
+                existing = set()
+                keys = list(items)
+                for i in range(0, len(keys), _SQL_BATCH):
+                    batch = keys[i:i + _SQL_BATCH]
+                    marks = ",".join("?" * len(batch))
+                    existing.update(r[0] for r in self._conn.execute(f"SELECT key FROM entries WHERE key IN ({marks})", batch))
+                new_keys = [k for k in keys if k not in existing][:self.max_entries]
+                slots = self._allocate_slots(len(new_keys))
+
+                for key, slot in zip(new_keys, slots):
+                    tags[slot] = 0   # đang ghi: người đọc slot cũ sẽ thấy dấu không khớp
+                    vectors[slot] = np.asarray(items[key], dtype=np.float32)
+                    tags[slot] = key_tag(key)
+                # Không msync mỗi lần ghi: page cache đã dùng chung giữa các worker, ghi xuống đĩa khi thoát (flush)
+                self._conn.executemany(
+                    "INSERT INTO entries (key, slot, last_used) VALUES (?, ?, ?)",
+                    [(k, s, now) for k, s in zip(new_keys, slots)]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._flush_touches()
+
+    def _allocate_slots(self, n):
+        """Cấp n slot: ưu tiên slot còn trống, hết chỗ thì thu hồi slot LRU (đang trong transaction)"""
+        next_slot = int(self._get_meta("next_slot") or 0)
+        free = min(n, self.max_entries - next_slot)
+        slots = list(range(next_slot, next_slot + free))
+        self._set_meta("next_slot", next_slot + free)
+
+        evict = n - free
+        if evict > 0:
+            rows = self._conn.execute("SELECT key, slot FROM entries ORDER BY last_used LIMIT ?", (evict,)).fetchall()
+            self._conn.executemany("DELETE FROM entries WHERE key = ?", [(r[0],) for r in rows])
+            slots.extend(r[1] for r in rows)
+        return slots
+
+    def _flush_touches(self):
+        if not self._pending_touch:
+            return
+        self._conn.executemany(
+            "UPDATE entries SET last_used = ? WHERE key = ?",
+            [(t, k) for k, t in self._pending_touch.items()]
+        )
+        self._pending_touch = {}
+
+    def flush(self):
+        """Ghi last_used đang chờ và đẩy vector/dấu xuống đĩa (gọi khi process thoát)"""
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._flush_touches()
+                if self._vectors is not None:
+                    self._vectors.flush()
+                    self._tags.flush()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+def _as_list(vector):
+    return vector.tolist() if isinstance(vector, np.ndarray) else list(vector)
+
+
+class CachedEmbeddings(Embeddings):
+    """Bọc model embedding của LangChain, text đã gặp thì lấy vector từ cache, không chạy transformer"""
+
+    def __init__(self, base: Embeddings, cache: EmbeddingCache, model_name: str):
+        self.base = base
+        self.cache = cache
+        self.model_name = model_name
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        cached = self.cache.get_many(self.model_name, texts)
+        miss_idx = [i for i, v in enumerate(cached) if v is None]
+        if miss_idx:
+            miss_texts = [texts[i] for i in miss_idx]
+            new_vectors = self.base.embed_documents(miss_texts)
+            self.cache.put_many(self.model_name, miss_texts, new_vectors)
+            for i, v in zip(miss_idx, new_vectors):
+                cached[i] = v
+        return [_as_list(v) for v in cached]
+
+    def embed_query(self, text):
+        cached = self.cache.get_many(self.model_name, [text])[0]
+        if cached is not None:
+            return _as_list(cached)
+        vector = self.base.embed_query(text)
+        self.cache.put_many(self.model_name, [text], [vector])
+        return vector
+
+
+_cache_instance = None
+
+def get_embedding_cache():
+    global _cache_instance
+    if _cache_instance is None:
+        _cache_instance = EmbeddingCache()
+        atexit.register(_cache_instance.flush)
+    return _cache_instance
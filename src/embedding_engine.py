@@ -0,0 +1,105 @@
+import os
+import time
+from src.models import get_sentence_transformer, embedding_model_id
+
+# Cấu hình qua biến môi trường, có thể ghi đè bằng tham số dòng lệnh của create_db.py
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "1"))  # 0 = dùng tất cả CPU
+DB_INSERT_BATCH_SIZE = int(os.getenv("DB_INSERT_BATCH_SIZE", "1000"))
+
+
+class EmbeddingEngine:
+    """
+    Bộ mã hóa cho pipeline ingestion:
+    - Encode theo batch cấu hình được (thay vì mặc định của HuggingFaceEmbeddings).
+    - Tùy chọn pool đa tiến trình để dùng hết các nhân CPU.
+    - In tiến độ và tốc độ (chunk/giây).
+    """
+
+    def __init__(self, batch_size: int = EMBED_BATCH_SIZE, num_workers: int = EMBED_WORKERS, cache=None):
+        self.batch_size = max(1, batch_size)
+        self.num_workers = num_workers if num_workers > 0 else (os.cpu_count() or 1)
+        self.cache = cache
+        self.last_rate = 0.0
+        self.cache_hits = 0
+
+    def embed_texts(self, texts):
+        """Trả về list vector (đã chuẩn hóa) theo đúng thứ tự texts, text đã có trong cache thì không encode lại"""
+        if not texts:
+            return []
+        if self.cache is None:
+            return self._encode(texts)
+
+        start = time.perf_counter()
+        cached = self.cache.get_many(embedding_model_id(), texts)
+        miss_idx = [i for i, v in enumerate(cached) if v is None]
+        self.cache_hits = len(texts) - len(miss_idx)
+        if self.cache_hits:
+            print(f"   Cache embedding: {self.cache_hits}/{len(texts)} chunk đã có sẵn")
+
+        if miss_idx:
+            miss_texts = [texts[i] for i in miss_idx]
+            new_vectors = self._encode(miss_texts)
+            self.cache.put_many(embedding_model_id(), miss_texts, new_vectors)
+            for i, v in zip(miss_idx, new_vectors):
+                cached[i] = v
+
+        elapsed = time.perf_counter() - start
+        self.last_rate = len(texts) / elapsed if elapsed > 0 else 0.0
+        return [v.tolist() if hasattr(v, "tolist") else v for v in cached]
+
+    def _encode(self, texts):
+        model = get_sentence_transformer()
+        # Mỗi bước tiến độ xử lý vài batch một lúc
+        step = self.batch_size * max(1, self.num_workers) * 4
+        use_pool = self.num_workers > 1 and len(texts) > self.batch_size * 2
+
+        vectors = []
+        pool = None
+        start = time.perf_counter()
+        try:
+            if use_pool:
+                print(f"Khởi động pool {self.num_workers} tiến trình encode...")
+                pool = model.start_multi_process_pool(["cpu"] * self.num_workers)
+
+            for i in range(0, len(texts), step):
+                block = texts[i:i + step]
+                if pool is not None:
+                    encoded = model.encode_multi_process(
+                        block, pool,
+                        batch_size=self.batch_size,
+                        normalize_embeddings=True,
+                    )
+                else:
+                    encoded = model.encode(
+                        block,
+                        batch_size=self.batch_size,
+                        normalize_embeddings=True,
+                        convert_to_numpy=True,
+                        show_progress_bar=False,
+                    )
+                vectors.extend(v.tolist() for v in encoded)
+
+                elapsed = time.perf_counter() - start
+                rate = len(vectors) / elapsed if elapsed > 0 else 0.0
+                print(f"   Đã embed {len(vectors)}/{len(texts)} chunk ({rate:.1f} chunk/s)", flush=True)
+        finally:
+            if pool is not None:
+                model.stop_multi_process_pool(pool)
+
+        elapsed = time.perf_counter() - start
+        self.last_rate = len(vectors) / elapsed if elapsed > 0 else 0.0
+        return vectors
+
+
+def upsert_in_batches(vector_db, ids, docs, vectors, batch_size: int = DB_INSERT_BATCH_SIZE):
+    """Ghi vector đã tính sẵn vào Chroma theo từng khối lớn (bỏ qua bước embed của LangChain)"""
+    collection = vector_db._collection
+    for i in range(0, len(ids), batch_size):
+        j = i + batch_size
+        collection.upsert(
+            ids=ids[i:j],
+            embeddings=vectors[i:j],
+            documents=[d.page_content for d in docs[i:j]],
+            metadatas=[d.metadata for d in docs[i:j]],
+        )
@@ -0,0 +1,122 @@
+import os
+import json
+from typing import Any, List
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from src.doc_router import category_rows, filter_categories
+
+FLAT_INDEX_DIR_NAME = "flat_index"
+VECTORS_FILE = "vectors.npy"
+META_FILE = "meta.json"
+
+
+def get_flat_index_dir(db_path: str) -> str:
+    return os.path.join(db_path, FLAT_INDEX_DIR_NAME)
+
+
+def export_flat_index(vector_db, db_path: str):
+    """
+    Xuất toàn bộ collection Chroma ra index phẳng:
+    - vectors.npy: ma trận float32 đã chuẩn hóa (n x dim), các worker memory-map dùng chung.
+    - meta.json: id, nội dung và metadata của từng hàng.
+    Ghi ra file tạm rồi os.replace để worker đang đọc bản cũ không bị hỏng.
+    """
+    data = vector_db._collection.get(include=["embeddings", "documents", "metadatas"])
+    ids = list(data["ids"])
+    out_dir = get_flat_index_dir(db_path)
+    os.makedirs(out_dir, exist_ok=True)
+
+    if ids:
+        vectors = np.asarray(data["embeddings"], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.maximum(norms, 1e-12)
+    else:
+        # Collection rỗng: vẫn giữ đúng số chiều để phép nhân trong search không lỗi shape
+        embedding = getattr(vector_db, "embeddings", None)
+        dim = len(embedding.embed_query("lexibot")) if embedding is not None else 0
+        vectors = np.zeros((0, dim), dtype=np.float32)
+
+    vectors_path = os.path.join(out_dir, VECTORS_FILE)
+    with open(vectors_path + ".tmp", "wb") as f:
+        np.save(f, vectors)
+    os.replace(vectors_path + ".tmp", vectors_path)
+
+    meta_path = os.path.join(out_dir, META_FILE)
+    with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({
+            "ids": ids,
+            "documents": list(data["documents"]),
+            "metadatas": list(data["metadatas"]),
+        }, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(meta_path + ".tmp", meta_path)
+
+    print(f"Đã xuất index phẳng: {len(ids)} vector -> {out_dir}")
+
+
+class FlatVectorIndex:
+    """Index vector phẳng trong bộ nhớ: 1 phép nhân ma trận + argpartition cho top-k"""
+
+    def __init__(self, db_path: str):
+        index_dir = get_flat_index_dir(db_path)
+        vectors_path = os.path.join(index_dir, VECTORS_FILE)
+        if not os.path.exists(vectors_path):
+            raise RuntimeError("Chưa có flat_index, hãy chạy create_db.py trước")
+
+        # mmap_mode="r": các worker cùng đọc một bản trang nhớ của hệ điều hành
+        self.vectors = np.load(vectors_path, mmap_mode="r")
+        with open(os.path.join(index_dir, META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.ids = meta["ids"]
+        self.documents = meta["documents"]
+        self.metadatas = meta["metadatas"]
+        self._category_rows = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows_for(self, categories):
+        key = tuple(sorted(categories))
+        if key not in self._category_rows:
+            self._category_rows[key] = category_rows(self.metadatas, key)
+        return self._category_rows[key]
+
+    def search(self, query_vector, k: int = 5, categories=None):
+        """Trả về list (index hàng, điểm cosine) sắp xếp giảm dần; categories: chỉ tìm trong các nhóm tài liệu này"""
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        if not self.ids:
+            return []
+        if categories is None:
+            rows = None
+            scores = self.vectors @ query_vector
+        else:
+            rows = self.rows_for(categories)
+            scores = self.vectors[rows] @ query_vector
+        n = len(scores)
+        if n == 0:
+            return []
+        k = min(k, n)
+        if k < n:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(n)
+        top = top[np.argsort(-scores[top])]
+        if rows is None:
+            return [(int(i), float(scores[i])) for i in top]
+        return [(int(rows[i]), float(scores[i])) for i in top]
+
+    def get_document(self, row: int) -> Document:
+        return Document(page_content=self.documents[row], metadata=dict(self.metadatas[row] or {}))
+
+
+class FlatRetriever(BaseRetriever):
+    """Retriever LangChain dùng FlatVectorIndex thay cho Chroma"""
+
+    index: Any
+    embedding: Any
+    k: int = 5
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None, filter=None) -> List[Document]:
+        query_vector = self.embedding.embed_query(query)
+        hits = self.index.search(query_vector, self.k, categories=filter_categories(filter))
+        return [self.index.get_document(row) for row, _ in hits]
@@ -0,0 +1,247 @@
+"""
+Index từ khóa (BM25) cho tiếng Việt, build cùng Chroma trong create_db.py.
+- Tách theo âm tiết; mỗi âm tiết được index cả dạng có dấu lẫn không dấu ("học" + "hoc"),
+  thêm bigram không dấu ("hoc_phi") để khớp cụm từ nhiều âm tiết.
+- Số tiền/số thập phân được chuẩn hóa ("630.000" -> "630000", "2,5" -> "2.5").
+- Lưu dạng CSR (offsets/docs/tfs) trong postings.npz + vocab.json, nạp vào RAM rất nhanh.
+- HybridRetriever trộn kết quả BM25 và vector bằng Reciprocal Rank Fusion.
+"""
+import os
+import re
+import json
+import math
+import unicodedata
+from collections import Counter
+from typing import Any, List
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from src.doc_router import category_rows, filter_categories
+
+LEXICAL_INDEX_DIR_NAME = "lexical_index"
+POSTINGS_FILE = "postings.npz"
+VOCAB_FILE = "vocab.json"
+
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))   # số ứng viên lấy từ mỗi nhánh
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+HYBRID_DENSE_BACKEND = os.getenv("HYBRID_DENSE_BACKEND", "chroma")  # chroma | flat
+
+TOKEN_PATTERN = re.compile(r"\w+(?:[.,/]\w+)*")
+NUMBER_UNIT_PATTERN = re.compile(r"(\d[\d.,]*)([^\W\d_]+)")
+
+
+def get_lexical_index_dir(db_path: str) -> str:
+    return os.path.join(db_path, LEXICAL_INDEX_DIR_NAME)
+
+
+# =========================
+# TÁCH TỪ TIẾNG VIỆT
+# =========================
+def fold_diacritics(text: str) -> str:
+    """Bỏ dấu: "Học phí" -> "Hoc phi" """
+    text = unicodedata.normalize("NFD", text)
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    return text.replace("đ", "d").replace("Đ", "D")
+
+
+def _normalize_number(token: str) -> str:
+    if re.fullmatch(r"\d{1,3}(?:[.,]\d{3})+", token):
+        return re.sub(r"[.,]", "", token)
+    if re.fullmatch(r"\d+,\d+", token):
+        return token.replace(",", ".")
+    return token
+
+
+def tokenize(text: str):
+    """Âm tiết viết thường (giữ dấu), số đã chuẩn hóa, tách đơn vị dính liền số ("500k" -> "500", "k")"""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(unicodedata.normalize("NFC", text).lower()):
+        match = NUMBER_UNIT_PATTERN.fullmatch(token)
+        if match:
+            tokens.append(_normalize_number(match.group(1).rstrip(".,")))
+            tokens.append(match.group(2))
+        else:
+            tokens.append(_normalize_number(token))
+    return tokens
+
+
+def index_terms(text: str):
+    tokens = tokenize(text)
+    folded = [fold_diacritics(t) for t in tokens]
+    terms = list(tokens)
+    terms.extend(f for t, f in zip(tokens, folded) if f != t)
+    terms.extend(f"{a}_{b}" for a, b in zip(folded, folded[1:]))
+    return terms
+
+
+def query_terms(text: str):
+    """Âm tiết có dấu khớp đúng dạng có dấu; gõ không dấu thì khớp mọi dạng có dấu tương ứng"""
+    tokens = tokenize(text)
+    folded = [fold_diacritics(t) for t in tokens]
+    return tokens + [f"{a}_{b}" for a, b in zip(folded, folded[1:])]
+
+
+# =========================
+# BUILD & LƯU INDEX
+# =========================
+def export_lexical_index(vector_db, db_path: str):
+    """Build index BM25 từ toàn bộ collection Chroma (ghi file tạm rồi os.replace như flat_index)"""
+    data = vector_db._collection.get(include=["documents", "metadatas"])
+    ids = list(data["ids"])
+    vocab = {}
+    postings = []
+    doc_len = np.zeros(len(ids), dtype=np.int32)
+    for row, text in enumerate(data["documents"]):
+        counts = Counter(index_terms(text or ""))
+        doc_len[row] = sum(counts.values())
+        for term, tf in counts.items():
+            tid = vocab.setdefault(term, len(vocab))
+            if tid == len(postings):
+                postings.append([])
+            postings[tid].append((row, tf))
+
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(p) for p in postings])
+    docs = np.fromiter((row for p in postings for row, _ in p), dtype=np.int32, count=int(offsets[-1]))
+    tfs = np.fromiter((min(tf, 65535) for p in postings for _, tf in p), dtype=np.uint16, count=int(offsets[-1]))
+
+    out_dir = get_lexical_index_dir(db_path)
+    os.makedirs(out_dir, exist_ok=True)
+    postings_path = os.path.join(out_dir, POSTINGS_FILE)
+    with open(postings_path + ".tmp", "wb") as f:
+        np.savez(f, offsets=offsets, docs=docs, tfs=tfs, doc_len=doc_len)
+    os.replace(postings_path + ".tmp", postings_path)
+
+    vocab_path = os.path.join(out_dir, VOCAB_FILE)
+    with open(vocab_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({
+            "terms": list(vocab),
+            "ids": ids,
+            "categories": [(m or {}).get("category") for m in data["metadatas"]],
+        }, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(vocab_path + ".tmp", vocab_path)
+
+    print(f"Đã xuất index BM25: {len(ids)} chunk, {len(vocab)} term -> {out_dir}")
+
+
+# =========================
+# TRA CỨU
+# =========================
+class LexicalIndex:
+    """Index BM25 trong bộ nhớ, mỗi term tra được danh sách (chunk, tần suất) bằng offsets"""
+
+    def __init__(self, db_path: str, k1: float = BM25_K1, b: float = BM25_B):
+        index_dir = get_lexical_index_dir(db_path)
+        postings_path = os.path.join(index_dir, POSTINGS_FILE)
+        if not os.path.exists(postings_path):
+            raise RuntimeError("Chưa có lexical_index, hãy chạy create_db.py trước")
+
+        with np.load(postings_path) as data:
+            self.offsets = data["offsets"]
+            self.docs = data["docs"]
+            self.tfs = data["tfs"].astype(np.float32)
+            self.doc_len = data["doc_len"].astype(np.float32)
+        with open(os.path.join(index_dir, VOCAB_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.term_ids = {term: i for i, term in enumerate(meta["terms"])}
+        self.ids = meta["ids"]
+        # Index cũ chưa lưu category -> bỏ qua filter
+        self.metadatas = [{"category": c} for c in meta["categories"]] if "categories" in meta else None
+        self._category_masks = {}
+        self.k1 = k1
+        self.b = b
+        self.avgdl = float(self.doc_len.mean()) if len(self.doc_len) else 0.0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def mask_for(self, categories):
+        key = tuple(sorted(categories))
+        if key not in self._category_masks:
+            mask = np.zeros(len(self.ids), dtype=bool)
+            mask[category_rows(self.metadatas, key)] = True
+            self._category_masks[key] = mask
+        return self._category_masks[key]
+
+    def search(self, query: str, k: int = 5, categories=None):
+        """Trả về list (index hàng, điểm BM25) sắp xếp giảm dần, bỏ chunk điểm 0; categories: lọc theo nhóm tài liệu"""
+        n = len(self.ids)
+        if n == 0:
+            return []
+        scores = np.zeros(n, dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * self.doc_len / self.avgdl)
+        for term, qtf in Counter(query_terms(query)).items():
+            tid = self.term_ids.get(term)
+            if tid is None:
+                continue
+            start, end = self.offsets[tid], self.offsets[tid + 1]
+            rows = self.docs[start:end]
+            tf = self.tfs[start:end]
+            df = end - start
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            scores[rows] += qtf * idf * tf * (self.k1 + 1) / (tf + norm[rows])
+
+        if categories is not None and self.metadatas is not None:
+            scores[~self.mask_for(categories)] = 0
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits])]
+        return [(int(i), float(scores[i])) for i in hits]
+
+
+class DocumentStore:
+    """Lấy Document theo id chunk từ index phẳng (meta.json đã có nội dung + metadata)"""
+
+    def __init__(self, flat_index):
+        self.flat_index = flat_index
+        self.rows = {cid: row for row, cid in enumerate(flat_index.ids)}
+
+    def get(self, chunk_id):
+        row = self.rows.get(chunk_id)
+        return None if row is None else self.flat_index.get_document(row)
+
+
+def reciprocal_rank_fusion(result_lists, k: int, rrf_k: int = HYBRID_RRF_K):
+    """Trộn nhiều danh sách xếp hạng: điểm = tổng 1/(rrf_k + hạng)"""
+    scores = {}
+    docs = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results, start=1):
+            key = (doc.metadata.get("source"), doc.page_content)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+            docs.setdefault(key, doc)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [docs[key] for key in ranked[:k]]
+
+
+class LexicalRetriever(BaseRetriever):
+    """Retriever chỉ dùng BM25 (không cần embed câu hỏi)"""
+
+    index: Any
+    store: Any
+    k: int = 5
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None, filter=None) -> List[Document]:
+        hits = self.index.search(query, self.k, categories=filter_categories(filter))
+        docs = (self.store.get(self.index.ids[row]) for row, _ in hits)
+        return [d for d in docs if d is not None]
+
+
+class HybridRetriever(BaseRetriever):
+    """Lấy HYBRID_CANDIDATES ứng viên từ vector + BM25 rồi trộn bằng RRF, giữ top k"""
+
+    dense: Any
+    lexical: Any
+    k: int = 5
+    rrf_k: int = HYBRID_RRF_K
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None, **kwargs) -> List[Document]:
+        dense_docs = self.dense.invoke(query, **kwargs)
+        return reciprocal_rank_fusion([dense_docs, self.lexical.invoke(query, **kwargs)], self.k, self.rrf_k)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager=None, **kwargs) -> List[Document]:
+        dense_docs = await self.dense.ainvoke(query, **kwargs)
+        return reciprocal_rank_fusion([dense_docs, self.lexical.invoke(query, **kwargs)], self.k, self.rrf_k)
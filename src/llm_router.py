@@ -0,0 +1,439 @@
+"""
+Định tuyến LLM giữa nhiều provider (gemini, groq) thay vì gắn cứng một client theo lựa chọn của người dùng.
+- Mỗi provider có số liệu cuốn chiếu (LLM_ROUTER_WINDOW lần gọi gần nhất): thời gian tới token đầu tiên, tỉ lệ lỗi.
+- Circuit breaker: tỉ lệ lỗi >= LLM_BREAKER_ERROR_RATE -> mở, bỏ qua provider đó LLM_BREAKER_COOLDOWN giây,
+  sau đó cho một request thăm dò (half_open): thành công thì đóng lại, lỗi thì mở tiếp.
+- Failover: provider lỗi trước khi có token đầu tiên -> chuyển sang provider dự phòng (LLM_FALLBACKS).
+- Hedge (LLM_HEDGE=1): chưa có token đầu tiên sau phân vị LLM_HEDGE_PERCENTILE thời gian tới token đầu của
+  provider đó -> gửi thêm request tới provider dự phòng, bên nào có token trước thì dùng, bên kia bị hủy.
+LLM_ROUTING=0 -> get_llm trả về client của đúng provider như cũ.
+"""
+import os
+import time
+import queue
+import asyncio
+import threading
+from collections import deque
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream, agenerate_from_stream
+from langchain_core.outputs import ChatGenerationChunk
+from src.models import get_provider_llm
+from src import metrics
+
+LLM_ROUTING = os.getenv("LLM_ROUTING", "1") != "0"
+LLM_FALLBACKS = os.getenv("LLM_FALLBACKS", "gemini:groq,groq:gemini")   # provider:dự phòng, cách nhau bởi dấu phẩy
+LLM_ROUTER_WINDOW = int(os.getenv("LLM_ROUTER_WINDOW", "100"))
+LLM_BREAKER_MIN_REQUESTS = int(os.getenv("LLM_BREAKER_MIN_REQUESTS", "5"))
+LLM_BREAKER_ERROR_RATE = float(os.getenv("LLM_BREAKER_ERROR_RATE", "0.5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))      # giây
+# Hedge gửi thêm request (tốn thêm quota) -> mặc định tắt
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") != "0"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "3"))  # giây, khi chưa đủ số liệu
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5"))
+LLM_HEDGE_MAX_DELAY = float(os.getenv("LLM_HEDGE_MAX_DELAY", "8"))
+
+
+def parse_fallbacks(spec: str):
+    """ "gemini:groq,groq:gemini" -> {"gemini": ["groq"], "groq": ["gemini"]} """
+    fallbacks = {}
+    for pair in spec.split(","):
+        if ":" not in pair:
+            continue
+        name, backup = (p.strip() for p in pair.split(":", 1))
+        if name and backup and backup != name:
+            fallbacks.setdefault(name, []).append(backup)
+    return fallbacks
+
+
+# =========================
+# SỐ LIỆU + CIRCUIT BREAKER
+# =========================
+class ProviderStats:
+    """Số liệu cuốn chiếu của một provider, breaker: closed -> open -> half_open -> closed/open"""
+
+    def __init__(self, name, window: int = LLM_ROUTER_WINDOW):
+        self.name = name
+        self.outcomes = deque(maxlen=window)   # True = thành công
+        self.ttfts = deque(maxlen=window)      # giây tới token đầu tiên
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def ttft_percentile(self, p: float):
+        with self._lock:
+            values = sorted(self.ttfts)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+    def acquire(self) -> bool:
+        """Có được gửi request tới provider này không (half_open chỉ cho một request thăm dò)"""
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < LLM_BREAKER_COOLDOWN:
+                    return False
+                self.state = "half_open"
+                self.probing = False
+            if self.state == "half_open":
+                if self.probing:
+                    return False
+                self.probing = True
+            return True
+
+    def record_ttft(self, seconds: float):
+        with self._lock:
+            self.ttfts.append(seconds)
+        metrics.observe("lexibot_llm_ttft_seconds", seconds, {"provider": self.name})
+
+    def record_success(self):
+        with self._lock:
+            self.outcomes.append(True)
+            closed = self.state != "closed"
+            if closed:
+                self.state = "closed"
+                self.probing = False
+                self.outcomes.clear()   # bắt đầu lại, không để lỗi cũ mở breaker ngay
+        metrics.inc("lexibot_llm_requests_total", {"provider": self.name, "outcome": "ok"})
+        if closed:
+            print(f"[LLM] {self.name}: đóng circuit breaker", flush=True)
+
+    def record_failure(self, error):
+        with self._lock:
+            self.outcomes.append(False)
+            opened = self.state == "half_open" or (
+                self.state == "closed" and len(self.outcomes) >= LLM_BREAKER_MIN_REQUESTS
+                and self.error_rate() >= LLM_BREAKER_ERROR_RATE)
+            if opened:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.probing = False
+        metrics.inc("lexibot_llm_requests_total", {"provider": self.name, "outcome": "error"})
+        if opened:
+            metrics.inc("lexibot_llm_circuit_opened_total", {"provider": self.name})
+            print(f"[LLM] {self.name}: mở circuit breaker {LLM_BREAKER_COOLDOWN:.0f}s "
+                  f"({type(error).__name__}: {error})", flush=True)
+
+    def record_cancel(self):
+        """Request bị hủy (thua hedge, client ngắt): không tính thành công hay lỗi"""
+        with self._lock:
+            self.probing = False
+        metrics.inc("lexibot_llm_requests_total", {"provider": self.name, "outcome": "cancelled"})
+
+
+# =========================
+# ROUTER
+# =========================
+class LLMRouter:
+    """Chọn provider cho từng lần gọi; số liệu dùng chung cho mọi chain trong worker"""
+
+    def __init__(self, fallbacks=None, hedge: bool = LLM_HEDGE):
+        self.fallbacks = parse_fallbacks(LLM_FALLBACKS) if fallbacks is None else fallbacks
+        self.hedge = hedge
+        self._stats = {}
+        self._unavailable = set()
+        self._lock = threading.Lock()
+
+    def stats(self, name) -> ProviderStats:
+        stats = self._stats.get(name)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(name, ProviderStats(name))
+        return stats
+
+    def _available(self, name) -> bool:
+        if name in self._unavailable:
+            return False
+        try:
+            get_provider_llm(name)
+            return True
+        except ValueError as e:
+            self._unavailable.add(name)
+            print(f"[LLM] Bỏ provider dự phòng {name}: {e}", flush=True)
+            return False
+
+    def providers(self, requested):
+        """Thứ tự thử: provider được chọn, rồi các provider dự phòng có cấu hình (bỏ provider thiếu API key)"""
+        order = [requested]
+        for name in self.fallbacks.get(requested, []):
+            if name not in order and self._available(name):
+                order.append(name)
+        return order
+
+    def _attempts(self, requested):
+        """Lần lượt các provider được phép gửi request (lấy dần: chỉ chiếm lượt thăm dò khi thật sự gửi)"""
+        acquired = False
+        for name in self.providers(requested):
+            if self.stats(name).acquire():
+                acquired = True
+                yield name
+            else:
+                metrics.inc("lexibot_llm_requests_total", {"provider": name, "outcome": "rejected"})
+        if not acquired:
+            # Mọi provider đều đang mở breaker -> vẫn thử provider được chọn thay vì báo lỗi ngay
+            yield requested
+
+    def hedge_delay(self, name) -> float:
+        """
+        Phân vị LLM_HEDGE_PERCENTILE thời gian tới token đầu của provider này hoặc provider dự phòng, lấy bên nhanh hơn:
+        provider chính chậm hẳn đi thì phân vị của chính nó cũng tăng theo, hedge sẽ không còn tác dụng.
+        """
+        delays = [self.stats(n).ttft_percentile(LLM_HEDGE_PERCENTILE) for n in [name] + self.fallbacks.get(name, [])
+                  if len(self.stats(n).ttfts) >= LLM_HEDGE_MIN_SAMPLES]
+        if not delays:
+            return LLM_HEDGE_DEFAULT_DELAY
+        return min(max(min(delays), LLM_HEDGE_MIN_DELAY), LLM_HEDGE_MAX_DELAY)
+
+    def _hedge_timeout(self, started, hedge_done):
+        """Số giây còn chờ trước khi hedge (None = không hedge nữa: đã hedge hoặc đã thử mà không còn provider)"""
+        if not self.hedge or hedge_done or len(started) != 1:
+            return None
+        (name, t0), = started.items()
+        return max(0.0, t0 + self.hedge_delay(name) - time.perf_counter())
+
+    # ----- sync -----
+    def _pump(self, name, messages, kwargs, events, stop):
+        """Chạy trong thread riêng: đẩy chunk của một provider vào events, dừng khi stop được bật"""
+        stats = self.stats(name)
+        start = time.perf_counter()
+        head = []   # chunk rỗng đầu stream (chỉ có role) chưa tính là token đầu tiên
+        stream = None
+        try:
+            stream = get_provider_llm(name).stream(messages, **kwargs)
+            for chunk in stream:
+                if head is not None and chunk.content:
+                    stats.record_ttft(time.perf_counter() - start)
+                if stop.is_set():
+                    stats.record_cancel()
+                    return
+                if head is not None and not chunk.content:
+                    head.append(chunk)
+                    continue
+                for c in (head or []) + [chunk]:
+                    events.put((name, "chunk", c))
+                head = None
+            stats.record_success()
+            for c in head or []:
+                events.put((name, "chunk", c))
+            events.put((name, "end", None))
+        except Exception as e:
+            stats.record_failure(e)
+            events.put((name, "error", e))
+        finally:
+            if stream is not None:
+                stream.close()
+
+    def stream(self, requested, messages, **kwargs):
+        """Stream AIMessageChunk của provider có token đầu tiên sớm nhất"""
+        attempts = self._attempts(requested)
+        events = queue.Queue()
+        running = {}   # name -> Event dừng
+        started = {}   # name -> thời điểm gửi, chỉ tính khi chưa chọn được provider
+
+        def launch():
+            name = next(attempts, None)
+            if name is not None:
+                running[name] = threading.Event()
+                started[name] = time.perf_counter()
+                threading.Thread(target=self._pump, args=(name, messages, kwargs, events, running[name]),
+                                 name=f"llm-{name}", daemon=True).start()
+            return name
+
+        launch()
+        winner = hedged = None
+        hedge_done = False
+        try:
+            while True:
+                timeout = self._hedge_timeout(started, hedge_done) if winner is None else None
+                try:
+                    name, kind, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    hedge_done = True   # chỉ thử hedge một lần, kể cả khi không còn provider để gửi
+                    hedged = launch()
+                    if hedged:
+                        metrics.inc("lexibot_llm_hedges_total", {"provider": hedged, "result": "sent"})
+                    continue
+                if name not in running:
+                    continue   # provider đã bị hủy
+                if kind == "error":
+                    del running[name]
+                    started.pop(name, None)
+                    if winner is not None:
+                        raise payload
+                    if not running and launch() is None:
+                        raise payload
+                    metrics.inc("lexibot_llm_failovers_total", {"provider": name})
+                    continue
+                if winner is None:
+                    winner = name
+                    started.clear()
+                    for other in [n for n in running if n != winner]:
+                        running.pop(other).set()
+                    if hedged:
+                        metrics.inc("lexibot_llm_hedges_total",
+                                    {"provider": hedged, "result": "won" if winner == hedged else "lost"})
+                if kind == "end":
+                    return
+                yield payload
+        finally:
+            for stop in running.values():
+                stop.set()
+
+    # ----- async -----
+    async def _apump(self, name, messages, kwargs, events):
+        stats = self.stats(name)
+        start = time.perf_counter()
+        head = []
+        try:
+            async for chunk in get_provider_llm(name).astream(messages, **kwargs):
+                if head is not None and not chunk.content:
+                    head.append(chunk)
+                    continue
+                if head is not None:
+                    stats.record_ttft(time.perf_counter() - start)
+                for c in (head or []) + [chunk]:
+                    events.put_nowait((name, "chunk", c))
+                head = None
+            stats.record_success()
+            for c in head or []:
+                events.put_nowait((name, "chunk", c))
+            events.put_nowait((name, "end", None))
+        except asyncio.CancelledError:
+            stats.record_cancel()
+            raise
+        except Exception as e:
+            stats.record_failure(e)
+            events.put_nowait((name, "error", e))
+
+    async def astream(self, requested, messages, **kwargs):
+        """Bản async của stream: mỗi provider là một task, provider thua bị cancel (đóng luôn kết nối HTTP)"""
+        attempts = self._attempts(requested)
+        events = asyncio.Queue()
+        running = {}   # name -> task
+        started = {}
+
+        def launch():
+            name = next(attempts, None)
+            if name is not None:
+                running[name] = asyncio.ensure_future(self._apump(name, messages, kwargs, events))
+                started[name] = time.perf_counter()
+            return name
+
+        launch()
+        winner = hedged = None
+        hedge_done = False
+        try:
+            while True:
+                timeout = self._hedge_timeout(started, hedge_done) if winner is None else None
+                try:
+                    name, kind, payload = await asyncio.wait_for(events.get(), timeout)
+                except asyncio.TimeoutError:
+                    hedge_done = True   # chỉ thử hedge một lần, kể cả khi không còn provider để gửi
+                    hedged = launch()
+                    if hedged:
+                        metrics.inc("lexibot_llm_hedges_total", {"provider": hedged, "result": "sent"})
+                    continue
+                if name not in running:
+                    continue
+                if kind == "error":
+                    del running[name]
+                    started.pop(name, None)
+                    if winner is not None:
+                        raise payload
+                    if not running and launch() is None:
+                        raise payload
+                    metrics.inc("lexibot_llm_failovers_total", {"provider": name})
+                    continue
+                if winner is None:
+                    winner = name
+                    started.clear()
+                    for other in [n for n in running if n != winner]:
+                        running.pop(other).cancel()
+                    if hedged:
+                        metrics.inc("lexibot_llm_hedges_total",
+                                    {"provider": hedged, "result": "won" if winner == hedged else "lost"})
+                if kind == "end":
+                    return
+                yield payload
+        finally:
+            for task in running.values():
+                task.cancel()
+
+    def circuit_states(self):
+        """Gauge: mỗi provider một dòng, label state = closed | open | half_open"""
+        return [({"provider": name, "state": stats.state}, 1) for name, stats in list(self._stats.items())]
+
+
+# =========================
+# CHAT MODEL CHO CHAIN
+# =========================
+class RoutedChatModel(BaseChatModel):
+    """Chat model LangChain: prompt | llm như cũ, mỗi lần gọi được router chọn provider"""
+
+    provider: str
+
+    @property
+    def _llm_type(self) -> str:
+        return "lexibot-routed"
+
+    @property
+    def _identifying_params(self):
+        return {"provider": self.provider}
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        for chunk in get_router().stream(self.provider, messages, stop=stop, **kwargs):
+            generation = ChatGenerationChunk(message=chunk)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.content, chunk=generation)
+            yield generation
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        async for chunk in get_router().astream(self.provider, messages, stop=stop, **kwargs):
+            generation = ChatGenerationChunk(message=chunk)
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.content, chunk=generation)
+            yield generation
+
+    # invoke cũng đi qua stream để đo được token đầu tiên và hedge/failover như nhau
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def _reset_router_after_fork():
+    """Worker mới bắt đầu với router (số liệu, breaker, lock) của riêng nó"""
+    global _router, _router_lock
+    _router = None
+    _router_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_router_after_fork)
+
+
+def get_router() -> LLMRouter:
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = LLMRouter()
+                metrics.register_gauge("lexibot_llm_circuit_state",
+                                       "Trạng thái circuit breaker của từng provider LLM", _router.circuit_states)
+    return _router
+
+
+def get_routed_llm(model_provider: str):
+    """LLM cho chain; lỗi cấu hình của provider được chọn (thiếu API key...) vẫn báo ngay như trước"""
+    llm = get_provider_llm(model_provider)
+    if not LLM_ROUTING:
+        return llm
+    return RoutedChatModel(provider=model_provider)
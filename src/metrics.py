@@ -0,0 +1,165 @@
+"""
+Đo thời gian từng bước (rewrite, retrieve, answer, render, lưu Mongo...) và các bộ đếm.
+- Histogram/counter dạng Prometheus, xuất ở /metrics (mỗi worker một bộ số liệu riêng).
+- Thời gian từng bước của request hiện tại, dùng cho header Server-Timing.
+"""
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_counters = {}      # name -> {labels_tuple: value}
+_histograms = {}    # name -> {labels_tuple: [bucket_counts, sum, count]}
+_gauge_callbacks = {}
+_help = {}
+
+# Dict thời gian các bước của request hiện tại (mutable để các context copy của LangChain vẫn ghi được)
+_request_timings = contextvars.ContextVar("lexibot_request_timings", default=None)
+
+
+def _labels_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def describe(name, help_text):
+    _help[name] = help_text
+
+
+def inc(name, labels=None, value=1):
+    key = _labels_key(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+
+def observe(name, seconds, labels=None, buckets=STAGE_BUCKETS):
+    key = _labels_key(labels)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        entry = series.get(key)
+        if entry is None:
+            entry = series[key] = [[0] * len(buckets), 0.0, 0, buckets]
+        for i, bound in enumerate(buckets):
+            if seconds <= bound:
+                entry[0][i] += 1
+        entry[1] += seconds
+        entry[2] += 1
+
+
+def register_gauge(name, help_text, callback):
+    """callback() trả về list (labels_dict, value) hoặc một số; được gọi mỗi lần xuất /metrics"""
+    _help[name] = help_text
+    _gauge_callbacks[name] = callback
+
+
+# =========================
+# THỜI GIAN TỪNG BƯỚC
+# =========================
+def start_request():
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def request_timings():
+    return _request_timings.get() or {}
+
+
+def record_stage(stage, seconds):
+    observe("lexibot_stage_duration_seconds", seconds, {"stage": stage})
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage):
+    """Đo một bước, lỗi (Exception) của bước đó được đếm vào lexibot_stage_errors_total"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc("lexibot_stage_errors_total", {"stage": stage})
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def server_timing_header(timings=None):
+    timings = request_timings() if timings is None else timings
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+# =========================
+# XUẤT PROMETHEUS
+# =========================
+def _fmt_labels(key, extra=None):
+    items = list(key) + (extra or [])
+    if not items:
+        return ""
+    body = ",".join(f'{k}="{str(v)}"' for k, v in items)
+    return "{" + body + "}"
+
+
+def render_prometheus():
+    lines = []
+    with _lock:
+        for name, series in sorted(_counters.items()):
+            lines.append(f"# HELP {name} {_help.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in series.items():
+                lines.append(f"{name}{_fmt_labels(key)} {value}")
+
+        for name, series in sorted(_histograms.items()):
+            lines.append(f"# HELP {name} {_help.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, (counts, total, count, buckets) in series.items():
+                for bound, c in zip(buckets, counts):
+                    lines.append(f"{name}_bucket{_fmt_labels(key, [('le', bound)])} {c}")
+                lines.append(f"{name}_bucket{_fmt_labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{_fmt_labels(key)} {total}")
+                lines.append(f"{name}_count{_fmt_labels(key)} {count}")
+
+    for name, callback in sorted(_gauge_callbacks.items()):
+        try:
+            values = callback()
+        except Exception:
+            continue
+        lines.append(f"# HELP {name} {_help.get(name, name)}")
+        lines.append(f"# TYPE {name} gauge")
+        if isinstance(values, list):
+            for labels, value in values:
+                lines.append(f"{name}{_fmt_labels(_labels_key(labels))} {value}")
+        else:
+            lines.append(f"{name} {values}")
+    return "\n".join(lines) + "\n"
+
+
+describe("lexibot_stage_duration_seconds", "Thời gian từng bước của pipeline hỏi-đáp")
+describe("lexibot_stage_errors_total", "Số lỗi theo từng bước")
+describe("lexibot_cache_requests_total", "Số lần tra cache theo kết quả hit/miss")
+describe("lexibot_http_requests_total", "Số request HTTP theo route và status")
+describe("lexibot_http_request_duration_seconds", "Thời gian xử lý request HTTP")
+describe("lexibot_answer_ttft_seconds", "Thời gian tới token đầu tiên của câu trả lời")
+describe("lexibot_rewrite_decisions_total", "Số lần gọi/bỏ qua bước viết lại câu hỏi, theo lý do")
+describe("lexibot_speculative_retrieval_total", "Retrieval chạy trước cho câu hỏi gốc: dùng lại hay bỏ")
+describe("lexibot_context_tokens_total", "Số token context ước lượng trước (raw) và sau khi ghép (packed)")
+describe("lexibot_xref_chunks_total", "Số chunk được thêm vào context nhờ index dẫn chiếu Điều/khoản")
+describe("lexibot_rerank_chunks_total", "Số chunk ứng viên đưa vào reranker và số chunk được giữ lại")
+describe("lexibot_history_window_messages", "Số tin nhắn lịch sử được gửi nguyên văn mỗi câu hỏi")
+describe("lexibot_history_summarized_messages_total", "Số tin nhắn cũ đã được gộp vào bản tóm tắt hội thoại")
+describe("lexibot_route_decisions_total", "Định tuyến câu hỏi theo nhóm tài liệu, theo lý do (keyword/centroid/fallback)")
+describe("lexibot_persist_writes_total", "Số thao tác ghi Mongo/file đã ghi xong qua hàng đợi ghi nền, theo loại")
+describe("lexibot_persist_fallback_total", "Số thao tác ghi lỗi phải chuyển sang file dự phòng")
+describe("lexibot_persist_sync_writes_total", "Số thao tác phải ghi đồng bộ vì hàng đợi ghi nền đầy")
+describe("lexibot_persist_batch_size", "Số thao tác mỗi lần flush của hàng đợi ghi nền")
+describe("lexibot_single_flight_requests_total", "Câu hỏi đầu tiên được gộp: leader chạy pipeline, follower dùng chung kết quả")
+describe("lexibot_llm_calls_saved_total", "Số lần gọi LLM tiết kiệm được nhờ gộp các câu hỏi giống hệt nhau đang chạy")
+describe("lexibot_llm_requests_total", "Số lần gọi từng provider LLM theo kết quả (ok/error/cancelled/rejected bởi circuit breaker)")
+describe("lexibot_llm_ttft_seconds", "Thời gian tới token đầu tiên của từng provider LLM")
+describe("lexibot_llm_failovers_total", "Số lần chuyển sang provider dự phòng vì provider lỗi trước token đầu tiên")
+describe("lexibot_llm_hedges_total", "Request hedge gửi tới provider dự phòng: sent/won/lost")
+describe("lexibot_llm_circuit_opened_total", "Số lần circuit breaker của provider LLM mở")
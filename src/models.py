@@ -1,53 +1,195 @@
 import os
+import threading
+import httpx
 from dotenv import load_dotenv
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_openai import ChatOpenAI
 from langchain_google_genai import ChatGoogleGenerativeAI
+from src.embedding_cache import CachedEmbeddings, get_embedding_cache, EMBED_CACHE_ENABLED
 
 load_dotenv()
 
+EMBEDDING_MODEL_NAME = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2" # Hoặc "intfloat/multilingual-e5-base"
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")  # torch | torch-int8 | onnx | onnx-int8
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "./models/paraphrase-multilingual-mpnet-base-v2-onnx")
+ONNX_QUANT_CONFIG = os.getenv("ONNX_QUANT_CONFIG", "avx2")  # arm64 | avx2 | avx512 | avx512_vnni
+# Ghi đè được để trỏ provider groq tới server tương thích OpenAI khác (vd. stub LLM khi load test)
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL", "https://api.groq.com/openai/v1")
+# Đặt thì gọi Gemini qua API tương thích OpenAI (https://generativelanguage.googleapis.com/v1beta/openai/ hoặc stub LLM)
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "")
+GEMINI_MODEL = "gemini-2.5-flash-preview-09-2025"
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))              # giây
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "1"))          # lỗi tiếp theo do router chuyển provider
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+
+_base_embedding_model = None
 _embedding_model_instance = None
+_llm_clients = {}
+_http_clients = None
+_llm_lock = threading.Lock()
+
+def _reset_llm_clients_after_fork():
+    """gunicorn --preload: client LLM/httpx (kết nối, lock) tạo ở master không dùng được sau fork -> tạo lại trong worker"""
+    global _http_clients, _llm_lock
+    _llm_clients.clear()
+    _http_clients = None
+    _llm_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_llm_clients_after_fork)
+
+def embedding_model_id(backend: str = EMBEDDING_BACKEND):
+    """Định danh model + backend (dùng làm key cache và chữ ký manifest), backend mặc định giữ tên cũ"""
+    if backend == "torch":
+        return EMBEDDING_MODEL_NAME
+    if backend == "onnx-int8":
+        # Mỗi cấu hình lượng tử hóa cho vector khác nhau -> cache/index riêng
+        return f"{EMBEDDING_MODEL_NAME}@{backend}-{ONNX_QUANT_CONFIG}"
+    return f"{EMBEDDING_MODEL_NAME}@{backend}"
+
+def _export_quantized_onnx():
+    """Xuất model sang ONNX + lượng tử hóa int8 động (chỉ làm 1 lần, lưu ở ONNX_MODEL_DIR)"""
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    file_name = f"onnx/model_qint8_{ONNX_QUANT_CONFIG}.onnx"
+    if not os.path.exists(os.path.join(ONNX_MODEL_DIR, file_name)):
+        print(f"Đang xuất model ONNX int8 ({ONNX_QUANT_CONFIG}) vào {ONNX_MODEL_DIR}...")
+        model = SentenceTransformer(EMBEDDING_MODEL_NAME, device="cpu", backend="onnx")
+        model.save(ONNX_MODEL_DIR)
+        export_dynamic_quantized_onnx_model(model, ONNX_QUANT_CONFIG, ONNX_MODEL_DIR)
+    return file_name
+
+def create_embedding_model(backend: str = EMBEDDING_BACKEND):
+    """
+    Tạo model embedding theo backend:
+    - "torch": PyTorch float32 (mặc định)
+    - "torch-int8": PyTorch, lượng tử hóa động int8 các lớp Linear
+    - "onnx" / "onnx-int8": ONNX Runtime (cần cài thêm optimum[onnxruntime])
+    """
+    encode_kwargs = {"normalize_embeddings": True}
+    if backend == "torch":
+        return HuggingFaceEmbeddings(
+            model_name=EMBEDDING_MODEL_NAME,
+            model_kwargs={"device": "cpu"},
+            encode_kwargs=encode_kwargs
+        )
+    if backend == "torch-int8":
+        import torch
+        embedding = create_embedding_model("torch")
+        embedding._client = torch.ao.quantization.quantize_dynamic(
+            embedding._client, {torch.nn.Linear}, dtype=torch.qint8
+        )
+        return embedding
+    if backend == "onnx":
+        return HuggingFaceEmbeddings(
+            model_name=EMBEDDING_MODEL_NAME,
+            model_kwargs={"device": "cpu", "backend": "onnx"},
+            encode_kwargs=encode_kwargs
+        )
+    if backend == "onnx-int8":
+        file_name = _export_quantized_onnx()
+        return HuggingFaceEmbeddings(
+            model_name=ONNX_MODEL_DIR,
+            model_kwargs={"device": "cpu", "backend": "onnx", "model_kwargs": {"file_name": file_name}},
+            encode_kwargs=encode_kwargs
+        )
+    raise ValueError(f"Embedding backend không hợp lệ: {backend}")
+
+def _load_base_embedding_model():
+    global _base_embedding_model
+    if _base_embedding_model is not None:
+        return _base_embedding_model
+
+    print(f"Đang tải model Embedding (backend: {EMBEDDING_BACKEND})...")
+    _base_embedding_model = create_embedding_model(EMBEDDING_BACKEND)
+    print("Embedding model ready!")
+    return _base_embedding_model
 
 def get_embedding_model():
+    """Model embedding dùng chung, bọc thêm cache trên đĩa nếu EMBED_CACHE bật"""
     global _embedding_model_instance
     if _embedding_model_instance is not None:
         return _embedding_model_instance
-    
-    print("Đang tải model Embedding...")
-    _embedding_model_instance = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/paraphrase-multilingual-mpnet-base-v2", # Hoặc "intfloat/multilingual-e5-base"
-        model_kwargs={"device": "cpu"},
-        encode_kwargs={"normalize_embeddings": True}
-    )
-    print("Embedding model ready!")
+
+    base = _load_base_embedding_model()
+    if EMBED_CACHE_ENABLED:
+        _embedding_model_instance = CachedEmbeddings(base, get_embedding_cache(), embedding_model_id())
+    else:
+        _embedding_model_instance = base
     return _embedding_model_instance
 
-def get_llm(model_provider: str = "gemini"):
+def get_sentence_transformer():
+    """Lấy SentenceTransformer gốc bên trong HuggingFaceEmbeddings (dùng cho encode theo batch/pool)"""
+    embedding = _load_base_embedding_model()
+    client = getattr(embedding, "_client", None) or getattr(embedding, "client", None)
+    if client is None:
+        raise RuntimeError("Không lấy được SentenceTransformer từ embedding model")
+    return client
+
+def warm_up_embedding_model():
+    """Encode thử một câu để nạp trọng số và khởi tạo kernel (bỏ qua cache để chắc chắn chạy transformer)"""
+    get_sentence_transformer().encode(["LexiBot khởi động: học phí, học bổng, quy chế đào tạo"], normalize_embeddings=True)
+
+def get_http_clients():
+    """(httpx.Client, httpx.AsyncClient) dùng chung cho mọi client LLM tương thích OpenAI -> giữ kết nối keep-alive"""
+    global _http_clients
+    if _http_clients is None:
+        limits = httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS)
+        _http_clients = (httpx.Client(limits=limits, timeout=LLM_TIMEOUT),
+                         httpx.AsyncClient(limits=limits, timeout=LLM_TIMEOUT))
+    return _http_clients
+
+def _openai_compatible_llm(base_url, api_key, model):
+    http_client, http_async_client = get_http_clients()
+    return ChatOpenAI(
+        base_url=base_url,
+        api_key=api_key,
+        model=model,
+        temperature=0.3,
+        max_tokens=2048,
+        timeout=LLM_TIMEOUT,
+        max_retries=LLM_MAX_RETRIES,
+        http_client=http_client,
+        http_async_client=http_async_client,
+    )
+
+def create_llm(model_provider: str = "gemini"):
     # Gemini
     if model_provider == "gemini":
         api_key = os.getenv("GEMINI_API_KEY_2")
         if not api_key:
             raise ValueError("Không tìm thấy GOOGLE_API_KEY")
+        if GEMINI_BASE_URL:
+            return _openai_compatible_llm(GEMINI_BASE_URL, api_key, GEMINI_MODEL)
 
         return ChatGoogleGenerativeAI(
-            model="gemini-2.5-flash-preview-09-2025",
+            model=GEMINI_MODEL,
             google_api_key=api_key,
             temperature=0.3,
             max_output_tokens=2048,
+            timeout=LLM_TIMEOUT,
+            max_retries=LLM_MAX_RETRIES,
         )
     # Dùng Groq 
     elif model_provider == "groq":
         api_key = os.getenv("GROQ_API_KEY")
         if not api_key:
             raise ValueError("Không tìm thấy GROQ_API_KEY!\n")
-    
-        return ChatOpenAI(
-            base_url="https://api.groq.com/openai/v1",
-            api_key=api_key,
-            model="llama-3.3-70b-versatile", # Hoặc "llama-3.1-8b-instant"
-            temperature=0.3,
-            max_tokens=2048,
-            timeout=60,  # Tăng timeout
-        )
+
+        return _openai_compatible_llm(GROQ_BASE_URL, api_key, "llama-3.3-70b-versatile") # Hoặc "llama-3.1-8b-instant"
     else:
-        raise ValueError(f"Model provider không hợp lệ: {model_provider}")
\ No newline at end of file
+        raise ValueError(f"Model provider không hợp lệ: {model_provider}")
+
+def get_provider_llm(model_provider: str = "gemini"):
+    """Client LLM của một provider, tạo 1 lần và dùng chung cho mọi chain (không dựng lại kết nối mỗi chain)"""
+    llm = _llm_clients.get(model_provider)
+    if llm is None:
+        with _llm_lock:
+            llm = _llm_clients.get(model_provider)
+            if llm is None:
+                llm = _llm_clients[model_provider] = create_llm(model_provider)
+    return llm
+
+def get_llm(model_provider: str = "gemini"):
+    """LLM cho chain: qua router (failover, circuit breaker, hedge) trừ khi LLM_ROUTING=0"""
+    from src.llm_router import get_routed_llm
+    return get_routed_llm(model_provider)
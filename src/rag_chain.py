@@ -1,12 +1,34 @@
 import os
+import time
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from langchain_community.vectorstores import Chroma
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.messages import HumanMessage, AIMessage
-from langchain_core.runnables import RunnableLambda
+from langchain_core.runnables import RunnableLambda, RunnableGenerator
+from langchain_core.runnables.utils import AddableDict
 from src.models import get_embedding_model, get_llm 
+from src.answer_cache import get_answer_cache, ANSWER_CACHE_ENABLED
+from src.flat_index import FlatVectorIndex, FlatRetriever
+from src.lexical_index import (
+    LexicalIndex, LexicalRetriever, HybridRetriever, DocumentStore, HYBRID_CANDIDATES, HYBRID_DENSE_BACKEND
+)
+from src.context_packer import (
+    pack_context, format_block, source_header, get_context_budget, CONTEXT_PACKING_ENABLED
+)
+from src.xref_index import load_xref_index
+from src.doc_router import DocRouter, RoutedRetriever, DOC_ROUTING_ENABLED
+from src.reranker import get_reranker, RERANK_CANDIDATES
+from src.single_flight import get_single_flight, coalesce_key
+from src.rewrite_gate import rewrite_decision, last_user_question, cosine, same_question, SPECULATIVE_RETRIEVAL
+from src import metrics
 
 
 DB_PATH = "./chroma_db"
+RETRIEVER_BACKEND = os.getenv("RETRIEVER_BACKEND", "chroma")  # chroma | flat | bm25 | hybrid
+# finish_reason của câu trả lời bị cắt (hết max_tokens, bị lọc) -> không đưa vào cache câu trả lời
+INCOMPLETE_FINISH_REASONS = {"length", "content_filter", "MAX_TOKENS", "SAFETY"}
 
 # =========================
 # PROMPT VIẾT LẠI CÂU HỎI
@@ -19,6 +41,9 @@ Quy tắc:
 - Nếu câu hỏi đã rõ ràng và là CHỦ ĐỀ MỚI, giữ nguyên và KHÔNG liên hệ nội dung cũ.
 - KHÔNG trả lời câu hỏi.
 - Chỉ xuất ra MỘT câu hỏi hoàn chỉnh.
+
+Tóm tắt các lượt trao đổi cũ hơn (nếu có):
+{history_summary}
 """
 
 contextualize_q_prompt = ChatPromptTemplate.from_messages([
@@ -99,77 +124,365 @@ def load_vector_db():
         embedding_function=embedding
     )
 
+def load_retriever(backend: str = RETRIEVER_BACKEND, k: int = 5, routing: bool = DOC_ROUTING_ENABLED):
+    """Chọn backend tìm kiếm; routing: chỉ tìm trong nhóm tài liệu liên quan tới câu hỏi (xem doc_router)"""
+    retriever = load_base_retriever(backend, k)
+    if not routing:
+        return retriever
+    # BM25 không embed câu hỏi -> router chỉ dùng từ khóa
+    embedding = None if backend == "bm25" else get_embedding_model()
+    return RoutedRetriever(router=DocRouter(FlatVectorIndex(DB_PATH), embedding), retriever=retriever)
+
+def load_base_retriever(backend: str, k: int = 5):
+    """Chroma (mặc định), index phẳng NumPy, BM25 hoặc hybrid (vector + BM25)"""
+    if backend == "flat":
+        return FlatRetriever(index=FlatVectorIndex(DB_PATH), embedding=get_embedding_model(), k=k)
+    if backend == "chroma":
+        return load_vector_db().as_retriever(search_kwargs={"k": k})
+    if backend == "bm25":
+        return LexicalRetriever(index=LexicalIndex(DB_PATH), store=DocumentStore(FlatVectorIndex(DB_PATH)), k=k)
+    if backend == "hybrid":
+        candidates = max(k, HYBRID_CANDIDATES)
+        return HybridRetriever(
+            dense=load_base_retriever(HYBRID_DENSE_BACKEND, k=candidates),
+            lexical=load_base_retriever("bm25", k=candidates),
+            k=k
+        )
+    raise ValueError(f"Retriever backend không hợp lệ: {backend}")
+
 # =========================
 # BUILD RAG CHAIN
 # =========================
 def build_rag_chain(model_provider="gemini"):
     llm = get_llm(model_provider)
-    vector_db = load_vector_db()
-
-    retriever = vector_db.as_retriever(search_kwargs={"k": 5})
+    # Có reranker: lấy rộng RERANK_CANDIDATES chunk rồi chỉ giữ RERANK_TOP_N chunk tốt nhất cho prompt
+    reranker = get_reranker()
+    retriever = load_retriever(k=RERANK_CANDIDATES if reranker is not None else 5)
+    embedding = get_embedding_model()
+    answer_cache = get_answer_cache(DB_PATH) if ANSWER_CACHE_ENABLED else None
+    context_budget = get_context_budget(model_provider)
+    xref_index = load_xref_index(DB_PATH)
+
+    # Retrieval cho câu hỏi gốc chạy song song với LLM viết lại (bản sync dùng thread pool)
+    speculative_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative-retrieve") \
+        if SPECULATIVE_RETRIEVAL else None
+
+    # Viết lại câu hỏi (chỉ khi cần: câu hỏi phụ thuộc lượt trước)
+    def count_rewrite(needed, reason):
+        decision = "rewrite" if needed else "skip"
+        metrics.inc("lexibot_rewrite_decisions_total", {"decision": decision, "reason": reason})
+
+    def gate_rewrite(question, history):
+        needed, reason = rewrite_decision(question, history)
+        raw_vector = None
+        if needed is None:
+            raw_vector = embedding.embed_query(question)
+            last_vector = embedding.embed_query(last_user_question(history))
+            needed, reason = rewrite_decision(question, history, cosine(raw_vector, last_vector))
+        count_rewrite(needed, reason)
+        return needed, raw_vector
+
+    async def agate_rewrite(question, history):
+        needed, reason = rewrite_decision(question, history)
+        raw_vector = None
+        if needed is None:
+            raw_vector = await embedding.aembed_query(question)
+            last_vector = await embedding.aembed_query(last_user_question(history))
+            needed, reason = rewrite_decision(question, history, cosine(raw_vector, last_vector))
+        count_rewrite(needed, reason)
+        return needed, raw_vector
 
-    # Viết lại câu hỏi
     def rewrite_question(inputs):
+        question = inputs["question"]
         history = inputs.get("chat_history", [])
 
-        if not history:
+        with metrics.timed("rewrite_gate"):
+            needed, raw_vector = gate_rewrite(question, history)
+        if not needed:
             return {
-                "question": inputs["question"],
-                "chat_history": []
+                "question": question,
+                "chat_history": history
             }
 
+        speculative = None
+        if speculative_pool is not None:
+            speculative = speculative_pool.submit(contextvars.copy_context().run, retriever.invoke, question)
+
         chain = contextualize_q_prompt | llm
-        rewritten = chain.invoke({
-            "input": inputs["question"],
-            "chat_history": history
-        })
+        try:
+            with metrics.timed("rewrite"):
+                rewritten = chain.invoke({
+                    "input": question,
+                    "chat_history": history,
+                    "history_summary": inputs.get("history_summary") or "(không có)"
+                })
+        except BaseException:
+            if speculative is not None:
+                speculative.cancel()
+            raise
 
         return {
             "question": rewritten.content,
-            "chat_history": history
+            "chat_history": history,
+            "raw_question": question,
+            "raw_vector": raw_vector,
+            "speculative": speculative
         }
 
-    # Retrieve tài liệu
-    def retrieve_docs(inputs):
+    async def arewrite_question(inputs):
         question = inputs["question"]
-        docs = retriever.invoke(question)
+        history = inputs.get("chat_history", [])
 
-        context_parts = []
-        for d in docs:
-            file_name = os.path.basename(d.metadata.get('source', 'Tai_lieu'))
-            section = d.metadata.get('section', 'Thông tin chung')
-            part = f"[Nguồn: {file_name} | {section}]\nNội dung: {d.page_content}"
-            context_parts.append(part)
+        with metrics.timed("rewrite_gate"):
+            needed, raw_vector = await agate_rewrite(question, history)
+        if not needed:
+            return {
+                "question": question,
+                "chat_history": history
+            }
 
-        context_text = "\n\n".join(context_parts)
+        speculative = None
+        if SPECULATIVE_RETRIEVAL:
+            speculative = asyncio.ensure_future(retriever.ainvoke(question))
+
+        chain = contextualize_q_prompt | llm
+        try:
+            with metrics.timed("rewrite"):
+                rewritten = await chain.ainvoke({
+                    "input": question,
+                    "chat_history": history,
+                    "history_summary": inputs.get("history_summary") or "(không có)"
+                })
+        except BaseException:
+            if speculative is not None:
+                speculative.cancel()
+            raise
 
         return {
-            "input": question,
-            "context": context_text,
-            "source_documents": docs
+            "question": rewritten.content,
+            "chat_history": history,
+            "raw_question": question,
+            "raw_vector": raw_vector,
+            "speculative": speculative
         }
 
-    # Trả lời
-    def answer_question(inputs):
-        chain = qa_prompt | llm
+    # Tra cache câu trả lời theo câu hỏi đã viết lại
+    def count_cache_result(cached):
+        result = "hit" if cached else "miss"
+        metrics.inc("lexibot_cache_requests_total", {"cache": "answer", "result": result})
 
-        prompt_inputs = {
-            "input": inputs["input"],
-            "context": inputs["context"]
-        }
+    def check_answer_cache(inputs):
+        if answer_cache is None:
+            return inputs
+
+        with metrics.timed("cache_lookup"):
+            question_vector = embedding.embed_query(inputs["question"])
+            cached = answer_cache.lookup(question_vector, model_provider)
+        count_cache_result(cached)
+        return {**inputs, "question_vector": question_vector, "cached": cached}
+
+    async def acheck_answer_cache(inputs):
+        if answer_cache is None:
+            return inputs
 
-        response = chain.invoke(prompt_inputs)
+        with metrics.timed("cache_lookup"):
+            question_vector = await embedding.aembed_query(inputs["question"])
+            cached = answer_cache.lookup(question_vector, model_provider)
+        count_cache_result(cached)
+        return {**inputs, "question_vector": question_vector, "cached": cached}
+
+    # Retrieve tài liệu
+    def log_context_stats(stats):
+        metrics.inc("lexibot_context_tokens_total", {"kind": "raw"}, stats["raw_tokens"])
+        metrics.inc("lexibot_context_tokens_total", {"kind": "packed"}, stats["packed_tokens"])
+        print(f"[CONTEXT] {stats['chunks']} chunk -> {stats['blocks']} đoạn | "
+              f"~{stats['raw_tokens']} -> ~{stats['packed_tokens']} token "
+              f"(tiết kiệm ~{stats['saved_tokens']})", flush=True)
+
+    def format_context(inputs, docs):
+        if xref_index is not None:
+            # Thêm các Điều được dẫn chiếu ("theo khoản 2 Điều 5") mà retrieval chưa lấy được
+            with metrics.timed("xref"):
+                extra = xref_index.expand(docs)
+            if extra:
+                metrics.inc("lexibot_xref_chunks_total", value=len(extra))
+                docs = docs + extra
+
+        if CONTEXT_PACKING_ENABLED:
+            # Bỏ phần overlap/tiêu đề lặp lại, gộp chunk cùng Điều, giới hạn theo budget của provider
+            with metrics.timed("pack"):
+                context_text, docs, stats = pack_context(docs, context_budget)
+            log_context_stats(stats)
+        else:
+            context_text = "\n\n".join(format_block(source_header(d), d.page_content) for d in docs)
 
         return {
-            "answer": response.content,
-            "sources": inputs["source_documents"]
+            "input": inputs["question"],
+            "context": context_text,
+            "source_documents": docs,
+            "question_vector": inputs.get("question_vector")
         }
 
-    # Ghép pipeline
+    # Câu viết lại gần như giữ nguyên câu gốc -> dùng luôn kết quả retrieval đã chạy trước
+    def count_speculative(reused):
+        result = "reused" if reused else "discarded"
+        metrics.inc("lexibot_speculative_retrieval_total", {"result": result})
+
+    def speculative_docs(inputs):
+        future = inputs.get("speculative")
+        if future is None:
+            return None
+        raw, rewritten = inputs["raw_question"], inputs["question"]
+        same = same_question(raw, rewritten)
+        if not same:
+            raw_vector = inputs.get("raw_vector")
+            if raw_vector is None:
+                raw_vector = embedding.embed_query(raw)
+            question_vector = inputs.get("question_vector")
+            if question_vector is None:
+                question_vector = embedding.embed_query(rewritten)
+            same = same_question(raw, rewritten, raw_vector, question_vector)
+        count_speculative(same)
+        if not same:
+            future.cancel()
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            # Retrieve song song lỗi -> retrieve lại theo câu hỏi đã viết lại, không làm hỏng cả request
+            print(f"[RETRIEVE] Retrieve song song lỗi: {e}", flush=True)
+            return None
+
+    async def aspeculative_docs(inputs):
+        task = inputs.get("speculative")
+        if task is None:
+            return None
+        raw, rewritten = inputs["raw_question"], inputs["question"]
+        same = same_question(raw, rewritten)
+        if not same:
+            raw_vector = inputs.get("raw_vector")
+            if raw_vector is None:
+                raw_vector = await embedding.aembed_query(raw)
+            question_vector = inputs.get("question_vector")
+            if question_vector is None:
+                question_vector = await embedding.aembed_query(rewritten)
+            same = same_question(raw, rewritten, raw_vector, question_vector)
+        count_speculative(same)
+        if not same:
+            task.cancel()
+            return None
+        try:
+            return await task
+        except Exception as e:
+            print(f"[RETRIEVE] Retrieve song song lỗi: {e}", flush=True)
+            return None
+
+    def retrieve_docs(inputs):
+        if inputs.get("cached"):
+            if inputs.get("speculative") is not None:
+                inputs["speculative"].cancel()
+            return {"input": inputs["question"], "cached": inputs["cached"]}
+        with metrics.timed("retrieve"):
+            docs = speculative_docs(inputs)
+            if docs is None:
+                docs = retriever.invoke(inputs["question"])
+        if reranker is not None:
+            docs = reranker.rerank(inputs["question"], docs)
+        return format_context(inputs, docs)
+
+    async def aretrieve_docs(inputs):
+        if inputs.get("cached"):
+            if inputs.get("speculative") is not None:
+                inputs["speculative"].cancel()
+            return {"input": inputs["question"], "cached": inputs["cached"]}
+        with metrics.timed("retrieve"):
+            docs = await aspeculative_docs(inputs)
+            if docs is None:
+                docs = await retriever.ainvoke(inputs["question"])
+        if reranker is not None:
+            docs = await asyncio.to_thread(reranker.rerank, inputs["question"], docs)
+        return format_context(inputs, docs)
+
+    # Trả lời (generator: phát sources trước, sau đó từng token của LLM)
+    # invoke() gộp các AddableDict lại thành {"sources": ..., "answer": "..."}
+    def store_answer(inputs, parts, finish_reason=None):
+        """Chỉ cache câu trả lời đầy đủ: lỗi/ngắt giữa chừng thì không tới được đây, rỗng hoặc bị cắt thì bỏ qua"""
+        if not "".join(parts).strip() or finish_reason in INCOMPLETE_FINISH_REASONS:
+            return
+        if answer_cache is not None and inputs.get("question_vector") is not None:
+            answer_cache.store(
+                inputs["question_vector"], model_provider, inputs["input"],
+                "".join(parts), inputs["source_documents"]
+            )
+
+    def answer_question(input_stream):
+        for inputs in input_stream:
+            cached = inputs.get("cached")
+            if cached:
+                yield AddableDict(sources=cached["sources"])
+                yield AddableDict(answer=cached["answer"])
+                continue
+
+            yield AddableDict(sources=inputs["source_documents"])
+
+            chain = qa_prompt | llm
+
+            prompt_inputs = {
+                "input": inputs["input"],
+                "context": inputs["context"]
+            }
+
+            parts = []
+            finish_reason = None
+            with metrics.timed("answer"):
+                start = time.perf_counter()
+                for chunk in chain.stream(prompt_inputs):
+                    finish_reason = chunk.response_metadata.get("finish_reason") or finish_reason
+                    if chunk.content:
+                        if not parts:
+                            metrics.observe("lexibot_answer_ttft_seconds", time.perf_counter() - start)
+                        parts.append(chunk.content)
+                        yield AddableDict(answer=chunk.content)
+
+            store_answer(inputs, parts, finish_reason)
+
+    async def aanswer_question(input_stream):
+        async for inputs in input_stream:
+            cached = inputs.get("cached")
+            if cached:
+                yield AddableDict(sources=cached["sources"])
+                yield AddableDict(answer=cached["answer"])
+                continue
+
+            yield AddableDict(sources=inputs["source_documents"])
+
+            chain = qa_prompt | llm
+
+            prompt_inputs = {
+                "input": inputs["input"],
+                "context": inputs["context"]
+            }
+
+            parts = []
+            finish_reason = None
+            with metrics.timed("answer"):
+                start = time.perf_counter()
+                async for chunk in chain.astream(prompt_inputs):
+                    finish_reason = chunk.response_metadata.get("finish_reason") or finish_reason
+                    if chunk.content:
+                        if not parts:
+                            metrics.observe("lexibot_answer_ttft_seconds", time.perf_counter() - start)
+                        parts.append(chunk.content)
+                        yield AddableDict(answer=chunk.content)
+
+            store_answer(inputs, parts, finish_reason)
+
+    # Ghép pipeline (mỗi bước có bản sync và async: invoke/stream và ainvoke/astream)
     rag_chain = (
-        RunnableLambda(rewrite_question)
-        | RunnableLambda(retrieve_docs)
-        | RunnableLambda(answer_question)
+        RunnableLambda(rewrite_question, afunc=arewrite_question)
+        | RunnableLambda(check_answer_cache, afunc=acheck_answer_cache)
+        | RunnableLambda(retrieve_docs, afunc=aretrieve_docs)
+        | RunnableGenerator(answer_question, aanswer_question)
     )
 
     return rag_chain
@@ -177,23 +490,77 @@ def build_rag_chain(model_provider="gemini"):
 # =========================
 # ASK (STATELESS)
 # =========================
-def ask_question(chain, question: str, chat_history: list = None):
-    if chain is None:
-        return "Hệ thống chưa sẵn sàng.", []
-
-    if chat_history is None:
-        chat_history = []
-
+def to_langchain_history(chat_history: list = None):
     processed_history = []
-    for msg in chat_history:
+    for msg in chat_history or []:
         if msg["role"] == "user":
             processed_history.append(HumanMessage(content=msg["content"]))
         else:
             processed_history.append(AIMessage(content=msg["content"]))
+    return processed_history
+
+def ask_question(chain, question: str, chat_history: list = None, history_summary: str = ""):
+    """chat_history: các lượt gần nhất (đã giới hạn bởi chat_history.build_history), history_summary: tóm tắt lượt cũ"""
+    if chain is None:
+        return "Hệ thống chưa sẵn sàng.", []
 
-    response = chain.invoke({
+    # Câu hỏi đầu tiên giống hệt một request đang chạy -> chờ và dùng chung kết quả
+    key = coalesce_key(chain, question, chat_history, history_summary)
+    response = get_single_flight().do(key, lambda: chain.invoke({
         "question": question,
-        "chat_history": processed_history
-    })
+        "chat_history": to_langchain_history(chat_history),
+        "history_summary": history_summary
+    }))
+
+    return response.get("answer", ""), response.get("sources", [])
 
-    return response["answer"], response.get("sources", [])
\ No newline at end of file
+def stream_question(chain, question: str, chat_history: list = None, history_summary: str = ""):
+    """
+    Bản streaming của ask_question, generator trả về các sự kiện:
+    ("sources", docs) ngay khi retrieve xong, sau đó ("token", text) theo từng đoạn LLM sinh ra.
+    """
+    if chain is None:
+        yield "token", "Hệ thống chưa sẵn sàng."
+        return
+
+    key = coalesce_key(chain, question, chat_history, history_summary)
+    for chunk in get_single_flight().stream(key, lambda: chain.stream({
+        "question": question,
+        "chat_history": to_langchain_history(chat_history),
+        "history_summary": history_summary
+    })):
+        if "sources" in chunk:
+            yield "sources", chunk["sources"]
+        if chunk.get("answer"):
+            yield "token", chunk["answer"]
+
+async def ask_question_async(chain, question: str, chat_history: list = None, history_summary: str = ""):
+    """Bản async của ask_question: chờ LLM không chiếm thread, một process phục vụ được nhiều câu hỏi"""
+    if chain is None:
+        return "Hệ thống chưa sẵn sàng.", []
+
+    key = coalesce_key(chain, question, chat_history, history_summary)
+    response = await get_single_flight().ado(key, lambda: chain.ainvoke({
+        "question": question,
+        "chat_history": to_langchain_history(chat_history),
+        "history_summary": history_summary
+    }))
+
+    return response.get("answer", ""), response.get("sources", [])
+
+async def astream_question(chain, question: str, chat_history: list = None, history_summary: str = ""):
+    """Bản async của stream_question"""
+    if chain is None:
+        yield "token", "Hệ thống chưa sẵn sàng."
+        return
+
+    key = coalesce_key(chain, question, chat_history, history_summary)
+    async for chunk in get_single_flight().astream(key, lambda: chain.astream({
+        "question": question,
+        "chat_history": to_langchain_history(chat_history),
+        "history_summary": history_summary
+    })):
+        if "sources" in chunk:
+            yield "sources", chunk["sources"]
+        if chunk.get("answer"):
+            yield "token", chunk["answer"]
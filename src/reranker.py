@@ -0,0 +1,140 @@
+"""
+Rerank 2 bước: retriever lấy rộng RERANK_CANDIDATES chunk, reranker chạy trên CPU giữ lại RERANK_TOP_N chunk.
+- "mmr": Maximal Marginal Relevance trên vector embedding (lấy từ embedding cache, gần như miễn phí).
+- "cross-encoder": chấm điểm từng cặp (câu hỏi, chunk) theo batch, bỏ chunk dưới RERANK_MIN_SCORE.
+Mỗi lần rerank có budget thời gian: đo chi phí trung bình mỗi chunk để giới hạn số ứng viên được chấm.
+"""
+import os
+import time
+import threading
+import numpy as np
+from src import metrics
+
+RERANKER = os.getenv("RERANKER", "mmr")                          # none | mmr | cross-encoder
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "20"))    # số chunk lấy ở bước 1
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "4"))               # số chunk giữ lại cho prompt
+RERANK_MIN_SCORE = float(os.getenv("RERANK_MIN_SCORE", "0.05"))  # cross-encoder (sigmoid 0-1)
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "150"))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "16"))
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))               # 1 = chỉ xét độ liên quan, 0 = chỉ đa dạng
+CROSS_ENCODER_MODEL = os.getenv("RERANKER_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+
+COST_SMOOTHING = 0.2   # trọng số của lần đo mới trong trung bình trượt chi phí/chunk
+
+_reranker_instance = None
+_reranker_lock = threading.Lock()
+
+
+class Reranker:
+    """Khung chung: cắt ứng viên theo budget, đo chi phí, ghi metrics; lớp con cài đặt select()"""
+
+    name = "base"
+
+    def __init__(self, top_n: int = RERANK_TOP_N, budget_ms: float = RERANK_BUDGET_MS):
+        self.top_n = top_n
+        self.budget = budget_ms / 1000
+        self.cost_per_doc = None   # giây/chunk, trung bình trượt
+
+    def max_candidates(self, n):
+        if self.cost_per_doc is None or self.budget <= 0:
+            return n
+        return max(self.top_n, min(n, int(self.budget / self.cost_per_doc)))
+
+    def rerank(self, query: str, docs):
+        if len(docs) <= self.top_n:
+            return docs
+        # Ứng viên đã xếp theo độ liên quan của retriever -> vượt budget thì bỏ phần đuôi
+        candidates = docs[:self.max_candidates(len(docs))]
+        start = time.perf_counter()
+        with metrics.timed("rerank"):
+            kept = self.select(query, candidates)
+        cost = (time.perf_counter() - start) / len(candidates)
+        if self.cost_per_doc is None:
+            self.cost_per_doc = cost
+        else:
+            self.cost_per_doc += COST_SMOOTHING * (cost - self.cost_per_doc)
+
+        metrics.inc("lexibot_rerank_chunks_total", {"reranker": self.name, "kind": "candidates"}, len(docs))
+        metrics.inc("lexibot_rerank_chunks_total", {"reranker": self.name, "kind": "kept"}, len(kept))
+        return kept
+
+    def select(self, query: str, docs):
+        raise NotImplementedError
+
+    def warm_up(self):
+        pass
+
+
+class MMRReranker(Reranker):
+    """Chọn lần lượt chunk vừa liên quan câu hỏi vừa ít trùng với các chunk đã chọn"""
+
+    name = "mmr"
+
+    def __init__(self, embedding, lambda_mult: float = MMR_LAMBDA, **kwargs):
+        super().__init__(**kwargs)
+        self.embedding = embedding
+        self.lambda_mult = lambda_mult
+
+    def select(self, query: str, docs):
+        query_vector = np.asarray(self.embedding.embed_query(query), dtype=np.float32)
+        doc_vectors = np.asarray(self.embedding.embed_documents([d.page_content for d in docs]), dtype=np.float32)
+        query_vector /= max(float(np.linalg.norm(query_vector)), 1e-12)
+        doc_vectors /= np.maximum(np.linalg.norm(doc_vectors, axis=1, keepdims=True), 1e-12)
+
+        relevance = doc_vectors @ query_vector
+        similarity = doc_vectors @ doc_vectors.T
+        selected = [int(np.argmax(relevance))]
+        while len(selected) < self.top_n:
+            redundancy = similarity[:, selected].max(axis=1)
+            scores = self.lambda_mult * relevance - (1 - self.lambda_mult) * redundancy
+            scores[selected] = -np.inf
+            selected.append(int(np.argmax(scores)))
+        return [docs[i] for i in selected]
+
+
+class CrossEncoderReranker(Reranker):
+    """Cross-encoder đa ngôn ngữ nhỏ, chấm cả batch (câu hỏi, chunk) trong một lần forward"""
+
+    name = "cross-encoder"
+
+    def __init__(self, model_name: str = CROSS_ENCODER_MODEL, min_score: float = RERANK_MIN_SCORE,
+                 batch_size: int = RERANK_BATCH_SIZE, **kwargs):
+        super().__init__(**kwargs)
+        from sentence_transformers import CrossEncoder
+
+        print(f"Đang tải model rerank: {model_name}...")
+        self.model = CrossEncoder(model_name, device="cpu", max_length=512)
+        self.min_score = min_score
+        self.batch_size = batch_size
+
+    def select(self, query: str, docs):
+        scores = self.model.predict(
+            [(query, d.page_content) for d in docs], batch_size=self.batch_size, show_progress_bar=False
+        )
+        order = np.argsort(-np.asarray(scores))[:self.top_n]
+        # Luôn giữ chunk điểm cao nhất, các chunk sau phải vượt ngưỡng
+        return [docs[i] for n, i in enumerate(order) if n == 0 or scores[i] >= self.min_score]
+
+    def warm_up(self):
+        self.model.predict([("học phí", "Học phí được tính theo tín chỉ")], show_progress_bar=False)
+
+
+def create_reranker(kind: str = RERANKER, top_n: int = RERANK_TOP_N):
+    if kind == "none":
+        return None
+    if kind == "mmr":
+        from src.models import get_embedding_model
+        return MMRReranker(get_embedding_model(), top_n=top_n)
+    if kind == "cross-encoder":
+        return CrossEncoderReranker(top_n=top_n)
+    raise ValueError(f"Reranker không hợp lệ: {kind}")
+
+
+def get_reranker():
+    """Reranker dùng chung cho mọi chain (model cross-encoder chỉ nạp một lần), None nếu RERANKER=none"""
+    global _reranker_instance
+    with _reranker_lock:
+        if _reranker_instance is None and RERANKER != "none":
+            _reranker_instance = create_reranker()
+            _reranker_instance.warm_up()
+        return _reranker_instance
@@ -0,0 +1,80 @@
+import os
+import re
+import unicodedata
+import numpy as np
+from langchain_core.messages import HumanMessage
+
+REWRITE_GATE_ENABLED = os.getenv("REWRITE_GATE", "1") != "0"
+REWRITE_SIM_THRESHOLD = float(os.getenv("REWRITE_SIM_THRESHOLD", "0.6"))    # cosine với câu hỏi trước
+REWRITE_MIN_WORDS = int(os.getenv("REWRITE_MIN_WORDS", "4"))                # câu quá ngắn -> luôn viết lại
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "1") != "0"
+REWRITE_SAME_THRESHOLD = float(os.getenv("REWRITE_SAME_THRESHOLD", "0.97"))  # câu viết lại coi như giữ nguyên
+
+# Từ/cụm từ cho thấy câu hỏi phụ thuộc vào lượt trước ("thế còn", "mức đó", "ngành này"...)
+DEPENDENT_PHRASES = [
+    "thế còn", "còn về", "thì sao", "vậy thì", "nếu vậy", "như vậy", "như thế",
+    "ở trên", "nói trên", "kể trên", "như trên", "vừa rồi", "vừa nói", "bạn vừa",
+    "ý thứ", "ý trên", "rõ hơn", "chi tiết hơn", "cụ thể hơn", "thêm về", "nữa không",
+]
+DEPENDENT_WORDS = {"đó", "này", "ấy", "kia", "nó", "họ"}
+LEADING_WORDS = {"còn", "thế", "vậy", "và", "nhưng", "ngoài", "tiếp"}
+
+
+def tokenize(text: str):
+    return re.findall(r"\w+", unicodedata.normalize("NFC", text or "").lower())
+
+
+def has_dependent_cue(question: str) -> bool:
+    tokens = tokenize(question)
+    if not tokens:
+        return False
+    if tokens[0] in LEADING_WORDS or DEPENDENT_WORDS.intersection(tokens):
+        return True
+    padded = f" {' '.join(tokens)} "
+    return any(f" {phrase} " in padded for phrase in DEPENDENT_PHRASES)
+
+
+def last_user_question(history):
+    for msg in reversed(history or []):
+        if isinstance(msg, HumanMessage):
+            return msg.content
+    return None
+
+
+def cosine(a, b) -> float:
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    denom = float(np.linalg.norm(a) * np.linalg.norm(b))
+    return float(a @ b) / denom if denom else 0.0
+
+
+def rewrite_decision(question: str, history, similarity: float = None):
+    """
+    Quyết định có cần gọi LLM viết lại câu hỏi không -> (True/False/None, lý do).
+    None: dấu hiệu từ vựng chưa đủ, cần truyền similarity (cosine giữa câu hỏi mới và câu hỏi trước).
+    """
+    if not history:
+        return False, "no_history"
+    if not REWRITE_GATE_ENABLED:
+        return True, "gate_disabled"
+    if has_dependent_cue(question):
+        return True, "dependent_cue"
+    if len(tokenize(question)) < REWRITE_MIN_WORDS:
+        return True, "short"
+    if last_user_question(history) is None:
+        return False, "self_contained"
+    if similarity is None:
+        return None, "need_similarity"
+    # Câu hỏi đầy đủ, khác chủ đề lượt trước -> prompt cũng sẽ giữ nguyên, bỏ qua LLM
+    if similarity >= REWRITE_SIM_THRESHOLD:
+        return True, "same_topic"
+    return False, "new_topic"
+
+
+def same_question(raw: str, rewritten: str, raw_vector=None, rewritten_vector=None) -> bool:
+    """Câu viết lại gần như giữ nguyên câu gốc -> dùng lại kết quả retrieval chạy trước"""
+    if tokenize(raw) == tokenize(rewritten):
+        return True
+    if raw_vector is None or rewritten_vector is None:
+        return False
+    return cosine(raw_vector, rewritten_vector) >= REWRITE_SAME_THRESHOLD
@@ -0,0 +1,224 @@
+"""
+Session phía server: cookie chỉ chứa session id đã ký, dữ liệu (lịch sử chat của khách...) nằm trên server.
+- SESSION_BACKEND=sqlite (mặc định): file SQLite dùng chung cho mọi worker gunicorn/uvicorn trên máy.
+- SESSION_BACKEND=memory: LRU trong RAM, chỉ dùng khi chạy 1 process (mỗi worker có bộ nhớ riêng).
+- SESSION_BACKEND=cookie: giữ cách cũ của Flask (toàn bộ session trong cookie đã ký, giới hạn ~4 KB).
+Session hết hạn sau SESSION_TTL giây kể từ lần ghi cuối.
+"""
+import os
+import time
+import sqlite3
+import secrets
+import threading
+from collections import OrderedDict
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
+
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite")             # sqlite | memory | cookie
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "./session_store.sqlite")
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(7 * 24 * 3600)))      # giây
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "10000"))  # backend memory
+
+_PURGE_EVERY = 500   # số lần ghi giữa 2 lần dọn session hết hạn (sqlite)
+
+# Cùng serializer với cookie session của Flask (giữ được datetime, bytes, Markup...)
+session_serializer = TaggedJSONSerializer()
+
+
+# =========================
+# BACKEND
+# =========================
+class MemorySessionBackend:
+    """LRU trong bộ nhớ: quá SESSION_MAX_ENTRIES thì bỏ session lâu không dùng nhất"""
+
+    def __init__(self, max_entries: int = SESSION_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data = OrderedDict()   # sid -> (hết hạn lúc, dữ liệu đã serialize)
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._data.get(sid)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._data[sid]
+                return None
+            self._data.move_to_end(sid)
+            return entry[1]
+
+    def set(self, sid, value, ttl):
+        with self._lock:
+            self._data[sid] = (time.time() + ttl, value)
+            self._data.move_to_end(sid)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteSessionBackend:
+    """Bảng sessions(sid, data, expires) trong SQLite (WAL), an toàn khi nhiều worker cùng ghi"""
+
+    def __init__(self, path: str = SESSION_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pid = None
+        self._conn = None
+        self._writes = 0
+
+    def _connect(self):
+        # Sau fork phải mở lại kết nối
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+        self._pid = os.getpid()
+        self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data TEXT, expires REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires)")
+        return self._conn
+
+    def get(self, sid):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT data FROM sessions WHERE sid = ? AND expires >= ?", (sid, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, sid, value, ttl):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)", (sid, value, now + ttl))
+            self._writes += 1
+            if self._writes % _PURGE_EVERY == 0:
+                conn.execute("DELETE FROM sessions WHERE expires < ?", (now,))
+
+    def delete(self, sid):
+        with self._lock:
+            self._connect().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+def create_session_backend(kind: str = SESSION_BACKEND):
+    if kind == "sqlite":
+        return SQLiteSessionBackend()
+    if kind == "memory":
+        return MemorySessionBackend()
+    raise ValueError(f"Session backend không hợp lệ: {kind}")
+
+
+# =========================
+# FLASK SESSION INTERFACE
+# =========================
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.modified = False
+
+
+class ServerSessionInterface(SessionInterface):
+    """Cookie = session id đã ký; chỉ ghi lại vào backend khi session thay đổi"""
+
+    session_class = ServerSession
+    salt = "lexibot-session"
+
+    def __init__(self, backend, ttl: int = SESSION_TTL):
+        self.backend = backend
+        self.ttl = ttl
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt=self.salt)
+
+    def load(self, app, cookie_value):
+        """Cookie -> ServerSession (rỗng nếu không có/sai chữ ký/đã hết hạn); dùng chung cho Flask và asgi.py"""
+        if not cookie_value:
+            return self.session_class()
+        try:
+            sid = self._signer(app).unsign(cookie_value).decode("ascii")
+        except (BadSignature, UnicodeDecodeError):
+            return self.session_class()
+        return self.get(sid)
+
+    def get(self, sid):
+        """Đọc session theo id (vd. thread nền cập nhật session sau khi response đã gửi)"""
+        raw = self.backend.get(sid)
+        if raw is None:
+            return self.session_class(sid=sid)
+        return self.session_class(session_serializer.loads(raw), sid=sid)
+
+    def store(self, app, session):
+        """Ghi session vào backend -> giá trị cookie mới (None nếu session rỗng, cần xóa cookie)"""
+        if not session:
+            if session.sid:
+                self.backend.delete(session.sid)
+            return None
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        self.backend.set(session.sid, session_serializer.dumps(dict(session)), self.ttl)
+        session.modified = False
+        return self._signer(app).sign(session.sid).decode("ascii")
+
+    def regenerate(self, session):
+        """Bỏ id hiện tại (xóa bản ghi cũ), lần store() sau cấp id mới"""
+        if session.sid is not None:
+            self.backend.delete(session.sid)
+            session.sid = None
+        session.modified = True
+
+    def open_session(self, app, request):
+        return self.load(app, request.cookies.get(self.get_cookie_name(app)))
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session.modified:
+            return
+        value = self.store(app, session)
+        if value is None:
+            response.delete_cookie(name, domain=domain, path=path)
+            return
+        response.vary.add("Cookie")
+        response.set_cookie(
+            name, value,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+def is_stored_session(session) -> bool:
+    """Session phía server đã có id (cookie đã gửi) -> ghi tiếp được cả sau khi response đã gửi header"""
+    return isinstance(session, ServerSession) and session.sid is not None
+
+
+def rotate_session_id(app, session):
+    """Đăng nhập/đổi quyền: cấp session id mới chống session fixation (cookie session không có id -> bỏ qua)"""
+    interface = app.session_interface
+    if isinstance(interface, ServerSessionInterface) and isinstance(session, ServerSession):
+        interface.regenerate(session)
+
+
+def init_session_store(app, kind: str = SESSION_BACKEND):
+    """Gắn session phía server cho app Flask (SESSION_BACKEND=cookie thì giữ session cookie mặc định)"""
+    if kind == "cookie":
+        return
+    app.session_interface = ServerSessionInterface(create_session_backend(kind))
+    print(f"Session phía server: {kind}")
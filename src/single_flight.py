@@ -0,0 +1,289 @@
+"""
+Gộp các câu hỏi giống hệt nhau đang xử lý cùng lúc (single-flight).
+Khi có thông báo mới, nhiều sinh viên gửi cùng một câu hỏi đầu tiên trong vài giây:
+chỉ request đầu tiên (leader) chạy pipeline RAG + LLM, các request trùng (follower) chờ và dùng chung kết quả.
+- Khóa: (chain của provider, câu hỏi đã chuẩn hóa); chỉ áp dụng khi chưa có lịch sử hội thoại.
+- Bản stream: pipeline chạy trong thread/task riêng, leader và follower cùng nhận lại từng sự kiện (sources, token);
+  client của leader ngắt không làm hỏng câu trả lời của follower, chỉ dừng pipeline khi không còn ai nhận.
+- Follower chờ quá SINGLE_FLIGHT_WAIT giây, hoặc leader lỗi trước khi có kết quả, thì tự chạy pipeline của mình.
+"""
+import os
+import re
+import asyncio
+import threading
+import contextvars
+from src.embedding_cache import normalize_text
+from src import metrics
+
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT", "1") != "0"
+SINGLE_FLIGHT_WAIT = float(os.getenv("SINGLE_FLIGHT_WAIT", "60"))   # giây
+
+
+def coalesce_key(chain, question: str, chat_history=None, history_summary: str = ""):
+    """None nếu không được gộp (có lịch sử -> câu trả lời phụ thuộc hội thoại)"""
+    if not SINGLE_FLIGHT_ENABLED or chat_history or history_summary or not question:
+        return None
+    text = re.sub(r"[\s?.!]+$", "", normalize_text(question).casefold())
+    # Mỗi provider có một chain dùng chung (app.get_chain) -> id(chain) phân biệt provider
+    return id(chain), text
+
+
+def _count(mode, role):
+    metrics.inc("lexibot_single_flight_requests_total", {"mode": mode, "role": role})
+    if role == "follower":
+        metrics.inc("lexibot_llm_calls_saved_total", {"mode": mode})
+
+
+class _Call:
+    def __init__(self):
+        self.events = []      # bản stream: các sự kiện leader đã nhận
+        self.result = None
+        self.error = None
+        self.done = False
+        self.consumers = 0    # bản stream: số request đang nhận sự kiện (kể cả leader)
+        self.task = None      # bản async: task chạy pipeline, giữ tham chiếu để không bị thu hồi
+
+
+class SingleFlight:
+    """Bản sync dùng threading (Flask), bản async dùng asyncio (asgi.py); hai loại không dùng chung call"""
+
+    def __init__(self, wait: float = SINGLE_FLIGHT_WAIT):
+        self.wait = wait
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._calls = {}
+        self._acalls = {}
+        self._acond = None
+
+    # ----- sync -----
+    def _join(self, calls, key):
+        """(call, True nếu là leader); key đã gồm mode vì bản ask không phát sự kiện cho follower bản stream"""
+        call = calls.get(key)
+        if call is not None:
+            return call, False
+        call = calls[key] = _Call()
+        return call, True
+
+    def _finish(self, calls, key, call, error=None):
+        call.error = error
+        call.done = True
+        if calls.get(key) is call:
+            del calls[key]
+
+    def do(self, key, fn, mode="ask"):
+        if key is None:
+            return fn()
+        flight_key = (mode, key)
+        with self._lock:
+            call, leader = self._join(self._calls, flight_key)
+        if not leader:
+            with self._cond:
+                finished = self._cond.wait_for(lambda: call.done, self.wait)
+            if not finished:
+                return fn()   # leader quá chậm -> tự chạy
+            if call.error is not None:
+                return self.do(key, fn, mode)   # leader lỗi -> gộp lại, một follower làm leader mới
+            _count(mode, "follower")
+            return call.result
+
+        _count(mode, "leader")
+        error = None
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            with self._cond:
+                self._finish(self._calls, flight_key, call, error)
+                self._cond.notify_all()
+
+    def stream(self, key, gen_fn, mode="stream"):
+        if key is None:
+            yield from gen_fn()
+            return
+        flight_key = (mode, key)
+        with self._lock:
+            call, leader = self._join(self._calls, flight_key)
+            call.consumers += 1
+        if leader:
+            _count(mode, "leader")
+            # Pipeline chạy trong thread riêng, không theo generator của leader:
+            # client của leader ngắt giữa chừng thì follower vẫn nhận đủ câu trả lời
+            threading.Thread(target=contextvars.copy_context().run, daemon=True, name="single-flight",
+                             args=(self._produce, flight_key, call, gen_fn)).start()
+        try:
+            fallback = yield from self._follow(call, mode, leader)
+        finally:
+            with self._lock:
+                call.consumers -= 1
+        if fallback == "retry":
+            yield from self.stream(key, gen_fn, mode)   # leader lỗi trước khi có kết quả -> gộp lại
+        elif fallback == "own":
+            yield from gen_fn()   # leader quá chậm -> tự chạy
+
+    def _produce(self, flight_key, call, gen_fn):
+        gen = gen_fn()
+        error = None
+        try:
+            for event in gen:
+                with self._cond:
+                    if not call.consumers:
+                        # Mọi client đã ngắt -> dừng, không tốn thêm LLM; gỡ call ngay để request mới không nhận câu trả lời dở
+                        self._finish(self._calls, flight_key, call, RuntimeError("Mọi request chờ câu trả lời đã bị hủy"))
+                        self._cond.notify_all()
+                        return
+                    call.events.append(event)
+                    self._cond.notify_all()
+        except Exception as e:
+            error = e
+        finally:
+            gen.close()
+        with self._cond:
+            self._finish(self._calls, flight_key, call, error)
+            self._cond.notify_all()
+
+    def _follow(self, call, mode, leader):
+        """Phát lại các sự kiện của call; trả về "own" / "retry" khi follower phải tự chạy / gộp lại"""
+        sent = 0
+        while True:
+            with self._cond:
+                ready = self._cond.wait_for(lambda: call.done or len(call.events) > sent,
+                                            None if leader else self.wait)
+                events = call.events[sent:]
+                done = call.done
+            if sent == 0 and not events and not leader:
+                if not ready:
+                    return "own"
+                if call.error is not None:
+                    return "retry"
+            if not ready:
+                raise TimeoutError("Hết thời gian chờ câu trả lời dùng chung")
+            if sent == 0 and events and not leader:
+                _count(mode, "follower")
+            yield from events
+            sent += len(events)
+            if done and sent == len(call.events):
+                if call.error is not None:
+                    raise call.error
+                return None
+
+    # ----- async -----
+    def _async_cond(self):
+        if self._acond is None:
+            self._acond = asyncio.Condition()
+        return self._acond
+
+    async def ado(self, key, afn, mode="ask"):
+        if key is None:
+            return await afn()
+        flight_key = (mode, key)
+        cond = self._async_cond()
+        call, leader = self._join(self._acalls, flight_key)
+        if not leader:
+            try:
+                async with cond:
+                    await asyncio.wait_for(cond.wait_for(lambda: call.done), self.wait)
+            except asyncio.TimeoutError:
+                return await afn()
+            if call.error is not None:
+                return await self.ado(key, afn, mode)
+            _count(mode, "follower")
+            return call.result
+
+        _count(mode, "leader")
+        error = RuntimeError("Request gốc bị hủy giữa chừng")
+        try:
+            call.result = await afn()
+            error = None
+            return call.result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._finish(self._acalls, flight_key, call, error)
+            async with cond:
+                cond.notify_all()
+
+    async def astream(self, key, agen_fn, mode="stream"):
+        if key is None:
+            async for event in agen_fn():
+                yield event
+            return
+        flight_key = (mode, key)
+        cond = self._async_cond()
+        call, leader = self._join(self._acalls, flight_key)
+        call.consumers += 1
+        if leader:
+            _count(mode, "leader")
+            # Task riêng như bản sync: leader ngắt (CancelledError) không hủy câu trả lời của follower
+            call.task = asyncio.create_task(self._aproduce(cond, flight_key, call, agen_fn))
+        fallback = []
+        try:
+            async for event in self._afollow(cond, call, mode, leader, fallback):
+                yield event
+        finally:
+            call.consumers -= 1
+        if fallback == ["retry"]:
+            async for event in self.astream(key, agen_fn, mode):
+                yield event
+        elif fallback == ["own"]:
+            async for event in agen_fn():
+                yield event
+
+    async def _aproduce(self, cond, flight_key, call, agen_fn):
+        agen = agen_fn()
+        error = RuntimeError("Request gốc bị hủy giữa chừng")
+        try:
+            async for event in agen:
+                if not call.consumers:
+                    error = RuntimeError("Mọi request chờ câu trả lời đã bị hủy")
+                    break
+                call.events.append(event)
+                async with cond:
+                    cond.notify_all()
+            else:
+                error = None
+        except Exception as e:
+            error = e
+        finally:
+            # Gỡ call trước khi đóng generator (có await) để request mới không nhận câu trả lời dở
+            self._finish(self._acalls, flight_key, call, error)
+            async with cond:
+                cond.notify_all()
+        await agen.aclose()
+
+    async def _afollow(self, cond, call, mode, leader, fallback):
+        """Bản async của _follow; "own" / "retry" được ghi vào fallback"""
+        sent = 0
+        while True:
+            try:
+                async with cond:
+                    await asyncio.wait_for(cond.wait_for(lambda: call.done or len(call.events) > sent),
+                                           None if leader else self.wait)
+            except asyncio.TimeoutError:
+                if sent == 0:
+                    fallback.append("own")
+                    return
+                raise TimeoutError("Hết thời gian chờ câu trả lời dùng chung")
+            events = call.events[sent:]
+            if sent == 0 and not events and call.error is not None and not leader:
+                fallback.append("retry")
+                return
+            if sent == 0 and events and not leader:
+                _count(mode, "follower")
+            for event in events:
+                yield event
+            sent += len(events)
+            if call.done and sent == len(call.events):
+                if call.error is not None:
+                    raise call.error
+                return
+
+
+_single_flight = SingleFlight()
+
+
+def get_single_flight():
+    return _single_flight
@@ -0,0 +1,212 @@
+"""
+Hàng đợi ghi nền (write-behind): request chỉ xếp thao tác ghi vào hàng đợi rồi trả lời ngay,
+một thread nền gom nhiều thao tác thành bulk write.
+- Bộ nhớ giới hạn: tối đa PERSIST_QUEUE_MAX thao tác chờ; đầy thì request chờ tối đa PERSIST_PUT_TIMEOUT
+  giây (backpressure), quá hạn thì chờ ghi xong các thao tác xếp trước rồi tự ghi đồng bộ (giữ thứ tự FIFO:
+  tin nhắn không được ghi trước lệnh tạo hội thoại của nó).
+- Ghi lỗi: thử lại PERSIST_RETRIES lần, vẫn lỗi thì ghi cả batch vào file dự phòng JSONL (một lần mở file mỗi batch).
+- close(): ghi nốt các thao tác còn trong hàng đợi khi worker tắt.
+PERSIST_WRITE_BEHIND=0 -> ghi đồng bộ như cũ.
+"""
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+from src import metrics
+
+PERSIST_WRITE_BEHIND = os.getenv("PERSIST_WRITE_BEHIND", "1") != "0"
+PERSIST_QUEUE_MAX = int(os.getenv("PERSIST_QUEUE_MAX", "5000"))
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "200"))
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "0.05"))   # giây chờ gom thêm thao tác
+PERSIST_PUT_TIMEOUT = float(os.getenv("PERSIST_PUT_TIMEOUT", "2"))
+PERSIST_RETRIES = int(os.getenv("PERSIST_RETRIES", "3"))
+PERSIST_FALLBACK_PATH = os.getenv("PERSIST_FALLBACK_PATH", "./persist_fallback.jsonl")
+
+_STOP = object()
+
+
+def append_jsonl(path, records):
+    """Ghi nhiều bản ghi JSONL trong một lần mở file"""
+    with open(path, "a", encoding="utf-8") as f:
+        f.writelines(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in records)
+
+
+class WriteBehindQueue:
+    """
+    handlers: kind -> hàm nhận list item cùng loại (theo thứ tự xếp hàng) và ghi chúng bằng bulk write.
+    Các loại được ghi theo thứ tự khai báo trong handlers (vd. tạo hội thoại trước khi thêm tin nhắn).
+    on_settled(kind, items): gọi sau khi items đã được ghi hoặc đã chuyển sang file dự phòng.
+    """
+
+    def __init__(self, handlers, on_settled=None, enabled: bool = PERSIST_WRITE_BEHIND,
+                 max_items: int = PERSIST_QUEUE_MAX, batch_size: int = PERSIST_BATCH_SIZE, interval: float = PERSIST_FLUSH_INTERVAL,
+                 put_timeout: float = PERSIST_PUT_TIMEOUT, fallback_path: str = PERSIST_FALLBACK_PATH):
+        self.handlers = handlers
+        self.on_settled = on_settled
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.interval = interval
+        self.put_timeout = put_timeout
+        self.fallback_path = fallback_path
+        self._queue = queue.Queue(maxsize=max_items)
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        self._enqueued = 0
+        self._processed = 0
+        self._thread = None
+        self._pid = None
+        self._closed = False
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    # ----- phía request -----
+    def _ensure_started(self):
+        # Thread không sống sót qua fork -> mỗi worker tự khởi động flusher của mình
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(maxsize=self._queue.maxsize)
+            self._enqueued = self._processed = 0
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def put(self, kind, item):
+        """Xếp hàng; đầy thì chờ tối đa put_timeout giây, rồi ghi đồng bộ sau khi các thao tác xếp trước đã ghi xong"""
+        if self.enabled and not self._closed:
+            self._ensure_started()
+            try:
+                self._put((kind, item), block=True, timeout=self.put_timeout)
+                return
+            except queue.Full:
+                metrics.inc("lexibot_persist_sync_writes_total", {"reason": "queue_full"})
+            if not self.drain():
+                # Thread ghi nền không kịp xả hàng đợi -> chờ chỗ trống thay vì ghi vượt lên trước
+                self._put((kind, item), block=True)
+                return
+        else:
+            self.drain()
+        self._write(kind, [item])
+
+    def _put(self, entry, **kwargs):
+        with self._lock:
+            self._enqueued += 1
+        try:
+            self._queue.put(entry, **kwargs)
+        except queue.Full:
+            self._mark_processed(1)
+            raise
+
+    def drain(self, timeout: float = 10.0) -> bool:
+        """Chờ các thao tác đã xếp hàng tới thời điểm gọi được ghi xong (vd. trước khi xóa hội thoại)"""
+        if self._thread is None or self._pid != os.getpid():
+            return True
+        with self._done:
+            target = self._enqueued
+            return self._done.wait_for(lambda: self._processed >= target, timeout)
+
+    def close(self, timeout: float = 10.0):
+        """Ghi nốt hàng đợi rồi dừng thread (gọi khi worker tắt)"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        pending = len(self)
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if pending:
+            print(f"[PERSIST] Đã ghi nốt {pending} thao tác trước khi tắt", flush=True)
+
+    # ----- thread nền -----
+    def _mark_processed(self, n):
+        with self._done:
+            self._processed += n
+            self._done.notify_all()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            entry = self._queue.get()
+            if entry is _STOP:
+                break
+            batch = [entry]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    entry = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    stop = True
+                    break
+                batch.append(entry)
+            self._flush(batch)
+        # Sau _STOP có thể vẫn còn thao tác được xếp hàng muộn
+        leftover = []
+        while True:
+            try:
+                entry = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is not _STOP:
+                leftover.append(entry)
+        if leftover:
+            self._flush(leftover)
+
+    def _flush(self, batch):
+        by_kind = {}
+        for kind, item in batch:
+            by_kind.setdefault(kind, []).append(item)
+        try:
+            with metrics.timed("persist_flush"):
+                for kind in self.handlers:
+                    if kind in by_kind:
+                        self._write(kind, by_kind[kind])
+            metrics.observe("lexibot_persist_batch_size", len(batch), buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+        except Exception as e:
+            # Không để thread ghi nền chết vì một batch lỗi
+            print(f"[PERSIST] Lỗi khi flush {len(batch)} thao tác: {e}", flush=True)
+        finally:
+            self._mark_processed(len(batch))
+
+    def _write(self, kind, items):
+        try:
+            self._write_with_retry(kind, items)
+        finally:
+            if self.on_settled is not None:
+                self.on_settled(kind, items)
+
+    def _write_with_retry(self, kind, items):
+        for attempt in range(PERSIST_RETRIES + 1):
+            try:
+                self.handlers[kind](items)
+                metrics.inc("lexibot_persist_writes_total", {"kind": kind}, len(items))
+                return
+            except Exception as e:
+                if attempt == PERSIST_RETRIES:
+                    print(f"[PERSIST] Ghi {len(items)} {kind} thất bại: {e} -> {self.fallback_path}", flush=True)
+                    break
+                time.sleep(0.1 * 2 ** attempt)
+        self.fallback(kind, items)
+
+    def fallback(self, kind, items, reason="write_failed"):
+        """Ghi các thao tác không ghi được vào file dự phòng JSONL (để khôi phục thủ công)"""
+        metrics.inc("lexibot_persist_fallback_total", {"kind": kind}, len(items))
+        try:
+            append_jsonl(self.fallback_path, [{"kind": kind, "reason": reason, "item": item} for item in items])
+        except Exception as e:
+            print(f"[PERSIST] Không ghi được file dự phòng: {e}", flush=True)
+
+
+def create_write_behind_queue(handlers, **kwargs):
+    """Tạo hàng đợi và đăng ký ghi nốt khi process thoát"""
+    persist_queue = WriteBehindQueue(handlers, **kwargs)
+    atexit.register(persist_queue.close)
+    metrics.register_gauge("lexibot_persist_queue_depth", "Số thao tác ghi đang chờ trong hàng đợi", lambda: len(persist_queue))
+    return persist_queue
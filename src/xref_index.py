@@ -0,0 +1,173 @@
+"""
+Index dẫn chiếu "khoản Y Điều X" giữa các Điều trong cùng một văn bản quy chế.
+- Build lúc ingestion (create_db.py) từ các chunk của split_legal_document, lưu ở chroma_db/xref_index.json.
+- Lúc trả lời: chunk retrieve được dẫn chiếu tới Điều nào thì lấy thẳng Điều đó bằng tra dict,
+  không cần thêm một lần tìm kiếm vector. Giới hạn độ sâu và số chunk thêm vào.
+"""
+import os
+import re
+import json
+from langchain_core.documents import Document
+
+XREF_FILE = "xref_index.json"
+XREF_ENABLED = os.getenv("XREF_EXPANSION", "1") != "0"
+XREF_MAX_DEPTH = int(os.getenv("XREF_MAX_DEPTH", "1"))
+XREF_MAX_CHUNKS = int(os.getenv("XREF_MAX_CHUNKS", "3"))            # tổng số chunk thêm mỗi câu hỏi
+XREF_MAX_CHUNKS_PER_REF = int(os.getenv("XREF_MAX_CHUNKS_PER_REF", "2"))
+
+# "Điều 10", "khoản 2 Điều 5", "khoản 1 và khoản 2 Điều 5", "khoản 3, 4 Điều 28 của Quy chế này"
+REF_PATTERN = re.compile(
+    r"((?:khoản\s+\d+(?:\s*(?:,|và)\s*(?:khoản\s+)?\d+)*)\s+(?:của\s+)?)?Điều\s+(\d+)(?!\d)",
+    re.IGNORECASE,
+)
+# Dẫn chiếu sang văn bản khác -> không xử lý được trong phạm vi một tài liệu
+EXTERNAL_HINTS = ("Luật", "Nghị định", "Thông tư", "Quyết định", "Bộ luật")
+ARTICLE_PATTERN = re.compile(r"Điều\s+(\d+)")
+
+
+def get_xref_path(db_path: str) -> str:
+    return os.path.join(db_path, XREF_FILE)
+
+
+def article_key(source: str, section: str) -> str:
+    return f"{os.path.basename(source or '')}|{section or ''}"
+
+
+def parse_section(section: str):
+    """ "CHƯƠNG II... > Điều 5. Học phí" -> ("CHƯƠNG II...", 5); không phải Điều -> (chương, None)"""
+    chapter, _, article = (section or "").rpartition(" > ")
+    match = ARTICLE_PATTERN.match(article)
+    return chapter, int(match.group(1)) if match else None
+
+
+def find_references(text: str):
+    """List (số Điều, [số khoản]) được nhắc tới trong đoạn văn"""
+    refs = []
+    for m in REF_PATTERN.finditer(text):
+        tail = re.split(r"[.;\n]", text[m.end():m.end() + 60], maxsplit=1)[0]
+        if any(hint in tail for hint in EXTERNAL_HINTS):
+            continue
+        clauses = [int(n) for n in re.findall(r"\d+", m.group(1) or "")]
+        refs.append((int(m.group(2)), clauses))
+    return refs
+
+
+def _clause_chunks(chunks, clauses):
+    """Vị trí các chunk của Điều chứa khoản được dẫn chiếu (không tìm thấy -> cả Điều)"""
+    if clauses:
+        patterns = [re.compile(rf"(?m)^\s*{n}\.\s") for n in clauses]
+        hits = [i for i, c in enumerate(chunks) if any(p.search(c["text"]) for p in patterns)]
+        if hits:
+            return hits
+    return list(range(len(chunks)))
+
+
+def build_xref_index(chunks):
+    """
+    chunks: Document của các văn bản quy chế (đầu ra split_legal_document, đã có section).
+    Dẫn chiếu được resolve ngay lúc build: ưu tiên Điều cùng chương (văn bản đánh số lại Điều
+    theo từng chương), sau đó tới Điều có số đó duy nhất trong văn bản. Một chương có nhiều Điều
+    trùng số (văn bản đánh số lỗi) -> dẫn chiếu tới tất cả các Điều đó.
+    """
+    articles = {}
+    by_chapter = {}
+    by_source = {}
+    for c in chunks:
+        section = c.metadata.get("section", "")
+        chapter, number = parse_section(section)
+        if number is None:
+            continue
+        source = os.path.basename(c.metadata.get("source", ""))
+        key = article_key(source, section)
+        if key not in articles:
+            articles[key] = {"chunks": []}
+            by_chapter.setdefault((source, chapter), {}).setdefault(number, []).append(key)
+            by_source.setdefault(source, {}).setdefault(number, []).append(key)
+        text = c.page_content
+        if text.startswith(f"[{section}]\n"):
+            text = text[len(section) + 3:]
+        articles[key]["chunks"].append({"text": c.page_content, "body": text, "metadata": c.metadata})
+
+    refs = {}
+    n_refs = 0
+    for key, article in articles.items():
+        source, section = key.split("|", 1)
+        chapter, number = parse_section(section)
+        targets = {}
+        for chunk in article["chunks"]:
+            for ref_number, clauses in find_references(chunk["body"]):
+                matches = by_chapter.get((source, chapter), {}).get(ref_number)
+                if not matches and len(by_source[source].get(ref_number, [])) == 1:
+                    matches = by_source[source][ref_number]
+                for target in matches or []:
+                    if target != key:
+                        targets.setdefault(target, set()).update(clauses)
+        if targets:
+            refs[key] = [
+                [target, _clause_chunks(articles[target]["chunks"], sorted(clauses))]
+                for target, clauses in targets.items()
+            ]
+            n_refs += len(targets)
+
+    for article in articles.values():
+        for chunk in article["chunks"]:
+            del chunk["body"]
+    return {"articles": articles, "refs": refs}, n_refs
+
+
+def export_xref_index(chunks, db_path: str):
+    index, n_refs = build_xref_index(chunks)
+    os.makedirs(db_path, exist_ok=True)
+    path = get_xref_path(db_path)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(path + ".tmp", path)
+    print(f"Đã xuất index dẫn chiếu: {len(index['articles'])} Điều, {n_refs} dẫn chiếu -> {path}")
+
+
+class XrefIndex:
+    """Tra các Điều được dẫn chiếu từ những chunk đã retrieve"""
+
+    def __init__(self, db_path: str, max_depth: int = XREF_MAX_DEPTH, max_chunks: int = XREF_MAX_CHUNKS,
+                 max_chunks_per_ref: int = XREF_MAX_CHUNKS_PER_REF):
+        with open(get_xref_path(db_path), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self.articles = data["articles"]
+        self.refs = data["refs"]
+        self.max_depth = max_depth
+        self.max_chunks = max_chunks
+        self.max_chunks_per_ref = max_chunks_per_ref
+
+    def expand(self, docs):
+        """Các chunk của Điều được dẫn chiếu (chưa có trong docs), theo thứ tự BFS, tối đa max_chunks"""
+        keys = (article_key(d.metadata.get("source"), d.metadata.get("section")) for d in docs)
+        frontier = list(dict.fromkeys(keys))
+        seen = set(frontier)
+        extra = []
+        for _ in range(self.max_depth):
+            next_frontier = []
+            for key in frontier:
+                for target, positions in self.refs.get(key, []):
+                    if target in seen:
+                        continue
+                    seen.add(target)
+                    next_frontier.append(target)
+                    chunks = self.articles[target]["chunks"]
+                    for pos in positions[:self.max_chunks_per_ref]:
+                        if len(extra) >= self.max_chunks:
+                            return extra
+                        chunk = chunks[pos]
+                        extra.append(Document(page_content=chunk["text"],
+                                              metadata={**chunk["metadata"], "xref_from": key}))
+            frontier = next_frontier
+        return extra
+
+
+def load_xref_index(db_path: str):
+    """None nếu tắt hoặc DB cũ chưa có xref_index.json (chạy lại create_db.py để tạo)"""
+    if not XREF_ENABLED:
+        return None
+    if not os.path.exists(get_xref_path(db_path)):
+        print("Chưa có xref_index.json, bỏ qua mở rộng dẫn chiếu (chạy lại create_db.py để tạo)")
+        return None
+    return XrefIndex(db_path)